@@ -29,7 +29,7 @@
 
 import os
 
-__all__ = ['builder', 'config', 'runner', 'utils', 'sysinstall', 'test']
+__all__ = ['accounting', 'builder', 'config', 'history', 'logfile', 'metrics', 'pkgindex', 'profiling', 'progress', 'runner', 'utils', 'sysinstall', 'tftp', 'trace', 'ufs', 'test']
 
 # General Info
 __version__ = '1.0'
@@ -51,6 +51,19 @@ LOADER_RC = os.path.join(DATA_DIR, "loader.rc")
 LOADER_CONF = os.path.join(DATA_DIR, "loader.conf")
 NETINSTALL_FORTH_TMPL = os.path.join(DATA_DIR, "netinstall.4th.tmpl")
 
+# Installation media layout, shared by the install root assembler and the
+# install.cfg files that refer to it
+# Mount point of the NFS install media within the sysinstall(8) mfsroot
+SYSINSTALL_MEDIA_PATH = '/dist'
+# Release data directory containing per-installation install.cfg files
+# and package lists
+INSTALL_CONFIG_DIR = 'install'
+# Release data directory containing per-installation package images
+PACKAGE_IMAGE_DIR = 'images'
+# Suffixes of per-installation package lists and package images
+PACKAGE_LIST_SUFFIX = '.packages'
+PACKAGE_IMAGE_SUFFIX = '.tgz'
+
 # Exceptions
 class FarbError(Exception):
     pass
@@ -0,0 +1,244 @@
+# accounting.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Resource usage accounting for the commands run by a build.
+
+The resources used by each command, as reported by wait4(2), are
+recorded against the labels in effect in the thread that ran it: the
+build phase, release and port. Labels nest, and are applied for the
+duration of a method with the labelled() decorator. Usage is aggregated
+per phase, per release and per port, for a summary at the end of a run.
+"""
+
+import threading
+
+# Dimensions by which command resource usage is aggregated
+DIMENSIONS = ('phase', 'release', 'port')
+
+class ResourceUsage(object):
+    """
+    Resources used by one or more commands
+    """
+    def __init__(self, wallTime=0.0, userTime=0.0, systemTime=0.0, maxRSS=0, inBlocks=0, outBlocks=0, voluntarySwitches=0, involuntarySwitches=0):
+        """
+        Create a new ResourceUsage instance
+        @param wallTime: Elapsed time, in seconds
+        @param userTime: User CPU time, in seconds
+        @param systemTime: System CPU time, in seconds
+        @param maxRSS: Maximum resident set size, in kilobytes
+        @param inBlocks: Block input operations
+        @param outBlocks: Block output operations
+        @param voluntarySwitches: Voluntary context switches
+        @param involuntarySwitches: Involuntary context switches
+        """
+        self.commands = 1
+        self.wallTime = wallTime
+        self.userTime = userTime
+        self.systemTime = systemTime
+        self.maxRSS = maxRSS
+        self.inBlocks = inBlocks
+        self.outBlocks = outBlocks
+        self.voluntarySwitches = voluntarySwitches
+        self.involuntarySwitches = involuntarySwitches
+
+    def fromRusage(cls, rusage, wallTime):
+        """
+        @param rusage: resource.struct_rusage, as returned by os.wait4()
+        @param wallTime: Elapsed time, in seconds
+        @return A new ResourceUsage instance
+        """
+        return cls(wallTime, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss, rusage.ru_inblock, rusage.ru_oublock, rusage.ru_nvcsw, rusage.ru_nivcsw)
+    fromRusage = classmethod(fromRusage)
+
+    def add(self, other):
+        """
+        Add another usage to this one. Times, I/O operations and context
+        switches are summed; the maximum resident set size is the larger
+        of the two.
+        @param other: ResourceUsage to add
+        """
+        self.commands += other.commands
+        self.wallTime += other.wallTime
+        self.userTime += other.userTime
+        self.systemTime += other.systemTime
+        self.maxRSS = max(self.maxRSS, other.maxRSS)
+        self.inBlocks += other.inBlocks
+        self.outBlocks += other.outBlocks
+        self.voluntarySwitches += other.voluntarySwitches
+        self.involuntarySwitches += other.involuntarySwitches
+
+    def copy(self):
+        usage = ResourceUsage()
+        usage.commands = 0
+        usage.add(self)
+        return usage
+
+    def asDict(self):
+        """
+        @return A dictionary of the usage's fields
+        """
+        return {
+            'commands' : self.commands,
+            'wallTime' : self.wallTime,
+            'userTime' : self.userTime,
+            'systemTime' : self.systemTime,
+            'maxRSS' : self.maxRSS,
+            'inBlocks' : self.inBlocks,
+            'outBlocks' : self.outBlocks,
+            'voluntarySwitches' : self.voluntarySwitches,
+            'involuntarySwitches' : self.involuntarySwitches
+        }
+
+class Accountant(object):
+    """
+    Aggregate command resource usage by phase, release and port
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {}
+        for dimension in DIMENSIONS:
+            self.totals[dimension] = {}
+
+    def record(self, usage, labels):
+        """
+        Record a command's resource usage
+        @param usage: ResourceUsage of the command
+        @param labels: Dictionary of the labels in effect when the command
+            was run
+        """
+        self._lock.acquire()
+        try:
+            for dimension in DIMENSIONS:
+                key = labels.get(dimension)
+                if (key is None):
+                    continue
+                # Ports are built once per release
+                if (dimension == 'port' and labels.get('release') is not None):
+                    key = '%s (%s)' % (key, labels['release'])
+                totals = self.totals[dimension]
+                if (totals.has_key(key)):
+                    totals[key].add(usage)
+                else:
+                    totals[key] = usage.copy()
+        finally:
+            self._lock.release()
+
+    def writeSummary(self, output):
+        """
+        Write a table of the aggregated usage
+        @param output: Open file
+        """
+        self._lock.acquire()
+        try:
+            for dimension in DIMENSIONS:
+                totals = self.totals[dimension]
+                if (not totals):
+                    continue
+                keys = totals.keys()
+                keys.sort()
+                width = max([len(dimension)] + [len(key) for key in keys])
+                output.write("Resource usage by %s:\n" % (dimension))
+                output.write("  %-*s %8s %10s %10s %10s %9s %10s %10s %10s %10s\n" % (width, dimension, 'commands', 'wall(s)', 'user(s)', 'sys(s)', 'maxrss(M)', 'in blocks', 'out blocks', 'vol csw', 'invol csw'))
+                for key in keys:
+                    usage = totals[key]
+                    output.write("  %-*s %8d %10.1f %10.1f %10.1f %9.1f %10d %10d %10d %10d\n" % (width, key, usage.commands, usage.wallTime, usage.userTime, usage.systemTime, usage.maxRSS / 1024.0, usage.inBlocks, usage.outBlocks, usage.voluntarySwitches, usage.involuntarySwitches))
+        finally:
+            self._lock.release()
+
+# Accountant recording the current run
+_accountant = Accountant()
+
+# Per-thread stack of label dictionaries
+_context = threading.local()
+
+def getAccountant():
+    """
+    @return The Accountant recording the current run
+    """
+    return _accountant
+
+def reset():
+    """
+    Discard all recorded usage
+    """
+    global _accountant
+    _accountant = Accountant()
+
+def _getStack():
+    stack = getattr(_context, 'stack', None)
+    if (stack is None):
+        stack = []
+        _context.stack = stack
+    return stack
+
+def getLabels():
+    """
+    @return A dictionary of the labels in effect in the current thread
+    """
+    labels = {}
+    for entry in _getStack():
+        labels.update(entry)
+    return labels
+
+def adopt(labels):
+    """
+    Apply labels taken from another thread with getLabels() to the
+    current thread
+    @param labels: Label dictionary
+    """
+    if (labels):
+        _getStack().append(labels)
+
+def labelled(labels):
+    """
+    Decorate a method, applying labels to the commands it runs
+    @param labels: Callable passed the method's arguments, including the
+        instance, returning a dictionary of labels
+    """
+    def decorate(function):
+        def wrapper(self, *args, **kwargs):
+            stack = _getStack()
+            stack.append(labels(self, *args, **kwargs))
+            try:
+                return function(self, *args, **kwargs)
+            finally:
+                stack.pop()
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorate
+
+def record(usage, labels):
+    """
+    Record a command's resource usage with the current Accountant
+    @param usage: ResourceUsage of the command
+    @param labels: Labels in effect when the command was run
+    """
+    _accountant.record(usage, labels)
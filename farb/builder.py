@@ -28,16 +28,26 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import cStringIO
+import errno
 import exceptions
+import fcntl
 import glob
 import gzip
 import os
+import Queue
 import re
+import select
 import shutil
+import signal
+import stat
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 import farb
-from farb import utils
+from farb import accounting, pkgindex, profiling, progress, trace, ufs, utils
 
 # make(1) path
 MAKE_PATH = '/usr/bin/make'
@@ -63,6 +73,9 @@ PORTSNAP_PATH = '/usr/sbin/portsnap'
 # tar(1) path
 TAR_PATH = '/usr/bin/tar'
 
+# pkg_add(1) path
+PKG_ADD_PATH = '/usr/sbin/pkg_add'
+
 # chflags(1) path
 CHFLAGS_PATH = '/bin/chflags'
 
@@ -87,6 +100,43 @@ ROOT_PATH = '/'
 # Releative path for /etc/resolv.conf
 RESOLV_CONF = 'etc/resolv.conf'
 
+# tftproot-relative directory containing per-release boot files shared by
+# all installations of that release
+SHARED_BOOT_DIR = 'releases'
+
+# Chroot-relative paths archived in package images
+PACKAGE_IMAGE_PATHS = ('usr/local', 'var/db/pkg')
+
+# Chroot-relative mount point of the package directory while building
+# package images
+PACKAGE_IMAGE_MOUNT = 'mnt'
+
+# Kernel directory files kept when pruning kernel modules, in addition
+# to the kernel and the allowed modules
+KERNEL_KEEP_FILES = ('linker.hints',)
+
+# InstallRoot-relative directory containing install root generations
+GENERATIONS_DIR = '.generations'
+
+# Name of the symlink that points to the served install root generation
+CURRENT_GENERATION = 'current'
+
+# Replica-relative manifest of replicated install root files
+REPLICA_MANIFEST = '.farbot-manifest'
+
+# Suffix of files being copied into a replica
+REPLICA_TEMP_SUFFIX = '.farbot-part'
+
+# Size of the reads and writes used to exchange data with commands
+COMMAND_BUFSIZE = 65536
+
+# Number of bytes of a command's output queued for its log before the
+# command is no longer read from
+COMMAND_LOG_BUFFER = 1048576
+
+# Interval at which to check for exited commands whose pipes have closed
+COMMAND_POLL_INTERVAL = 0.01
+
 # Default Root Environment
 ROOT_ENV = {
     'USER'      : 'root',
@@ -97,6 +147,14 @@ ROOT_ENV = {
     'FTP_PASSIVE_MODE' : 'YES'
 }
 
+# Package Installation Environment. Prevents pkg_add(1) from trying to
+# interact with the user.
+PACKAGE_ENV = ROOT_ENV.copy()
+PACKAGE_ENV.update({
+    'PACKAGE_BUILDING'  : '1',
+    'BATCH'             : '1'
+})
+
 # Exceptions
 class CommandError(farb.FarbError):
     pass
@@ -125,6 +183,9 @@ class ChflagsCommandError(CommandError):
 class TarCommandError(CommandError):
     pass
 
+class PkgAddCommandError(CommandError):
+    pass
+
 class ReleaseBuildError(farb.FarbError):
     pass
 
@@ -137,6 +198,9 @@ class PackageChrootAssemblerError(farb.FarbError):
 class PackageBuildError(farb.FarbError):
     pass
 
+class PackageImageBuildError(farb.FarbError):
+    pass
+
 class InstallAssembleError(farb.FarbError):
     pass
 
@@ -152,6 +216,19 @@ class CDReleaseError(farb.FarbError):
 class ChrootCleanerError(farb.FarbError):
     pass
 
+class InstallRootGenerationsError(farb.FarbError):
+    pass
+
+class InstallRootReplicatorError(farb.FarbError):
+    pass
+
+# CommandSupervisor on which _runCommand runs commands, if any
+_commandSupervisor = None
+
+# Serializes md(4) device attachment and detachment between concurrent
+# assemblers
+_mdconfigLock = threading.Lock()
+
 class MDConfigCommand(object):
     """
     mdconfig(8) command context
@@ -173,7 +250,11 @@ class MDConfigCommand(object):
 
         # Create command argv, and run it. Save the device name mdconfig prints
         argv = [MDCONFIG_PATH, '-a', '-t', 'vnode', '-f', self.file]
-        device = _runCommand(argv, log, MDConfigCommandError, ROOT_ENV, True)
+        _mdconfigLock.acquire()
+        try:
+            device = _runCommand(argv, log, MDConfigCommandError, ROOT_ENV, True).output
+        finally:
+            _mdconfigLock.release()
         self.md = device.rstrip('\n')
 
     def detach(self, log):
@@ -185,7 +266,11 @@ class MDConfigCommand(object):
 
         # Create command argv, then run it
         argv = [MDCONFIG_PATH, '-d', '-u', self.md]
-        _runCommand(argv, log, MDConfigCommandError, ROOT_ENV)
+        _mdconfigLock.acquire()
+        try:
+            _runCommand(argv, log, MDConfigCommandError, ROOT_ENV)
+        finally:
+            _mdconfigLock.release()
 
 class CVSCommand(object):
     """
@@ -437,7 +522,7 @@ class ReleaseBuilder(object):
         fbsdBranch = None
         
         argv = [CVS_PATH, '-R', '-d', self.cvsroot, 'co', '-p', '-r', self.cvstag, NEWVERS_PATH]
-        buffer = _runCommand(argv, log, CVSCommandError, ROOT_ENV, True)
+        buffer = _runCommand(argv, log, CVSCommandError, ROOT_ENV, True).output
         
         # Split the input into lines
         lines = buffer.split('\n')
@@ -456,6 +541,7 @@ class ReleaseBuilder(object):
         
         return fbsdRevision + '-' + fbsdBranch
 
+    @trace.traced('step', 'build release %(cvstag)s')
     def build(self, log):
         """
         Build the release
@@ -537,25 +623,19 @@ class PackageChrootAssembler(object):
         if (not os.path.exists(target)):
             os.makedirs(target)
         
-        # Extract a distribution set into the chroot with tar. We use the 
-        # subprocess module directly here rather than the helper function 
-        # _runCommand so we will have control over the process' standard input.
+        # Extract a distribution set into the chroot with tar, feeding
+        # the split distribution set to it in order
         argv = [TAR_PATH, '--unlink', '-xpvzf', '-', '-C', target]
-        proc = subprocess.Popen(argv, stdout=log, stderr=log, env=ROOT_ENV, stdin=subprocess.PIPE)
-        
-        path = os.path.join(distdir, distname.lower())
-        files = glob.glob(path + '.??')
-        for filename in files:
-            file = open(filename, 'rb')
-            proc.stdin.write(file.read())
-            file.close()
-        
-        proc.stdin.close()
-        retval = proc.wait()
-        if retval != 0:
-            raise TarCommandError, "%s returned with exit code %d while extracting dist %s" % (argv[0], retval, distname)
+        files = glob.glob(os.path.join(distdir, distname.lower()) + '.??')
+        files.sort()
+        try:
+            _runCommand(argv, log, TarCommandError, ROOT_ENV, input=_readFiles(files))
+        except TarCommandError, e:
+            raise TarCommandError, "%s while extracting dist %s" % (e, distname)
+        progress.addBytes(sum([os.path.getsize(path) for path in files]))
         
     def _extractAll(self, dists, log):
+        progress.addTotal('dists', sum([len(distnames) for distnames in dists.itervalues()]))
         # Extract each dist in the chroot
         for key in dists.iterkeys():
             distdir = os.path.join(self.cdroot, os.path.join(self.cdroot, _getCDRelease(self.cdroot)), key)
@@ -575,7 +655,9 @@ class PackageChrootAssembler(object):
                     target = self.chroot
             
                 self._extractDist(distdir, distname, target, log)
+                progress.advance('dists')
     
+    @trace.traced('step', lambda self, dists, log: 'extract %s' % (self.chroot))
     def extract(self, dists, log):
         """
         Extract the release into a chroot
@@ -605,6 +687,7 @@ class PackageBuilder(object):
     Build a package from a FreeBSD port
     """
     makeTarget = ('deinstall', 'clean', 'package-recursive')
+    fetchTarget = ('fetch-recursive',)
     defaultMakeOptions = {
         'PACKAGE_BUILDING'  : 'yes',
         'BATCH'             : 'yes',
@@ -626,6 +709,23 @@ class PackageBuilder(object):
         self.port = port
         self.buildOptions = buildOptions
 
+    @trace.traced('step', 'fetch package %(port)s')
+    @accounting.labelled(lambda self, log: {'port' : self.port})
+    def fetch(self, log):
+        """
+        Fetch the distfiles of the port and its dependencies
+        @param log: Open log file
+        """
+        makeOptions = self.defaultMakeOptions.copy()
+        makeOptions.update(self.buildOptions)
+        makecmd = MakeCommand(os.path.join(FREEBSD_PORTS_PATH, self.port), self.fetchTarget, makeOptions, self.pkgroot)
+        try:
+            makecmd.make(log)
+        except MakeCommandError, e:
+            raise PackageBuildError, "An error occured fetching the distfiles of the port \"%s\": %s" % (self.port, e)
+
+    @trace.traced('step', 'build package %(port)s')
+    @accounting.labelled(lambda self, log: {'port' : self.port})
     def build(self, log):
         """
         Build the package 
@@ -639,21 +739,144 @@ class PackageBuilder(object):
         except MakeCommandError, e:
             raise PackageBuildError, "An error occured building the port \"%s\": %s" % (self.port, e)
 
+class PackageImageBuilder(object):
+    """
+    Build an archive of an installation's installed packages, by
+    installing the packages in a scratch chroot
+    """
+    def __init__(self, releaseroot, packagedir, chroot, packages):
+        """
+        Create a new PackageImageBuilder instance
+        @param releaseroot: Directory that contains built release in R/
+        @param packagedir: Directory containing the built packages
+        @param chroot: Scratch chroot directory in which to install the
+            packages
+        @param packages: Names of the packages to install. Their
+            dependencies are also installed.
+        """
+        self.releaseroot = releaseroot
+        self.packagedir = packagedir
+        self.chroot = chroot
+        self.packages = packages
+
+    def _installPackages(self, packages, log):
+        """
+        Install packages in the chroot, from the package directory
+        mounted within it.
+        @param packages: List of Packages, in installation order
+        @param log: Open log file
+        """
+        devmount = MountCommand('devfs', os.path.join(self.chroot, 'dev'), fstype='devfs')
+        pkgmount = MountCommand(self.packagedir, os.path.join(self.chroot, PACKAGE_IMAGE_MOUNT), fstype='nullfs')
+        for mount in (devmount, pkgmount):
+            if (not os.path.exists(mount.mountpoint)):
+                os.makedirs(mount.mountpoint)
+
+        devmount.mount(log)
+        try:
+            pkgmount.mount(log)
+            try:
+                for package in packages:
+                    log.write("Installing package %s in %s\n" % (package.name, self.chroot))
+                    argv = [CHROOT_PATH, self.chroot, PKG_ADD_PATH, os.path.join('/', PACKAGE_IMAGE_MOUNT, package.getPath())]
+                    _runCommand(argv, log, PkgAddCommandError, PACKAGE_ENV)
+            finally:
+                pkgmount.umount(log)
+        finally:
+            devmount.umount(log)
+
+    @trace.traced('stage', lambda self, dists, imagePath, log: 'build package image %s' % (os.path.basename(imagePath)))
+    def build(self, dists, imagePath, log):
+        """
+        Populate the scratch chroot with the release, install the packages
+        in it, and write the gzip(1) compressed tar(1) image of the
+        installed packages.
+        @param dists: Dictionary of distribution sets to extract, as
+            accepted by PackageChrootAssembler.extract()
+        @param imagePath: Path of the package image to write
+        @param log: Open log file
+        """
+        try:
+            assembler = PackageChrootAssembler(self.releaseroot, self.chroot)
+            assembler.extract(dists, log)
+
+            index = pkgindex.PackageIndex()
+            index.scan(self.packagedir)
+            self._installPackages(index.getInstallOrder(self.packages), log)
+
+            for path in PACKAGE_IMAGE_PATHS:
+                if (not os.path.exists(os.path.join(self.chroot, path))):
+                    os.makedirs(os.path.join(self.chroot, path))
+            if (not os.path.exists(os.path.dirname(imagePath))):
+                os.makedirs(os.path.dirname(imagePath))
+
+            log.write("Writing package image %s\n" % (imagePath))
+            argv = [TAR_PATH, '-czf', imagePath, '-C', self.chroot] + list(PACKAGE_IMAGE_PATHS)
+            _runCommand(argv, log, TarCommandError, ROOT_ENV)
+
+            # Discard the scratch chroot
+            ChrootCleaner(self.chroot).clean(log)
+
+        except PackageChrootAssemblerError, e:
+            raise PackageImageBuildError, "Error populating the package image chroot: %s" % e
+        except pkgindex.PackageIndexError, e:
+            raise PackageImageBuildError, "Could not resolve the image's packages: %s" % e
+        except CommandError, e:
+            raise PackageImageBuildError, "Error building the package image: %s" % e
+        except ChrootCleanerError, e:
+            raise PackageImageBuildError, "Error cleaning the package image chroot: %s" % e
+        except exceptions.OSError, e:
+            raise PackageImageBuildError, "An OS error occured: %s" % e
+
 class InstallAssembler(object):
     """
     Assemble an installation configuration
     """
-    def __init__(self, name, description, releaseroot, installConfigPath):
+    def __init__(self, name, description, releaseroot, installConfigPath, release=None, mfsCache=None, bootstrapConfigPath=None, loaderVariables=None, compress=False, kernelModules=None, packages=None, packageImage=None):
         """
         @param name: A unique name for this install instance 
         @param description: A human-readable description of this install type
         @param releaseroot: Directory containing the release binaries
         @param installConfigFile: The complete path to this installation's install.cfg
+        @param release: Name of the release used by this installation.
+            Defaults to the release version in the release's cdrom.inf
+        @param mfsCache: Optional directory in which decompressed mfsroot
+            images are cached, keyed by the hash of the compressed image.
+        @param bootstrapConfigPath: Optional path to a bootstrap install.cfg.
+            If supplied, the installation boots the release's shared mfsroot
+            containing the bootstrap install.cfg, which loads this
+            installation's install.cfg from the release data over NFS.
+        @param loaderVariables: Optional dictionary of additional boot loader
+            variables to set in the installation's boot.conf
+        @param compress: Store the kernel, its modules, and the mfsroot
+            gzip(1) compressed. The boot loader transparently loads the
+            compressed copies of the files named in boot.conf.
+        @param kernelModules: Optional list of the names of the kernel
+            modules to install with the kernel. Modules referenced by the
+            boot loader configuration are always installed. If None, all
+            of the release's kernel modules are installed.
+        @param packages: Optional list of the names of the packages to
+            install. If supplied, the packages and their dependencies are
+            written, in installation order, to a package list in the
+            release's data directory, for use by install_package.sh.
+        @param packageImage: Optional path to the installation's package
+            image, built by PackageImageBuilder, which is copied to the
+            release's data directory.
         """
         self.name = name
         self.description = description
         self.releaseroot = releaseroot
         self.installConfigSource = installConfigPath
+        self.release = release
+        self.mfsCache = mfsCache
+        self.bootstrapConfigSource = bootstrapConfigPath
+        if (loaderVariables is None):
+            loaderVariables = {}
+        self.loaderVariables = loaderVariables
+        self.compress = compress
+        self.kernelModules = kernelModules
+        self.packages = packages
+        self.packageImage = packageImage
         
         #
         # Source Paths
@@ -671,12 +894,49 @@ class InstallAssembler(object):
         Decompression/writing of mfsroot file
         """
         compressedFile = gzip.GzipFile(self.mfsCompressed, 'rb')
-        outputFile = open(mfsOutput, 'wb')
-        while (True):
-            data = compressedFile.read(1024)
-            if (not data):
-                break
-            outputFile.write(data)
+        try:
+            outputFile = open(mfsOutput, 'wb')
+            try:
+                utils.copyFileObjSparse(compressedFile, outputFile)
+            finally:
+                outputFile.close()
+        finally:
+            compressedFile.close()
+
+    def _writeMFSRoot(self, mfsOutput, log):
+        """
+        Write the uncompressed mfsroot file. If an mfsroot cache is
+        configured, the release's mfsroot is only decompressed once, and
+        each installation receives a sparse copy of the cached image.
+        """
+        if (not self.mfsCache):
+            log.write("Decompressing %s to %s\n" % (self.mfsCompressed, mfsOutput))
+            self._decompressMFSRoot(mfsOutput)
+            return
+
+        try:
+            os.makedirs(self.mfsCache)
+        except OSError, e:
+            # Concurrent assemblers may race to create the cache
+            if (e.errno != errno.EEXIST):
+                raise
+
+        cached = os.path.join(self.mfsCache, utils.sha1File(self.mfsCompressed) + '.mfsroot')
+        if (not os.path.exists(cached)):
+            # Decompress to a temporary file first, so that a partially
+            # written image is never mistaken for a cached one
+            log.write("Decompressing %s to mfsroot cache %s\n" % (self.mfsCompressed, cached))
+            fd, tmpname = tempfile.mkstemp(dir=self.mfsCache)
+            os.close(fd)
+            try:
+                self._decompressMFSRoot(tmpname)
+                os.rename(tmpname, cached)
+            except:
+                os.unlink(tmpname)
+                raise
+
+        log.write("Copying cached mfsroot %s to %s\n" % (cached, mfsOutput))
+        utils.copySparse(cached, mfsOutput)
     
     def _mountMFSRoot(self, mfsOutput, mountPoint, log):
         """
@@ -689,19 +949,73 @@ class InstallAssembler(object):
         self.mdmount = MDMountCommand(mdconfig, mountPoint)
         self.mdmount.mount(log)
 
+    def _editMFSRoot(self, mfsOutput, installConfigSource, log):
+        """
+        Write an install.cfg directly into the decompressed mfsroot
+        image, without attaching or mounting it.
+        @return True if the install.cfg was written, or False if the
+            image could not be opened for editing.
+        """
+        try:
+            image = ufs.UFSImage(mfsOutput)
+        except ufs.UFSImageError, e:
+            log.write("Unable to edit %s in place, it will be mounted instead: %s\n" % (mfsOutput, e))
+            return False
+
+        try:
+            log.write("Writing %s to mfsroot %s\n" % (installConfigSource, mfsOutput))
+            installConfig = open(installConfigSource, 'r')
+            try:
+                image.writeFile('/install.cfg', installConfig.read())
+            finally:
+                installConfig.close()
+        finally:
+            image.close()
+
+        return True
+
     def _copyKernel(self, destdir):
         """
-        Copy the kernel directory to the install-specific directory
+        Copy the kernel directory to the shared release directory
         """
         dest = os.path.join(destdir, 'kernel')
-        utils.copyRecursive(self.kernel, dest, symlinks=True)
+        if (self.kernelModules == None):
+            utils.copyRecursive(self.kernel, dest, symlinks=True)
+            return
+
+        # Copy only the kernel and the required modules
+        os.makedirs(dest)
+        keep = _kernelKeepFiles(self.kernelModules)
+        for name in os.listdir(self.kernel):
+            if (keep.has_key(name)):
+                utils.copyWithOwnership(os.path.join(self.kernel, name), os.path.join(dest, name))
+        shutil.copystat(self.kernel, dest)
+
+    def getReleaseName(self):
+        """
+        @return The name of the release used by this installation
+        """
+        if (self.release == None):
+            self.release = _getCDRelease(os.path.join(self.releaseroot, RELEASE_CD_PATH))
+        return self.release
+
+    def getSharedBootDir(self):
+        """
+        @return The tftproot-relative directory containing the boot files
+            shared by all installations of this installation's release
+        """
+        return os.path.join(SHARED_BOOT_DIR, self.getReleaseName())
 
     def _doWriteBootConf(self, destdir):
         """
         Write the per-install bootloader configuration file
         """
         subst = {}
-        subst['bootdir'] = os.path.basename(destdir)
+        subst['kerneldir'] = os.path.join(self.getSharedBootDir(), 'kernel')
+        if (self.bootstrapConfigSource):
+            subst['mfsroot'] = os.path.join(self.getSharedBootDir(), 'mfsroot')
+        else:
+            subst['mfsroot'] = os.path.join(os.path.basename(destdir), 'mfsroot')
 
         output = open(os.path.join(destdir, 'boot.conf'), 'w')
         template = open(farb.BOOT_CONF_TMPL, 'r')
@@ -709,12 +1023,177 @@ class InstallAssembler(object):
         for line in template:
             output.write(line % (subst))
 
+        # Tell the shared mfsroot's bootstrap install.cfg which
+        # installation to load
+        loaderVariables = self.loaderVariables.copy()
+        if (self.bootstrapConfigSource):
+            loaderVariables['configFile'] = os.path.join(farb.SYSINSTALL_MEDIA_PATH, self.getInstallConfigName())
+
+        names = loaderVariables.keys()
+        names.sort()
+        for name in names:
+            output.write('%s="%s"\n' % (name, loaderVariables[name]))
+
         output.close()
         template.close()
+
+    def _buildMFSRoot(self, mfsOutput, installConfigSource, mountPoint, log):
+        """
+        Write an mfsroot containing the given install.cfg
+        """
+        try:
+            # Write the uncompressed mfsroot file
+            self._writeMFSRoot(mfsOutput, log)
+
+            # Write the install.cfg directly into the mfsroot image. If the
+            # image can't be edited in place, mount it instead.
+            if (not self._editMFSRoot(mfsOutput, installConfigSource, log)):
+                # Mount the mfsroot once it has been decompressed
+                log.write("Mounting %s on %s\n" % (mfsOutput, mountPoint))
+                self._mountMFSRoot(mfsOutput, mountPoint, log)
+
+                # Copy the install.cfg to the attached md device
+                log.write("Copying %s to mfsroot mounted at %s\n" % (installConfigSource, mountPoint))
+                shutil.copy2(installConfigSource, os.path.join(mountPoint, 'install.cfg'))
+
+                # Unmount/detach md device
+                self.mdmount.umount(log)
+
+        except MDConfigCommandError, e:
+            raise InstallAssembleError, "An error occured operating on the mfsroot \"%s\": %s" % (mfsOutput, e)
+        except MountCommandError, e:
+            raise InstallAssembleError, "An error occured mounting \"%s\": %s" % (mfsOutput, e)
+        except ufs.UFSImageError, e:
+            raise InstallAssembleError, "An error occured writing to the mfsroot \"%s\": %s" % (mfsOutput, e)
+
+    def getInstallConfigName(self):
+        """
+        @return The path of this installation's install.cfg, relative to
+            its release's data directory, when using a shared mfsroot
+        """
+        return os.path.join(farb.INSTALL_CONFIG_DIR, self.name + '.cfg')
+
+    def getPackageListName(self):
+        """
+        @return The path of this installation's package list, relative to
+            its release's data directory
+        """
+        return os.path.join(farb.INSTALL_CONFIG_DIR, self.name + farb.PACKAGE_LIST_SUFFIX)
+
+    def getPackageImageName(self):
+        """
+        @return The path of this installation's package image, relative to
+            its release's data directory
+        """
+        return os.path.join(farb.PACKAGE_IMAGE_DIR, self.name + farb.PACKAGE_IMAGE_SUFFIX)
         
+    def buildShared(self, shareddir, log):
+        """
+        Copy the boot files that are shared by all installations of this
+        installation's release.
+        @param shareddir: The release-specific boot-loader directory, as
+            returned by getSharedBootDir()
+        @param log: Open log file
+        """
+        try:
+            # Replace anything left over from a previous build
+            if (os.path.exists(shareddir)):
+                shutil.rmtree(shareddir)
+
+            # Copy the kernel
+            log.write("Copying kernel from %s to %s\n" % (self.kernel, shareddir))
+            self._copyKernel(shareddir)
+            if (self.compress):
+                log.write("Compressing kernel in %s\n" % (shareddir))
+                _compressKernel(os.path.join(shareddir, 'kernel'))
+
+            # Write the shared mfsroot, containing the bootstrap install.cfg
+            if (self.bootstrapConfigSource):
+                mfsOutput = os.path.join(shareddir, 'mfsroot')
+                self._buildMFSRoot(mfsOutput, self.bootstrapConfigSource, os.path.join(shareddir, 'mnt'), log)
+                if (self.compress):
+                    log.write("Compressing %s\n" % (mfsOutput))
+                    utils.compressFile(mfsOutput)
+
+        except InstallAssembleError:
+            raise
+        except exceptions.IOError, e:
+            raise InstallAssembleError, "An I/O error occured: %s" % e
+        except Exception, e:
+            raise InstallAssembleError, "An error occured: %s" % e
+
+    def _writePackageList(self, releasedir, log):
+        """
+        Write the paths of this installation's packages, and all of their
+        dependencies, to the package list, in installation order. If the
+        release has no package index, the package names are written as
+        given, leaving pkg_add(1) to find their dependencies.
+        @param releasedir: The release's installation data directory
+        @param log: Open log file
+        """
+        indexPath = os.path.join(releasedir, 'packages', pkgindex.INDEX_NAME)
+        if (os.path.exists(indexPath)):
+            index = pkgindex.PackageIndex()
+            index.read(indexPath)
+            entries = []
+            for package in index.getInstallOrder(self.packages):
+                entries.append(os.path.join(farb.SYSINSTALL_MEDIA_PATH, 'packages', package.getPath()))
+        else:
+            entries = self.packages
+
+        dest = os.path.join(releasedir, self.getPackageListName())
+        log.write("Writing package list %s\n" % (dest))
+        output = open(dest, 'w')
+        try:
+            for entry in entries:
+                output.write(entry + '\n')
+        finally:
+            output.close()
+
+    def buildReleaseData(self, releasedir, log):
+        """
+        Write this installation's files in its release's data directory:
+        the package list and package image, if any, and, when using a
+        shared mfsroot, the install.cfg, which is loaded from there at boot.
+        @param releasedir: The release's installation data directory
+        @param log: Open log file
+        """
+        try:
+            if (self.packageImage):
+                dest = os.path.join(releasedir, self.getPackageImageName())
+                if (not os.path.exists(os.path.dirname(dest))):
+                    os.mkdir(os.path.dirname(dest))
+                log.write("Copying %s to %s\n" % (self.packageImage, dest))
+                shutil.copy2(self.packageImage, dest)
+
+            if (not self.bootstrapConfigSource and self.packages == None):
+                return
+
+            installdir = os.path.join(releasedir, farb.INSTALL_CONFIG_DIR)
+            if (not os.path.exists(installdir)):
+                os.mkdir(installdir)
+
+            if (self.packages != None):
+                self._writePackageList(releasedir, log)
+
+            if (self.bootstrapConfigSource):
+                dest = os.path.join(releasedir, self.getInstallConfigName())
+                log.write("Copying %s to %s\n" % (self.installConfigSource, dest))
+                shutil.copy2(self.installConfigSource, dest)
+        except pkgindex.PackageIndexError, e:
+            raise InstallAssembleError, "Could not resolve the installation's packages: %s" % e
+        except exceptions.IOError, e:
+            raise InstallAssembleError, "An I/O error occured: %s" % e
+        except exceptions.OSError, e:
+            raise InstallAssembleError, "An OS error occured: %s" % e
+
+    @trace.traced('step', 'assemble installation %(name)s')
+    @accounting.labelled(lambda self, destdir, log: {'release' : self.release})
     def build(self, destdir, log):
         """
-        Build the MFSRoot, build the boot loader configuration, and copy the kernel.
+        Build the MFSRoot and the boot loader configuration. The kernel
+        referenced by the boot loader configuration, and the shared
+        mfsroot, if any, are installed by buildShared().
         @param destdir: The installation-specific boot-loader directory
         @param log: Open log file
         """
@@ -726,41 +1205,26 @@ class InstallAssembler(object):
         mfsOutput = os.path.join(destdir, "mfsroot")
         # Temporary mount point for the mfsroot image
         mountPoint = os.path.join(destdir, "mnt")
-        # Write the install.cfg to the mfsroot mount point
-        installConfigDest = os.path.join(mountPoint, 'install.cfg')
 
         try:
             # Create the destdir, if necessary
             if (not os.path.exists(destdir)):
                 os.mkdir(destdir)
 
-            # Write the uncompressed mfsroot file
-            log.write("Decompressing %s to %s\n" % (self.mfsCompressed, mfsOutput))
-            self._decompressMFSRoot(mfsOutput)
-        
-            # Mount the mfsroot once it has been decompressed
-            log.write("Mounting %s on %s\n" % (mfsOutput, mountPoint))
-            self._mountMFSRoot(mfsOutput, mountPoint, log)
-
-            # Copy the install.cfg to the attached md device
-            log.write("Copying %s to mfsroot mounted at %s\n" % (self.installConfigSource, mountPoint))
-            shutil.copy2(self.installConfigSource, installConfigDest)
-
-            # Unmount/detach md device
-            self.mdmount.umount(log)
-
-            # Copy the kernel
-            log.write("Copying kernel from %s to %s\n" % (self.kernel, destdir))
-            self._copyKernel(destdir)
+            # Installations using the release's shared mfsroot only need a
+            # boot.conf of their own
+            if (not self.bootstrapConfigSource):
+                self._buildMFSRoot(mfsOutput, self.installConfigSource, mountPoint, log)
+                if (self.compress):
+                    log.write("Compressing %s\n" % (mfsOutput))
+                    utils.compressFile(mfsOutput)
 
             # Write boot.conf
             log.write("Writing out boot.conf file in %s\n" % destdir)
             self._doWriteBootConf(destdir)
         
-        except MDConfigCommandError, e:
-            raise InstallAssembleError, "An error occured operating on the mfsroot \"%s\": %s" % (self.mfsOutput, e)
-        except MountCommandError, e:
-            raise InstallAssembleError, "An error occured mounting \"%s\": %s" % (self.mfsOutput, e)
+        except InstallAssembleError:
+            raise
         except exceptions.IOError, e:
             raise InstallAssembleError, "An I/O error occured: %s" % e
         except Exception, e:
@@ -770,19 +1234,56 @@ class ReleaseAssembler(object):
     """
     Assemble the per-release installation data directory.
     """
-    def __init__(self, name, releaseroot, pkgroot, localData = []):
+    def __init__(self, name, releaseroot, pkgroot, localData = [], dists = None):
         """
         Initialize the ReleaseAssembler
         @param name: A unique name for this release
         @param releaseroot: Directory containing the release binaries
         @param pkgroot: Chroot directory where packages were built
         @param localData: List of file and directory paths to copy to installRoot/local.
+        @param dists: Optional dictionary of the distribution sets to copy,
+            as accepted by PackageChrootAssembler.extract(). If None, all
+            distribution sets are copied.
         """
         self.name = name
         self.cdroot = os.path.join(releaseroot, RELEASE_CD_PATH)
         self.pkgroot = pkgroot
         self.localData = localData
-
+        self.dists = dists
+
+    def _ignoreDists(self, releasedir, directory, names):
+        """
+        copyRecursive() ignore callback, skipping the distribution set
+        directories, and the subdistribution set files, not in self.dists.
+        Distribution set files are recognized by their first split file,
+        named <dist>.aa.
+        @param releasedir: Release directory being copied
+        @param directory: Directory being copied
+        @param names: Contents of directory
+        @return List of the names to skip
+        """
+        ignored = []
+        dist = directory[len(releasedir):].strip(os.sep)
+        if (dist == ''):
+            # Skip unused distribution set directories
+            for name in names:
+                path = os.path.join(directory, name)
+                if (not self.dists.has_key(name) and os.path.isdir(path) and glob.glob(os.path.join(path, '*.aa'))):
+                    ignored.append(name)
+
+        elif (self.dists.has_key(dist)):
+            # Skip the unused subdistribution sets' files
+            subdists = [subdist.lower() for subdist in self.dists[dist]]
+            lowerNames = [name.lower() for name in names]
+            for name in names:
+                prefix = name.split('.')[0].lower()
+                if (not prefix in subdists and prefix + '.aa' in lowerNames):
+                    ignored.append(name)
+
+        return ignored
+
+    @trace.traced('step', 'assemble release %(name)s')
+    @accounting.labelled(lambda self, destdir, log: {'release' : self.name})
     def build(self, destdir, log):
         """
         Create the install root, copy in the release data,
@@ -791,9 +1292,13 @@ class ReleaseAssembler(object):
         @param log: Open log file.
         """
         try:
-            # Copy the installation data
-            log.write("Copying release files from %s to %s\n" % (os.path.join(self.cdroot, _getCDRelease(self.cdroot)), destdir))
-            utils.copyRecursive(os.path.join(self.cdroot, _getCDRelease(self.cdroot)), destdir, symlinks=True)
+            # Copy the installation data, skipping any unused distribution sets
+            releasedir = os.path.join(self.cdroot, _getCDRelease(self.cdroot))
+            ignore = None
+            if (self.dists != None):
+                ignore = lambda directory, names: self._ignoreDists(releasedir, directory, names)
+            log.write("Copying release files from %s to %s\n" % (releasedir, destdir))
+            utils.copyRecursive(releasedir, destdir, symlinks=True, ignore=ignore)
 
             # If there are packages, copy those too
             packagedir = os.path.join(self.pkgroot, RELEASE_PACKAGE_PATH)
@@ -801,6 +1306,14 @@ class ReleaseAssembler(object):
             if (os.path.exists(packagedir)):
                 utils.copyRecursive(packagedir, os.path.join(destdir, 'packages'), symlinks=True)
 
+                # Index the packages, so that installations' dependencies
+                # can be resolved in advance
+                indexPath = os.path.join(destdir, 'packages', pkgindex.INDEX_NAME)
+                log.write("Writing package index %s\n" % (indexPath))
+                index = pkgindex.PackageIndex()
+                index.scan(os.path.join(destdir, 'packages'))
+                index.write(indexPath)
+
             # Copy in any local data
             if (len(self.localData)):
                 # Create the local directory
@@ -818,6 +1331,9 @@ class ReleaseAssembler(object):
             log.write("Installing package installer script to %s\n" % destdir)
             utils.copyWithOwnership(farb.INSTALL_PACKAGE_SH, destdir)
             os.chmod(os.path.join(destdir, os.path.basename(farb.INSTALL_PACKAGE_SH)), 0755)
+
+            if (progress.getProgress()):
+                progress.addBytes(utils.getTreeSize(destdir))
         except exceptions.IOError, e:
             raise ReleaseAssembleError, "An I/O error occured: %s" % e
         except Exception, e:
@@ -828,17 +1344,27 @@ class NetInstallAssembler(object):
     Assemble the netinstall directory, including the tftproot,
     using the supplied release and install assemblers.
     """
-    def __init__(self, installroot, releaseAssemblers, installAssemblers):
+    def __init__(self, installroot, releaseAssemblers, installAssemblers, jobs=1, compress=False, kernelModules=None):
         """
         Initialize the InstallRootBuilder
         @param installroot: Network install/boot directory.
         @param releaseAssemblers: List of ReleaseAssembler instances.
         @param installAssemblers: List of InstallAssembler instances.
+        @param jobs: Maximum number of assemblers to run concurrently.
+        @param compress: Store the shared boot loader's kernel and modules
+            gzip(1) compressed.
+        @param kernelModules: Optional list of the names of the kernel
+            modules to keep with the shared boot loader's kernel, in
+            addition to those referenced by the boot loader configuration.
+            If None, all kernel modules are kept.
         """
         self.installroot = installroot
         self.tftproot = os.path.join(installroot, 'tftproot')
         self.releaseAssemblers = releaseAssemblers
         self.installAssemblers = installAssemblers
+        self.jobs = jobs
+        self.compress = compress
+        self.kernelModules = kernelModules
 
     def _doConfigureBootLoader(self, destdir):
         """
@@ -885,6 +1411,39 @@ class NetInstallAssembler(object):
         utils.copyWithOwnership(farb.LOADER_CONF, destdir)
         utils.copyWithOwnership(farb.LOADER_RC, destdir)
 
+    def _releaseJob(self, release, log):
+        """
+        @return A job assembling the given release's data
+        """
+        def job():
+            destdir = os.path.join(self.installroot, release.name)
+            log.write("Assembling release data in %s\n" % destdir)
+            release.build(destdir, log)
+        return job
+
+    def _sharedJob(self, install, shareddir, loaderKernel, log):
+        """
+        @return A job assembling the boot data shared by the installations
+            of the given installation's release
+        """
+        def job():
+            log.write("Assembling shared release boot data in %s\n" % shareddir)
+            install.buildShared(shareddir, log)
+            if (os.path.isdir(loaderKernel)):
+                utils.linkIdentical(loaderKernel, os.path.join(shareddir, 'kernel'))
+        return job
+
+    def _installJob(self, install, log):
+        """
+        @return A job assembling the given installation's boot data
+        """
+        def job():
+            destdir = os.path.join(self.tftproot, install.name)
+            log.write("Assembling installation-specific data in %s\n" % destdir)
+            install.build(destdir, log)
+        return job
+
+    @trace.traced('stage', 'assemble install root')
     def build(self, log):
         """
         Create the install root, copy in the release data,
@@ -916,17 +1475,46 @@ class NetInstallAssembler(object):
             log.write("Generating netinstall.4th and copying loader.conf and loader.rc to %s\n" % dest)
             self._doConfigureBootLoader(dest)
 
-            # Assemble the release data
+            # Remove unneeded kernel modules
+            if (self.kernelModules != None and os.path.isdir(os.path.join(dest, 'kernel'))):
+                log.write("Removing unneeded kernel modules from %s\n" % dest)
+                _pruneKernel(os.path.join(dest, 'kernel'), self.kernelModules)
+
+            # Compress its kernel, allowing identical release kernels
+            # compressed in the same way to be hardlinked to it
+            if (self.compress and os.path.isdir(os.path.join(dest, 'kernel'))):
+                log.write("Compressing kernel in %s\n" % dest)
+                _compressKernel(os.path.join(dest, 'kernel'))
+
+            # Assemble the release data, and copy each release's kernel, and
+            # its shared mfsroot if in use, once, to be shared by all of the
+            # release's installations. Where the shared boot loader's kernel
+            # is identical, hardlink it rather than storing another copy.
+            # These are independent of each other, and may run concurrently.
+            jobs = []
             for release in self.releaseAssemblers:
-                destdir = os.path.join(self.installroot, release.name)
-                log.write("Assembling release data in %s\n" % destdir)
-                release.build(destdir, log)
+                jobs.append(self._releaseJob(release, log))
+
+            sharedDirs = {}
+            for install in self.installAssemblers:
+                shareddir = os.path.join(self.tftproot, install.getSharedBootDir())
+                if (sharedDirs.has_key(shareddir)):
+                    continue
+                sharedDirs[shareddir] = True
+                jobs.append(self._sharedJob(install, shareddir, os.path.join(dest, 'kernel'), log))
+
+            _runJobs(jobs, self.jobs)
+
+            # Copy the install.cfg files loaded by shared mfsroots
+            for install in self.installAssemblers:
+                install.buildReleaseData(os.path.join(self.installroot, install.getReleaseName()), log)
 
             # Assemble the installation data
+            jobs = []
             for install in self.installAssemblers:
-                destdir = os.path.join(self.tftproot, install.name)
-                log.write("Assembling installation-specific data in %s\n" % destdir)
-                install.build(destdir, log)
+                jobs.append(self._installJob(install, log))
+
+            _runJobs(jobs, self.jobs)
 
         except exceptions.IOError, e:
             raise NetInstallAssembleError, "An I/O error occured: %s" % e
@@ -935,6 +1523,425 @@ class NetInstallAssembler(object):
         except Exception, e:
             raise NetInstallAssembleError, "An error occured: %s" % e
 
+class InstallRootGenerations(object):
+    """
+    Maintain hardlink snapshots of previously assembled installation roots.
+
+    Each generation is a complete installation root stored in
+    GENERATIONS_DIR. Files left unchanged from the previous generation are
+    hardlinked to it, so a generation only costs as much space as it differs
+    from its predecessor. The top level of the install root is made up of
+    symlinks through the CURRENT_GENERATION symlink, allowing the served
+    generation to be switched with a single rename(2).
+    """
+    def __init__(self, installroot, keep):
+        """
+        Create a new InstallRootGenerations instance
+        @param installroot: Network install/boot directory
+        @param keep: Number of generations to retain
+        """
+        self.installroot = installroot
+        self.keep = keep
+        self.root = os.path.join(installroot, GENERATIONS_DIR)
+        self.current = os.path.join(self.root, CURRENT_GENERATION)
+
+    def getGenerations(self):
+        """
+        @return A sorted list of the available generation numbers
+        """
+        generations = []
+        if (not os.path.exists(self.root)):
+            return generations
+
+        for name in os.listdir(self.root):
+            if (name.isdigit() and os.path.isdir(os.path.join(self.root, name))):
+                generations.append(int(name))
+
+        generations.sort()
+        return generations
+
+    def getCurrent(self):
+        """
+        @return The generation number currently being served, or None
+        """
+        if (not os.path.islink(self.current)):
+            return None
+        return int(os.readlink(self.current))
+
+    def getPath(self, generation):
+        """
+        @return The path to the given generation
+        """
+        return os.path.join(self.root, str(generation))
+
+    def create(self, log):
+        """
+        Create a new, empty generation directory
+        @param log: Open log file
+        @return The new generation number
+        """
+        generations = self.getGenerations()
+        if (len(generations)):
+            generation = generations[-1] + 1
+        else:
+            generation = 1
+
+        path = self.getPath(generation)
+        log.write("Creating install root generation %d in %s\n" % (generation, path))
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            raise InstallRootGenerationsError, "Could not create install root generation %s: %s" % (path, e)
+
+        return generation
+
+    def commit(self, generation, log):
+        """
+        Share unchanged files with the currently served generation, switch
+        the install root to the new generation, and prune old generations.
+        @param generation: Fully assembled generation number
+        @param log: Open log file
+        """
+        previous = self.getCurrent()
+        try:
+            if (previous != None and os.path.isdir(self.getPath(previous))):
+                log.write("Linking unchanged files in generation %d to generation %d\n" % (generation, previous))
+                shared = utils.linkIdentical(self.getPath(previous), self.getPath(generation))
+                log.write("Generation %d shares %d bytes with generation %d\n" % (generation, shared, previous))
+        except OSError, e:
+            raise InstallRootGenerationsError, "Could not link generation %d to generation %d: %s" % (generation, previous, e)
+
+        self.activate(generation, log)
+        self.prune(log)
+
+    def activate(self, generation, log):
+        """
+        Serve the given generation from the install root
+        @param generation: Generation number to serve
+        @param log: Open log file
+        """
+        path = self.getPath(generation)
+        if (not os.path.isdir(path)):
+            raise InstallRootGenerationsError, "Install root generation %d does not exist" % (generation)
+
+        log.write("Activating install root generation %d\n" % generation)
+        try:
+            # Atomically replace the current symlink
+            tmplink = os.path.join(self.root, '.%s.tmp' % CURRENT_GENERATION)
+            if (os.path.islink(tmplink)):
+                os.unlink(tmplink)
+            os.symlink(str(generation), tmplink)
+            os.rename(tmplink, self.current)
+
+            # Point the top level of the install root through the current symlink
+            entries = os.listdir(path)
+            for name in entries:
+                link = os.path.join(self.installroot, name)
+                target = os.path.join(GENERATIONS_DIR, CURRENT_GENERATION, name)
+                if (os.path.islink(link)):
+                    if (os.readlink(link) == target):
+                        continue
+                    os.unlink(link)
+                elif (os.path.isdir(link)):
+                    # Left over from an install root built without generations
+                    shutil.rmtree(link)
+                elif (os.path.exists(link)):
+                    os.unlink(link)
+                os.symlink(target, link)
+
+            # Remove links to anything the new generation doesn't have
+            prefix = os.path.join(GENERATIONS_DIR, CURRENT_GENERATION) + os.sep
+            for name in os.listdir(self.installroot):
+                link = os.path.join(self.installroot, name)
+                if (os.path.islink(link) and os.readlink(link).startswith(prefix) and not name in entries):
+                    os.unlink(link)
+        except OSError, e:
+            raise InstallRootGenerationsError, "Could not activate install root generation %d: %s" % (generation, e)
+
+    def rollback(self, log):
+        """
+        Serve the newest generation older than the current generation
+        @param log: Open log file
+        @return The generation number now being served
+        """
+        current = self.getCurrent()
+        older = []
+        for generation in self.getGenerations():
+            if (current == None or generation < current):
+                older.append(generation)
+
+        if (not len(older)):
+            raise InstallRootGenerationsError, "No install root generation older than the current generation is available"
+
+        self.activate(older[-1], log)
+        return older[-1]
+
+    def discard(self, generation, log):
+        """
+        Remove a generation whose assembly failed, so that it is neither
+        rolled back to nor counted among the generations kept. The
+        currently served generation is never removed.
+        @param generation: Generation number
+        @param log: Open log file
+        """
+        if (generation == self.getCurrent()):
+            return
+        log.write("Removing incomplete install root generation %d\n" % generation)
+        shutil.rmtree(self.getPath(generation), True)
+
+    def prune(self, log):
+        """
+        Remove all but the newest self.keep generations. The currently
+        served generation is never removed.
+        @param log: Open log file
+        """
+        current = self.getCurrent()
+        generations = self.getGenerations()
+        for generation in generations[:max(len(generations) - self.keep, 0)]:
+            if (generation == current):
+                continue
+            log.write("Removing install root generation %d\n" % generation)
+            try:
+                shutil.rmtree(self.getPath(generation))
+            except OSError, e:
+                raise InstallRootGenerationsError, "Could not remove install root generation %d: %s" % (generation, e)
+
+class ReplicationStats(object):
+    """
+    Summary of a single install root replication
+    """
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.removed = 0
+        self.elapsed = 0.0
+
+    def getThroughput(self):
+        """
+        @return The transfer rate of the replication, in bytes per second
+        """
+        if (self.elapsed <= 0):
+            return float(self.bytes)
+        return self.bytes / self.elapsed
+
+    def __str__(self):
+        return "copied %d files (%.1f MB), removed %d, in %.1f seconds (%.1f MB/s)" % (
+            self.files, self.bytes / 1048576.0, self.removed, self.elapsed, self.getThroughput() / 1048576.0)
+
+class InstallRootReplicator(object):
+    """
+    Mirror the served installation root to a replica directory, such as
+    an NFS mirror's export, mounted locally.
+
+    The replica records the state of its files in a manifest, which is
+    compared against the installation root to find the files that must
+    be transferred. Files are considered unchanged if their size,
+    modification time and mode match.
+    """
+    def __init__(self, installroot, replicaroot, jobs=1):
+        """
+        Create a new InstallRootReplicator instance
+        @param installroot: Network install/boot directory
+        @param replicaroot: Directory to mirror the installation root to
+        @param jobs: Maximum number of files to copy concurrently
+        """
+        self.installroot = installroot
+        self.replicaroot = replicaroot
+        self.jobs = jobs
+
+    def getManifest(self):
+        """
+        Scan the installation root. Only the served install root
+        generation, if any, is included.
+        @return A tuple of the manifest, mapping replica-relative paths to
+            (type, size, mtime, mode, link target) entries, and a dictionary
+            mapping replica-relative paths to the source paths
+        """
+        manifest = {}
+        sources = {}
+        for name in os.listdir(self.installroot):
+            if (name == GENERATIONS_DIR):
+                continue
+            # Follow the top level generation symlinks
+            source = os.path.realpath(os.path.join(self.installroot, name))
+            _scanTree(source, name, manifest, sources)
+        return (manifest, sources)
+
+    def readManifest(self):
+        """
+        Read the replica's manifest. If the replica has no manifest, its
+        contents are scanned instead.
+        @return The replica manifest
+        """
+        manifestPath = os.path.join(self.replicaroot, REPLICA_MANIFEST)
+        manifest = {}
+        if (not os.path.exists(manifestPath)):
+            for name in os.listdir(self.replicaroot):
+                if (name == REPLICA_MANIFEST):
+                    continue
+                _scanTree(os.path.join(self.replicaroot, name), name, manifest)
+            return manifest
+
+        f = open(manifestPath, 'r')
+        try:
+            for line in f:
+                line = line.rstrip('\n')
+                if (not line):
+                    continue
+                type, size, mtime, mode, target, path = line.split('|', 5)
+                manifest[path] = (type, int(size), int(mtime), int(mode), target)
+        finally:
+            f.close()
+        return manifest
+
+    def _writeManifest(self, manifest):
+        """
+        Atomically replace the replica's manifest
+        @param manifest: Replica manifest
+        """
+        manifestPath = os.path.join(self.replicaroot, REPLICA_MANIFEST)
+        tempPath = manifestPath + REPLICA_TEMP_SUFFIX
+        paths = manifest.keys()
+        paths.sort()
+        f = open(tempPath, 'w')
+        try:
+            for path in paths:
+                type, size, mtime, mode, target = manifest[path]
+                f.write('%s|%d|%d|%d|%s|%s\n' % (type, size, mtime, mode, target, path))
+        finally:
+            f.close()
+        os.rename(tempPath, manifestPath)
+
+    def _copyFile(self, source, path, stats, lock):
+        """
+        Copy a file into the replica, replacing any existing file atomically
+        @param source: Source file path
+        @param path: Replica file path
+        @param stats: ReplicationStats to update
+        @param lock: Lock guarding stats
+        """
+        tempPath = path + REPLICA_TEMP_SUFFIX
+        utils.copyWithOwnership(source, tempPath)
+        os.rename(tempPath, path)
+        size = os.path.getsize(path)
+        progress.addBytes(size)
+        lock.acquire()
+        try:
+            stats.files += 1
+            stats.bytes += size
+        finally:
+            lock.release()
+
+    @trace.traced('step', 'replicate %(replicaroot)s', lambda stats: {'files' : stats.files, 'bytes' : stats.bytes, 'removed' : stats.removed})
+    def replicate(self, log):
+        """
+        Bring the replica up to date with the installation root, copying
+        only the files that changed since the last replication.
+        @param log: Open log file
+        @return A ReplicationStats instance
+        """
+        log.write("Replicating install root %s to %s\n" % (self.installroot, self.replicaroot))
+        stats = ReplicationStats()
+        started = time.time()
+        try:
+            manifest, sources = self.getManifest()
+            replica = self.readManifest()
+
+            # The replica's contents are unknown until the replication
+            # completes
+            manifestPath = os.path.join(self.replicaroot, REPLICA_MANIFEST)
+            if (os.path.exists(manifestPath)):
+                os.unlink(manifestPath)
+
+            # Remove entries that no longer exist, or have changed type,
+            # deepest first
+            stale = []
+            for path, entry in replica.iteritems():
+                if (not manifest.has_key(path) or manifest[path][0] != entry[0]):
+                    stale.append(path)
+            stale.sort()
+            stale.reverse()
+            for path in stale:
+                dest = os.path.join(self.replicaroot, path)
+                if (not os.path.lexists(dest)):
+                    continue
+                if (os.path.isdir(dest) and not os.path.islink(dest)):
+                    shutil.rmtree(dest)
+                else:
+                    os.unlink(dest)
+                stats.removed += 1
+
+            # Create directories and links, parents first, and collect
+            # the files to copy
+            paths = manifest.keys()
+            paths.sort()
+            directories = []
+            jobs = []
+            lock = threading.Lock()
+            for path in paths:
+                entry = manifest[path]
+                if (replica.get(path) == entry and os.path.lexists(os.path.join(self.replicaroot, path))):
+                    continue
+                dest = os.path.join(self.replicaroot, path)
+                type = entry[0]
+                if (type == 'd'):
+                    if (not os.path.isdir(dest)):
+                        os.mkdir(dest)
+                    directories.append(path)
+                elif (type == 'l'):
+                    if (os.path.lexists(dest)):
+                        os.unlink(dest)
+                    os.symlink(entry[4], dest)
+                else:
+                    jobs.append(lambda source=sources[path], dest=dest: self._copyFile(source, dest, stats, lock))
+
+            _runJobs(jobs, self.jobs)
+
+            # Set directory permissions once their contents are in place
+            directories.reverse()
+            for path in directories:
+                dest = os.path.join(self.replicaroot, path)
+                shutil.copystat(sources[path], dest)
+                st = os.stat(sources[path])
+                os.chown(dest, st.st_uid, st.st_gid)
+
+            self._writeManifest(manifest)
+        except (IOError, OSError, shutil.Error), e:
+            raise InstallRootReplicatorError, "Could not replicate %s to %s: %s" % (self.installroot, self.replicaroot, e)
+
+        stats.elapsed = time.time() - started
+        log.write("Replicated install root to %s: %s\n" % (self.replicaroot, stats))
+        return stats
+
+def _scanTree(path, relpath, manifest, sources=None):
+    """
+    Add a directory tree to a replication manifest. Symbolic links are
+    recorded, not followed.
+    @param path: Path to scan
+    @param relpath: Manifest path of the tree
+    @param manifest: Manifest dictionary to update
+    @param sources: Optional dictionary mapping manifest paths to scanned paths
+    """
+    st = os.lstat(path)
+    mode = stat.S_IMODE(st.st_mode)
+    if (stat.S_ISLNK(st.st_mode)):
+        manifest[relpath] = ('l', 0, 0, 0, os.readlink(path))
+    elif (stat.S_ISDIR(st.st_mode)):
+        manifest[relpath] = ('d', 0, 0, mode, '')
+    elif (stat.S_ISREG(st.st_mode)):
+        if (path.endswith(REPLICA_TEMP_SUFFIX)):
+            return
+        manifest[relpath] = ('f', st.st_size, int(st.st_mtime), mode, '')
+    else:
+        return
+
+    if (sources is not None):
+        sources[relpath] = path
+
+    if (stat.S_ISDIR(st.st_mode)):
+        for name in os.listdir(path):
+            _scanTree(os.path.join(path, name), os.path.join(relpath, name), manifest, sources)
+
 def _getCDRelease(cdroot):
     # Get the release name from the cdrom.inf file in cdroot
     infFile = os.path.join(cdroot, 'cdrom.inf')
@@ -953,35 +1960,813 @@ def _getCDRelease(cdroot):
 
     return splitString[1]
 
-def _runCommand(argv, log, exception, env=ROOT_ENV, returnOut=False):
+def _bootModules():
+    """
+    @return A list of the names of the kernel modules referenced by the
+        boot loader configuration
+    """
+    modules = []
+    for path in (farb.BOOT_CONF_TMPL, farb.LOADER_CONF):
+        input = open(path, 'r')
+        try:
+            for line in input:
+                # Modules named by path, ie. acpi_name="/kernel/acpi.ko"
+                modules.extend(re.findall(r'([\w.-]+)\.ko\b', line))
+                # Modules loaded by name, ie. if_em_load="YES"
+                match = re.match(r'\s*([\w-]+)_load\s*=\s*"?yes"?\s*$', line, re.IGNORECASE)
+                if (match):
+                    modules.append(match.group(1))
+        finally:
+            input.close()
+    return modules
+
+def _kernelKeepFiles(modules):
+    """
+    @param modules: Names of the kernel modules to keep
+    @return A dictionary of the names of the files to keep in a kernel
+        directory
+    """
+    keep = {'kernel' : True}
+    for name in KERNEL_KEEP_FILES:
+        keep[name] = True
+    for module in list(modules) + _bootModules():
+        keep[module + '.ko'] = True
+    return keep
+
+def _pruneKernel(kerneldir, modules):
+    """
+    Remove everything from a kernel directory but the kernel and the given
+    kernel modules, along with those referenced by the boot loader
+    configuration.
+    @param kerneldir: Kernel directory
+    @param modules: Names of the kernel modules to keep
+    """
+    keep = _kernelKeepFiles(modules)
+    for name in os.listdir(kerneldir):
+        if (keep.has_key(name)):
+            continue
+        path = os.path.join(kerneldir, name)
+        if (os.path.isdir(path) and not os.path.islink(path)):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+def _compressKernel(kerneldir):
+    """
+    Compress the kernel and kernel modules in a kernel directory. Other
+    files, such as linker.hints, are left uncompressed.
+    @param kerneldir: Kernel directory
+    """
+    for name in os.listdir(kerneldir):
+        path = os.path.join(kerneldir, name)
+        if (os.path.islink(path) or not os.path.isfile(path)):
+            continue
+        if (name == 'kernel' or name.endswith('.ko')):
+            utils.compressFile(path)
+
+def _runJobs(jobs, maxJobs):
+    """
+    Run a list of jobs, using up to maxJobs threads. If a job raises an
+    exception, no further jobs are started, and the exception is re-raised
+    once the running jobs have finished.
+    @param jobs: List of callables
+    @param maxJobs: Maximum number of jobs to run concurrently
+    """
+    if (maxJobs <= 1):
+        for job in jobs:
+            job()
+        return
+
+    queue = Queue.Queue()
+    for job in jobs:
+        queue.put(job)
+    errors = []
+    parent = trace.getCurrent()
+    labels = accounting.getLabels()
+    phase = profiling.getCurrent()
+
+    def worker():
+        trace.adopt(parent)
+        accounting.adopt(labels)
+        profile = profiling.adopt(phase)
+        try:
+            while (not errors):
+                try:
+                    job = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    job()
+                except:
+                    errors.append(sys.exc_info())
+                    # Don't wait for the other jobs' commands to complete
+                    if (_commandSupervisor is not None):
+                        _commandSupervisor.cancelAll()
+        finally:
+            profiling.release(phase, profile)
+
+    threads = []
+    for i in range(min(maxJobs, len(jobs))):
+        thread = threading.Thread(target=worker, name='job%d' % (i + 1))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if (errors):
+        type, value, traceback = errors[0]
+        raise type, value, traceback
+
+class CommandResult(object):
+    """
+    Result of a command run by _runCommand
+    """
+    def __init__(self, argv, exitCode, duration, output=None, usage=None):
+        """
+        @param argv: The command's argv
+        @param exitCode: The command's exit code
+        @param duration: Wall clock time taken by the command, in seconds
+        @param output: What the command printed to stdout, if captured
+        @param usage: accounting.ResourceUsage of the command, if available
+        """
+        self.argv = argv
+        self.exitCode = exitCode
+        self.duration = duration
+        self.output = output
+        self.usage = usage
+
+class _CommandOutput(object):
+    """
+    Split a command's output stream into lines, queueing each to be
+    written to the job's log, and optionally capturing it.
+    """
+    def __init__(self, job, capture=False, tee=True):
+        """
+        @param job: CommandJob producing the output
+        @param capture: If true, retain the output
+        @param tee: If true, write the output to the log
+        """
+        self.job = job
+        self.tee = tee
+        self.pending = ''
+        self.captured = None
+        if (capture):
+            self.captured = []
+
+    def feed(self, data):
+        """
+        Process a chunk of output
+        """
+        if (self.captured is not None):
+            self.captured.append(data)
+        if (not self.tee):
+            return
+        lines = (self.pending + data).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.job.queueLog(line)
+
+    def close(self):
+        """
+        Queue any unterminated final line
+        @return The captured output, or None
+        """
+        if (self.pending):
+            self.job.queueLog(self.pending)
+            self.pending = ''
+        if (self.captured is None):
+            return None
+        return ''.join(self.captured)
+
+class CommandJob(object):
+    """
+    A command run by a CommandSupervisor
+    """
+    def __init__(self, argv, log, exception, env, returnOut, tee, input, name):
+        """
+        Create a new CommandJob instance. See CommandSupervisor.submit()
+        """
+        self.argv = argv
+        self.log = log
+        self.exception = exception
+        self.env = env
+        self.returnOut = returnOut
+        self.tee = tee
+        self.input = input
+        self.name = name
+        self.supervisor = None
+        self.process = None
+        self.started = None
+        self.result = None
+        self.failure = None
+        self.cancelled = False
+
+        # Output streams, input state and the number of open pipes
+        self.stdout = None
+        self.stderr = None
+        self.chunks = None
+        self.pending = ''
+        self.pipes = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+        # Resources used by the command, recorded against the labels in
+        # effect in the submitting thread
+        self.usage = None
+        self.labels = accounting.getLabels()
+
+        # Trace span, within the span open in the submitting thread
+        self.thread = threading.currentThread().getName()
+        self.traceParent = trace.getCurrent()
+        self.tracer = None
+        self.traceSpan = None
+
+        # Log lines not yet written
+        self.logBuffer = []
+        self.logBuffered = 0
+        self._done = threading.Event()
+
+    def queueLog(self, line):
+        """
+        Queue a line to be written to the log, with a timestamp and the
+        job's name
+        @param line: Line to write, without its newline
+        """
+        if (self.name):
+            line = '[%s] %s' % (self.name, line)
+        entry = '[%s] %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), line)
+        self.logBuffer.append(entry)
+        self.logBuffered += len(entry)
+
+    def flushLog(self, limit=None):
+        """
+        Write queued lines to the log
+        @param limit: Optional number of bytes after which to stop writing
+        """
+        written = 0
+        while (self.logBuffer and (limit is None or written < limit)):
+            entry = self.logBuffer.pop(0)
+            self.log.write(entry)
+            written += len(entry)
+        self.logBuffered -= written
+
+    def isDone(self):
+        """
+        @return True if the command has completed or been cancelled
+        """
+        return self._done.isSet()
+
+    def cancel(self):
+        """
+        Cancel the command, terminating it if it has started
+        """
+        self.supervisor.cancel(self)
+
+    def wait(self):
+        """
+        Wait for the command to complete. Raise the job's exception if the
+        command failed or was cancelled.
+        @return A CommandResult
+        """
+        self._done.wait()
+        if (self.failure):
+            type, value, traceback = self.failure
+            raise type, value, traceback
+        return self.result
+
+class CommandSupervisor(object):
+    """
+    Run many commands concurrently from a single select(2) loop.
+
+    Each command's output is written to its log a line at a time, as it
+    arrives, prefixed with a timestamp and the job's name, so that several
+    commands can share a log. A job whose queued log output exceeds the
+    log buffer size is not read from until its backlog has been written,
+    so a command producing output faster than it can be logged blocks on
+    its own full pipe.
+
+    Jobs may be submitted and cancelled from any thread. The loop is run
+    by run(), until all submitted jobs have completed, or in a background
+    thread between start() and stop().
+    """
+    def __init__(self, maxJobs=0, logBufferSize=COMMAND_LOG_BUFFER):
+        """
+        Create a new CommandSupervisor instance
+        @param maxJobs: Maximum number of commands to run at once, or 0 for
+            no limit
+        @param logBufferSize: Number of bytes of a job's output to queue for
+            its log before the job is no longer read from
+        """
+        self.maxJobs = maxJobs
+        self.logBufferSize = logBufferSize
+        self._lock = threading.Lock()
+        self._queued = []
+        self._running = []
+        self._cancels = []
+        self._cancelAll = False
+        self._readers = {}
+        self._writers = {}
+        self._thread = None
+        self._stopping = False
+        # Exception that stopped the background loop, if any
+        self._failure = None
+
+        # Wakes the loop when jobs are submitted or cancelled
+        self._wakeRead, self._wakeWrite = os.pipe()
+        for fd in (self._wakeRead, self._wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def submit(self, argv, log, exception, env=ROOT_ENV, returnOut=False, tee=False, input=None, name=None):
+        """
+        Queue a command to be run. Arguments are as accepted by _runCommand.
+        @param name: Optional name prefixed to each line the job logs
+        @return A CommandJob
+        """
+        job = CommandJob(argv, log, exception, env, returnOut, tee, input, name)
+        job.supervisor = self
+        self._lock.acquire()
+        try:
+            failure = self._failure
+            if (failure is None):
+                self._queued.append(job)
+        finally:
+            self._lock.release()
+        if (failure is not None):
+            # The loop has stopped, and will never run the job
+            job.failure = failure
+            job._done.set()
+            return job
+        self._wake()
+        return job
+
+    def cancel(self, job):
+        """
+        Cancel a job, terminating its command if it has started
+        @param job: CommandJob to cancel
+        """
+        self._lock.acquire()
+        try:
+            self._cancels.append(job)
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def cancelAll(self):
+        """
+        Cancel all queued and running jobs
+        """
+        self._lock.acquire()
+        try:
+            self._cancelAll = True
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def getJobCount(self):
+        """
+        @return The number of queued and running jobs
+        """
+        self._lock.acquire()
+        try:
+            return len(self._queued) + len(self._running)
+        finally:
+            self._lock.release()
+
+    def _wake(self):
+        try:
+            os.write(self._wakeWrite, 'x')
+        except OSError, e:
+            # The loop has already been woken
+            if (e.errno != errno.EAGAIN):
+                raise
+
+    def _start(self, job):
+        """
+        Start a job's command, and register its pipes
+        """
+        job.started = time.time()
+        job.tracer = trace.getTracer()
+        if (job.tracer is not None):
+            job.traceSpan = job.tracer.begin(os.path.basename(job.argv[0]), 'command', {'argv' : job.argv}, parent=job.traceParent, thread=job.thread)
+        stdin = None
+        if (job.input is not None):
+            stdin = subprocess.PIPE
+        try:
+            job.process = subprocess.Popen(job.argv, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=job.env)
+        except:
+            job.failure = sys.exc_info()
+            self._finish(job)
+            return
+
+        job.stdout = _CommandOutput(job, capture=job.returnOut, tee=(job.tee or not job.returnOut))
+        job.stderr = _CommandOutput(job)
+        self._readers[job.process.stdout.fileno()] = (job, job.stdout)
+        self._readers[job.process.stderr.fileno()] = (job, job.stderr)
+        job.pipes = 2
+        if (job.input is not None):
+            fd = job.process.stdin.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            job.chunks = iter(job.input)
+            self._writers[fd] = job
+            job.pipes += 1
+
+    def _closeInput(self, job):
+        """
+        Close a job's stdin
+        """
+        del self._writers[job.process.stdin.fileno()]
+        job.process.stdin.close()
+        job.pipes -= 1
+
+    def _feedInput(self, job):
+        """
+        Write the next chunk of a job's input to its stdin
+        """
+        if (not job.pending):
+            try:
+                job.pending = job.chunks.next()
+            except StopIteration:
+                self._closeInput(job)
+                return
+        try:
+            written = os.write(job.process.stdin.fileno(), job.pending)
+            job.pending = job.pending[written:]
+            job.bytesWritten += written
+        except OSError, e:
+            if (e.errno == errno.EAGAIN):
+                return
+            if (e.errno != errno.EPIPE):
+                raise
+            # The command exited without reading all of its input
+            self._closeInput(job)
+
+    def _terminate(self, job):
+        """
+        Terminate a job's command, if it is still running
+        """
+        if (job.process is None or job.process.returncode is not None):
+            return
+        try:
+            os.kill(job.process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _reap(self, job):
+        """
+        Collect the exit status and resource usage of a job's command, if
+        it has exited
+        @return True if the command has exited
+        """
+        if (not hasattr(os, 'wait4')):
+            return job.process.poll() is not None
+        try:
+            pid, status, rusage = os.wait4(job.process.pid, os.WNOHANG)
+        except OSError, e:
+            if (e.errno != errno.ECHILD):
+                raise
+            # Collected elsewhere
+            return job.process.poll() is not None
+        if (pid == 0):
+            return False
+
+        if (os.WIFSIGNALED(status)):
+            job.process.returncode = -os.WTERMSIG(status)
+        else:
+            job.process.returncode = os.WEXITSTATUS(status)
+        job.usage = accounting.ResourceUsage.fromRusage(rusage, time.time() - job.started)
+        return True
+
+    def _abandon(self, job, failure):
+        """
+        Fail a job whose command could not be supervised, terminating the
+        command and releasing its pipes
+        @param job: CommandJob
+        @param failure: sys.exc_info() tuple of the exception raised
+            supervising the job
+        """
+        if (job.failure is None):
+            job.failure = failure
+        if (job.process is not None):
+            self._terminate(job)
+            for fd, (reader, output) in self._readers.items():
+                if (reader is job):
+                    del self._readers[fd]
+            for fd, writer in self._writers.items():
+                if (writer is job):
+                    del self._writers[fd]
+            job.pipes = 0
+            for pipe in (job.process.stdin, job.process.stdout, job.process.stderr):
+                if (pipe is not None and not pipe.closed):
+                    try:
+                        pipe.close()
+                    except (IOError, OSError):
+                        pass
+            try:
+                self._reap(job)
+            except OSError:
+                pass
+        self._lock.acquire()
+        try:
+            if (job in self._running):
+                self._running.remove(job)
+            if (job in self._queued):
+                self._queued.remove(job)
+        finally:
+            self._lock.release()
+        job._done.set()
+
+    def _abandonAll(self, failure):
+        """
+        Fail all queued and running jobs, and any submitted later, once the
+        loop itself has failed
+        @param failure: sys.exc_info() tuple of the exception raised by
+            the loop
+        """
+        self._lock.acquire()
+        try:
+            self._failure = failure
+            jobs = self._queued + self._running
+        finally:
+            self._lock.release()
+        for job in jobs:
+            self._abandon(job, failure)
+
+    def _finish(self, job):
+        """
+        Record the result of a job whose command has exited, and write the
+        rest of its log
+        """
+        duration = time.time() - job.started
+        output = None
+        if (job.process is not None):
+            for pipe in (job.process.stdin, job.process.stdout, job.process.stderr):
+                if (pipe is not None and not pipe.closed):
+                    pipe.close()
+            output = job.stdout.close()
+            job.stderr.close()
+            retval = job.process.returncode
+
+            if (job.cancelled):
+                job.queueLog('Command %s was cancelled after %.2f seconds' % (job.argv[0], duration))
+            else:
+                job.queueLog('Command %s exited with code %d after %.2f seconds' % (job.argv[0], retval, duration))
+
+            if (job.failure is None):
+                if (job.cancelled):
+                    job.failure = (job.exception, job.exception("Command %s was cancelled after %.2f seconds" % (job.argv[0], duration)), None)
+                elif (retval != 0):
+                    job.failure = (job.exception, job.exception("Command %s returned with exit code %d after %.2f seconds" % (job.argv[0], retval, duration)), None)
+                else:
+                    job.result = CommandResult(job.argv, retval, duration, output, job.usage)
+        elif (job.failure is None):
+            job.failure = (job.exception, job.exception("Command %s was cancelled" % (job.argv[0])), None)
+
+        if (job.usage is not None):
+            accounting.record(job.usage, job.labels)
+
+        if (job.traceSpan is not None):
+            results = {'duration' : duration, 'bytesRead' : job.bytesRead, 'bytesWritten' : job.bytesWritten, 'cancelled' : job.cancelled}
+            if (job.process is not None):
+                results['exitCode'] = job.process.returncode
+            if (job.usage is not None):
+                results['usage'] = job.usage.asDict()
+            job.tracer.end(job.traceSpan, results)
+
+        job.flushLog()
+        self._lock.acquire()
+        try:
+            if (job in self._running):
+                self._running.remove(job)
+        finally:
+            self._lock.release()
+        job._done.set()
+
+    def poll(self, timeout=None):
+        """
+        Run a single iteration of the supervisor loop: start queued jobs,
+        process cancellations, exchange data with the running commands,
+        and collect those that have exited.
+        @param timeout: Maximum time to wait for command I/O, in seconds,
+            or None to wait indefinitely
+        """
+        # Process cancellations and start queued jobs, as slots allow
+        cancelled = []
+        starting = []
+        self._lock.acquire()
+        try:
+            cancels = self._cancels
+            self._cancels = []
+            if (self._cancelAll):
+                cancels = cancels + self._queued + self._running
+                self._cancelAll = False
+            for job in cancels:
+                if (job in self._queued):
+                    self._queued.remove(job)
+                    job.cancelled = True
+                    cancelled.append(job)
+                elif (job in self._running):
+                    job.cancelled = True
+                    self._terminate(job)
+            while (self._queued and (self.maxJobs <= 0 or len(self._running) < self.maxJobs)):
+                job = self._queued.pop(0)
+                self._running.append(job)
+                starting.append(job)
+        finally:
+            self._lock.release()
+
+        # A job whose I/O or completion raises an exception is failed on
+        # its own, rather than stopping the loop and its other jobs
+        for job in cancelled:
+            job.started = time.time()
+            try:
+                self._finish(job)
+            except:
+                self._abandon(job, sys.exc_info())
+        for job in starting:
+            try:
+                self._start(job)
+            except:
+                self._abandon(job, sys.exc_info())
+
+        # Jobs with a log backlog are not read from
+        readers = [self._wakeRead]
+        for fd, (job, output) in self._readers.iteritems():
+            if (job.logBuffered < self.logBufferSize):
+                readers.append(fd)
+        writers = self._writers.keys()
+
+        # Commands whose pipes have all closed are polled until they exit,
+        # and log backlogs are written without waiting
+        running = self._running[:]
+        for job in running:
+            if (job.logBuffered):
+                timeout = 0
+            elif (job.process is not None and job.pipes == 0):
+                if (timeout is None or timeout > COMMAND_POLL_INTERVAL):
+                    timeout = COMMAND_POLL_INTERVAL
+
+        try:
+            readable, writable, exceptional = select.select(readers, writers, [], timeout)
+        except select.error, e:
+            if (e[0] != errno.EINTR):
+                raise
+            readable, writable = [], []
+
+        for fd in readable:
+            if (fd == self._wakeRead):
+                try:
+                    os.read(self._wakeRead, COMMAND_BUFSIZE)
+                except OSError, e:
+                    if (e.errno != errno.EAGAIN):
+                        raise
+                continue
+            if (not self._readers.has_key(fd)):
+                # Its job has been abandoned
+                continue
+            job, output = self._readers[fd]
+            try:
+                data = os.read(fd, COMMAND_BUFSIZE)
+                if (data):
+                    job.bytesRead += len(data)
+                    output.feed(data)
+                else:
+                    del self._readers[fd]
+                    job.pipes -= 1
+            except:
+                self._abandon(job, sys.exc_info())
+
+        for fd in writable:
+            if (not self._writers.has_key(fd)):
+                continue
+            job = self._writers[fd]
+            try:
+                self._feedInput(job)
+            except:
+                # The input could not be read; abandon the command
+                job.failure = sys.exc_info()
+                self._closeInput(job)
+                self._terminate(job)
+
+        for job in running:
+            if (job.isDone()):
+                continue
+            try:
+                if (job.process is not None and job.pipes == 0 and self._reap(job)):
+                    self._finish(job)
+                else:
+                    job.flushLog(self.logBufferSize)
+            except:
+                self._abandon(job, sys.exc_info())
+
+    def run(self):
+        """
+        Run the supervisor loop until all submitted jobs have completed
+        """
+        try:
+            while (self.getJobCount()):
+                self.poll()
+        except:
+            self._abandonAll(sys.exc_info())
+            raise
+
+    def _serve(self):
+        try:
+            while (not self._stopping or self.getJobCount()):
+                self.poll()
+        except:
+            # Don't leave the jobs' callers waiting on a loop that has gone
+            self._abandonAll(sys.exc_info())
+
+    def start(self):
+        """
+        Run the supervisor loop in a background thread, until stop() is
+        called
+        """
+        self._stopping = False
+        self._thread = threading.Thread(target=self._serve, name='CommandSupervisor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Wait for all submitted jobs to complete, and stop the background
+        thread
+        """
+        self._stopping = True
+        self._wake()
+        self._thread.join()
+        self._thread = None
+
+    def close(self):
+        """
+        Release the supervisor's resources
+        """
+        os.close(self._wakeRead)
+        os.close(self._wakeWrite)
+
+def setCommandSupervisor(supervisor):
+    """
+    Run the commands started by _runCommand on a running CommandSupervisor,
+    named after the thread that started them, so that the commands of
+    concurrent jobs are multiplexed into their logs and can be cancelled
+    together.
+    @param supervisor: CommandSupervisor, or None to run each command on
+        its own
+    """
+    global _commandSupervisor
+    _commandSupervisor = supervisor
+
+def _readFiles(paths, size=COMMAND_BUFSIZE):
+    """
+    Generate the contents of a list of files, in chunks
+    @param paths: List of file paths
+    @param size: Maximum chunk size
+    """
+    for path in paths:
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(size)
+                if (not data):
+                    break
+                yield data
+        finally:
+            f.close()
+
+def _runCommand(argv, log, exception, env=ROOT_ENV, returnOut=False, tee=False, input=None):
     """
     Run a command, logging its output to an open file. Raise an exception if it 
     has an exit code of anything other than 0.
+
+    The command's stdout and stderr are drained concurrently, so a command
+    can never block on a full pipe, and each line is written to the log as
+    it arrives, prefixed with a timestamp. The command's exit code and
+    duration are logged once it exits.
     @param argv: List containing path of command, followed by its arguments
     @param log: Open log file where stderr and possibly stdout will be written.
     @param exception: Type of exception to throw if command returns a value 
         other than zero
     @param env: Dictionary of the environment to run the command under. Defaults 
         to ROOT_ENV
-    @param returnOut: If true, instead of writing stderr to the file log, the 
-        contents of the commands output will be returned by this function. 
+    @param returnOut: If true, the command's stdout is captured rather than
+        written to the log. Defaults to false.
+    @param tee: If true, captured stdout is also written to the log.
         Defaults to false.
-    @return A string containing what the command prints to stdout if returnOut 
-        is true. None otherwise.
+    @param input: Optional iterable of strings to write to the command's
+        stdin, which is closed once they have been written. If None, the
+        command inherits stdin.
+    @return A CommandResult. Its output is what the command printed to stdout
+        if returnOut is true, None otherwise.
     """
-    if returnOut:
-        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=log, env=env)
-    else:
-        process = subprocess.Popen(argv, stdout=log, stderr=log, env=env)
-    
-    retval = process.wait()
-    
-    # Read all of what the command wrote to stdout if we set returnOut
-    outputString = None
-    if returnOut:
-        outputString = process.stdout.read()
-        
-    if retval != 0:
-        raise exception, "Command %s returned with exit code %d" % (argv[0], retval)
-    
-    return outputString
+    supervisor = _commandSupervisor
+    if (supervisor is not None):
+        job = supervisor.submit(argv, log, exception, env, returnOut, tee, input, threading.currentThread().getName())
+        return job.wait()
+
+    supervisor = CommandSupervisor()
+    try:
+        job = supervisor.submit(argv, log, exception, env, returnOut, tee, input)
+        supervisor.run()
+    finally:
+        supervisor.close()
+    return job.wait()
@@ -31,6 +31,8 @@ import os, ZConfig
 
 import builder
 
+# NFS host assignment strategies
+NFS_ASSIGNMENTS = ('roundrobin', 'pin', 'hash')
 
 def releases_handler(section):
     """
@@ -43,6 +45,40 @@ def releases_handler(section):
     # Global tftproot
     section.tftproot = os.path.join(section.installroot, 'tftproot')
 
+    if (section.installrootgenerations < 0):
+        raise ZConfig.ConfigurationError("InstallRootGenerations may not be negative.")
+
+    if (section.assemblerjobs < 1):
+        raise ZConfig.ConfigurationError("AssemblerJobs must be at least 1.")
+
+    if (section.pipelinejobs < 1):
+        raise ZConfig.ConfigurationError("PipelineJobs must be at least 1.")
+
+    if (section.replicationjobs < 1):
+        raise ZConfig.ConfigurationError("ReplicationJobs must be at least 1.")
+
+    if (section.historywindow < 1):
+        raise ZConfig.ConfigurationError("HistoryWindow must be at least 1.")
+
+    if (section.regressionthreshold < 0):
+        raise ZConfig.ConfigurationError("RegressionThreshold may not be negative.")
+
+    if (section.logrotatesize != None and section.logrotatesize < 1):
+        raise ZConfig.ConfigurationError("LogRotateSize must be at least 1 byte.")
+
+    # The run history is kept in the buildroot by default
+    if (section.historydatabase == None):
+        section.historydatabase = os.path.join(section.buildroot, 'history.sqlite')
+
+    section.nfsassignment = section.nfsassignment.lower()
+    if (not section.nfsassignment in NFS_ASSIGNMENTS):
+        raise ZConfig.ConfigurationError("NFSAssignment must be one of: %s." % (', '.join(NFS_ASSIGNMENTS)))
+
+    # Installations are assigned to the NFSHost and the NFS mirrors
+    section.nfshosts = [section.nfshost]
+    for mirror in section.NFSMirror:
+        section.nfshosts.append(mirror.host)
+
     # Validate release sections and instantiate
     # ReleaseBuilders.
     for release in section.Release:
@@ -69,6 +105,9 @@ def releases_handler(section):
         release.portsdir = os.path.join(release.pkgroot, 'usr', 'ports')
         # And the package dir ...
         release.packagedir = os.path.join(release.portsdir, 'packages')
+        # And the scratch chroot and output directory for package images
+        release.imageroot = os.path.join(release.buildroot, 'imageroot')
+        release.imagedir = os.path.join(release.buildroot, 'images')
         
         # Don't let a ports distribution set be defined
         if release.dists.count('ports') > 0:
@@ -142,6 +181,17 @@ def verifyReferences(config):
             if (not foundPackageSet):
                 raise ZConfig.ConfigurationError, "Can't find package set \"%s\" for \"%s\" installation." % (pkgsetName, inst.getSectionName())
 
+        # Verify that Installation's pinned NFSMirror exists
+        if (inst.nfsmirror):
+            foundMirror = False
+            for mirror in config.Releases.NFSMirror:
+                if (inst.nfsmirror.lower() == mirror.getSectionName()):
+                    foundMirror = True
+                    break
+
+            if (not foundMirror):
+                raise ZConfig.ConfigurationError, "Can't find NFS mirror \"%s\" for \"%s\" installation." % (inst.nfsmirror, inst.getSectionName())
+
 
 def verifyPackages(config):
     """
@@ -38,13 +38,14 @@ export PKG_PATH="/dist/packages/Latest:/dist/packages/All"
 
 # Print Usage
 usage() {
-    echo "$0 <package>"
+    echo "$0 <package> [<package> ...]"
+    echo "$0 -l <package list>"
 }
 
 # Install the package
 installPackage() {
     pkg="$1"
-    # Exit cleanly if the package is already installed
+    # Return cleanly if the package is already installed
 
     # Glob to check
     glob='*pkg_add: package * or its older version already installed*'
@@ -57,11 +58,11 @@ installPackage() {
         case "$msg" in
             $glob)
                 echo "$pkg is already installed (perhaps by a dependency) ..."
-                exit 0
+                return 0
                 ;;
             *)
                 echo "$msg"
-                exit 1
+                return 1
                 ;;
         esac
     fi
@@ -69,15 +70,57 @@ installPackage() {
     echo "$msg"
 }
 
+# Install a package from a package list. Listed packages are given by
+# path, in dependency order, so pkg_add needn't search PKG_PATH for the
+# package or its dependencies, and no package can have been installed as
+# a dependency of an earlier one.
+installListedPackage() {
+    pkg="$1"
+    case "$pkg" in
+        /*)
+            echo "Installing $pkg ..."
+            pkg_add "$pkg"
+            ;;
+        *)
+            # Listed by name, as the release has no package index
+            installPackage "$pkg"
+            ;;
+    esac
+}
+
 main() {
-    pkg=$1
-    if [ -z "$pkg" ]; then
+    list=""
+    while getopts "l:" opt; do
+        case "$opt" in
+            l)
+                list="$OPTARG"
+                ;;
+            *)
+                usage
+                exit 1
+                ;;
+        esac
+    done
+    shift $((OPTIND - 1))
+
+    install=installPackage
+    if [ -n "$list" ]; then
+        install=installListedPackage
+        set -- `cat "$list"`
+    elif [ -z "$1" ]; then
         usage
         exit 1
     fi
 
-    # Do it!
-    installPackage $pkg
+    # Do it! Packages are installed in the order given, stopping at the
+    # first failure.
+    start=`date +%s`
+    for pkg in "$@"; do
+        pkgStart=`date +%s`
+        $install $pkg || exit 1
+        echo "Installed $pkg in $((`date +%s` - pkgStart)) seconds"
+    done
+    echo "Installed $# package(s) in $((`date +%s` - start)) seconds"
 }
 
-main $1
+main "$@"
@@ -0,0 +1,408 @@
+# history.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Run history database, and timing regression detection.
+
+Each farbot run records the durations and outcomes of its build phases,
+pipeline tasks and assembler steps in an SQLite database. A task's
+duration is compared against the median of its durations over a window
+of previous successful runs to find tasks that have become slower.
+"""
+
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
+import farb
+from farb import accounting
+
+# Span categories recorded as tasks
+TASK_CATEGORIES = ('phase', 'task', 'stage', 'step')
+
+# Number of previous runs a task's duration is compared against
+DEFAULT_WINDOW = 10
+
+# Percentage by which a task must exceed its median to be flagged
+DEFAULT_THRESHOLD = 50
+
+# Tasks shorter than this, in seconds, are too noisy to be flagged
+MIN_DURATION = 5.0
+
+# Run and task outcomes
+OUTCOME_SUCCEEDED = 'succeeded'
+OUTCOME_FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    action TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    outcome TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    release TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_by_name ON tasks (category, name, release);
+"""
+
+class HistoryError(farb.FarbError):
+    pass
+
+def median(values):
+    """
+    @param values: Non-empty sequence of numbers
+    @return The median value
+    """
+    values = list(values)
+    values.sort()
+    middle = len(values) / 2
+    if (len(values) % 2):
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class Run(object):
+    """
+    A recorded farbot run
+    """
+    def __init__(self, id, action, started, finished, outcome):
+        self.id = id
+        self.action = action
+        self.started = started
+        self.finished = finished
+        self.outcome = outcome
+
+    def getDuration(self):
+        """
+        @return The run's duration in seconds, or None if it did not finish
+        """
+        if (self.finished is None):
+            return None
+        return self.finished - self.started
+
+class Task(object):
+    """
+    A recorded task, and its duration relative to previous runs
+    """
+    def __init__(self, category, name, release, duration, outcome, error=None):
+        self.category = category
+        self.name = name
+        self.release = release
+        self.duration = duration
+        self.outcome = outcome
+        self.error = error
+        # Median duration over the previous runs, and the number of
+        # durations it was taken from
+        self.median = None
+        self.samples = 0
+
+    def getChange(self):
+        """
+        @return The percentage by which the task's duration differs from
+            its median, or None if there is no median
+        """
+        if (not self.median):
+            return None
+        return (self.duration - self.median) * 100.0 / self.median
+
+    def isRegression(self, threshold=DEFAULT_THRESHOLD, minDuration=MIN_DURATION):
+        """
+        @param threshold: Percentage by which the duration must exceed the
+            median
+        @param minDuration: Minimum duration, in seconds, to consider
+        @return True if the task took longer than its median by more than
+            the threshold
+        """
+        change = self.getChange()
+        if (change is None or self.outcome != OUTCOME_SUCCEEDED):
+            return False
+        return self.duration >= minDuration and change > threshold
+
+    def getLabel(self):
+        """
+        @return A description of the task
+        """
+        if (self.release and self.name.find(self.release) == -1):
+            return '%s (%s)' % (self.name, self.release)
+        return self.name
+
+class History(object):
+    """
+    SQLite run history database
+    """
+    def __init__(self, path):
+        """
+        Open a history database, creating it if necessary. The database
+        must only be used from the thread that opened it.
+        @param path: Database path
+        """
+        if (sqlite3 is None):
+            raise HistoryError, "Run history requires the sqlite3 or pysqlite2 module"
+        self.path = path
+        try:
+            self._db = sqlite3.connect(path)
+            self._db.executescript(SCHEMA)
+        except sqlite3.Error, e:
+            raise HistoryError, "Could not open run history %s: %s" % (path, e)
+
+    def close(self):
+        self._db.close()
+
+    def addRun(self, action, started, finished, outcome, tasks):
+        """
+        Record a run and its tasks
+        @param action: farbot action
+        @param started: Start time
+        @param finished: Finish time
+        @param outcome: OUTCOME_SUCCEEDED or OUTCOME_FAILED
+        @param tasks: List of (Task, started) tuples
+        @return The new Run
+        """
+        try:
+            cursor = self._db.cursor()
+            cursor.execute("INSERT INTO runs (action, started, finished, outcome) VALUES (?, ?, ?, ?)", (action, started, finished, outcome))
+            run = cursor.lastrowid
+            for task, taskStarted in tasks:
+                cursor.execute("INSERT INTO tasks (run, category, name, release, started, duration, outcome, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (run, task.category, task.name, task.release, taskStarted, task.duration, task.outcome, task.error))
+            self._db.commit()
+        except sqlite3.Error, e:
+            self._db.rollback()
+            raise HistoryError, "Could not record run in %s: %s" % (self.path, e)
+        return Run(run, action, started, finished, outcome)
+
+    def getRuns(self, limit=None):
+        """
+        @param limit: Maximum number of runs to return
+        @return The most recent runs, newest first
+        """
+        sql = "SELECT id, action, started, finished, outcome FROM runs ORDER BY id DESC"
+        if (limit is not None):
+            sql += " LIMIT %d" % (limit)
+        return [Run(*row) for row in self._db.execute(sql)]
+
+    def getLastSuccess(self, action):
+        """
+        @param action: farbot action
+        @return The most recent successful Run of the action, or None
+        """
+        row = self._db.execute("SELECT id, action, started, finished, outcome FROM runs WHERE action = ? AND outcome = ? ORDER BY id DESC LIMIT 1", (action, OUTCOME_SUCCEEDED)).fetchone()
+        if (row is None):
+            return None
+        return Run(*row)
+
+    def getTasks(self, run, window=DEFAULT_WINDOW):
+        """
+        Get a run's tasks, with the median duration of each over the
+        previous runs in which it succeeded
+        @param run: Run id
+        @param window: Number of previous durations to take the median of
+        @return List of Tasks, in the order they started
+        """
+        tasks = []
+        rows = self._db.execute("SELECT category, name, release, duration, outcome, error FROM tasks WHERE run = ? ORDER BY started", (run,))
+        for row in rows.fetchall():
+            task = Task(*row)
+            durations = self._getDurations(task.category, task.name, task.release, run, window)
+            if (durations):
+                task.median = median(durations)
+                task.samples = len(durations)
+            tasks.append(task)
+        return tasks
+
+    def _getDurations(self, category, name, release, before, window):
+        """
+        @return Up to window of a task's most recent successful durations,
+            from runs before the given run id
+        """
+        rows = self._db.execute("SELECT duration FROM tasks WHERE category = ? AND name = ? AND release = ? AND outcome = ? AND run < ? ORDER BY run DESC LIMIT ?",
+                (category, name, release, OUTCOME_SUCCEEDED, before, window))
+        return [duration for (duration,) in rows]
+
+    def getEstimates(self, action, window=DEFAULT_WINDOW):
+        """
+        Estimate the durations of the tasks an action will run, from the
+        most recent successful run of the action
+        @param action: farbot action
+        @param window: Number of durations to take the median of
+        @return Dictionary of each task's median duration, keyed by
+            (category, name, release)
+        """
+        run = self.getLastSuccess(action)
+        if (run is None):
+            return {}
+        estimates = {}
+        rows = self._db.execute("SELECT category, name, release FROM tasks WHERE run = ? AND outcome = ?", (run.id, OUTCOME_SUCCEEDED))
+        for category, name, release in rows.fetchall():
+            estimates[(category, name, release)] = median(self._getDurations(category, name, release, run.id + 1, window))
+        return estimates
+
+    def findRegressions(self, run, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD, minDuration=MIN_DURATION):
+        """
+        @param run: Run id
+        @param window: Number of previous durations to take the median of
+        @param threshold: Percentage by which a task must exceed its median
+        @param minDuration: Minimum task duration, in seconds, to consider
+        @return List of the run's Tasks that regressed, largest change first
+        """
+        regressions = [task for task in self.getTasks(run, window) if task.isRegression(threshold, minDuration)]
+        regressions.sort(lambda a, b: cmp(b.getChange(), a.getChange()))
+        return regressions
+
+class Recorder(object):
+    """
+    Collect completed spans from a trace.Tracer, to be recorded as a run
+    in a History
+    """
+    def __init__(self, action, categories=TASK_CATEGORIES):
+        """
+        @param action: farbot action being run
+        @param categories: Span categories to record
+        """
+        self.action = action
+        self.categories = categories
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._tasks = []
+
+    def spanEnded(self, span):
+        """
+        trace.Tracer listener
+        @param span: Completed span dictionary
+        """
+        if (not span['category'] in self.categories):
+            return
+        error = span['results'].get('error')
+        if (error is None):
+            outcome = OUTCOME_SUCCEEDED
+        else:
+            outcome = OUTCOME_FAILED
+        # Ports and install steps are repeated for each release
+        release = accounting.getLabels().get('release') or ''
+        task = Task(span['category'], span['name'], release, span['end'] - span['ts'], outcome, error)
+        self._lock.acquire()
+        try:
+            self._tasks.append((task, span['ts']))
+        finally:
+            self._lock.release()
+
+    def save(self, history, outcome):
+        """
+        Record the run
+        @param history: History to record the run in
+        @param outcome: OUTCOME_SUCCEEDED or OUTCOME_FAILED
+        @return The new Run
+        """
+        self._lock.acquire()
+        try:
+            tasks = list(self._tasks)
+        finally:
+            self._lock.release()
+        return history.addRun(self.action, self.started, time.time(), outcome, tasks)
+
+def formatDuration(seconds):
+    """
+    @param seconds: Duration in seconds
+    @return The duration as [[h]h:]mm:ss, or with tenths of a second if
+        shorter than a minute
+    """
+    if (seconds < 60):
+        return '%.1fs' % (seconds)
+    seconds = int(seconds)
+    if (seconds < 3600):
+        return '%d:%02d' % (seconds / 60, seconds % 60)
+    return '%d:%02d:%02d' % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+def writeReport(history, output, runs=5, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD, minDuration=MIN_DURATION):
+    """
+    Write a report of the recent runs, and of the tasks of the latest run,
+    flagging those that regressed with '!'
+    @param history: History
+    @param output: Open file
+    @param runs: Number of recent runs to list
+    @param window: Number of previous durations to take the median of
+    @param threshold: Percentage by which a task must exceed its median
+    @param minDuration: Minimum task duration, in seconds, to flag
+    @return The number of regressed tasks in the latest run
+    """
+    recent = history.getRuns(runs)
+    if (not recent):
+        output.write("No runs recorded in %s.\n" % (history.path))
+        return 0
+
+    output.write("Recent runs:\n")
+    width = max([len(run.action) for run in recent] + [10])
+    for run in recent:
+        duration = run.getDuration()
+        if (duration is None):
+            duration = '-'
+        else:
+            duration = formatDuration(duration)
+        output.write("  %5d  %s  %-*s %-10s %10s\n" % (run.id, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run.started)), width, run.action, run.outcome or '-', duration))
+
+    latest = recent[0]
+    tasks = history.getTasks(latest.id, window)
+    if (not tasks):
+        return 0
+
+    regressions = 0
+    width = max([len(task.getLabel()) for task in tasks])
+    output.write("\nTasks of run %d, against the median of up to %d previous runs:\n" % (latest.id, window))
+    output.write("    %-6s %-*s %10s %10s %8s\n" % ('kind', width, 'task', 'duration', 'median', 'change'))
+    for task in tasks:
+        flag = ' '
+        if (task.isRegression(threshold, minDuration)):
+            flag = '!'
+            regressions += 1
+        if (task.median is None):
+            medianText = changeText = '-'
+        else:
+            medianText = formatDuration(task.median)
+            changeText = '%+.0f%%' % (task.getChange())
+        if (task.outcome != OUTCOME_SUCCEEDED):
+            changeText = task.outcome
+        output.write("  %s %-6s %-*s %10s %10s %8s\n" % (flag, task.category, width, task.getLabel(), formatDuration(task.duration), medianText, changeText))
+
+    if (regressions):
+        output.write("\n%d task(s) took more than %d%% longer than their median.\n" % (regressions, threshold))
+    return regressions
@@ -0,0 +1,414 @@
+# logfile.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Buffered build logs.
+
+Build logs receive a line of output at a time from make, tar and the
+other commands a build runs. Rather than writing each line to disk as it
+arrives, a LogFile buffers it in memory; a single writer thread shared
+by all open logs writes out the buffered data periodically, or as soon
+as a log's buffer fills. Logs may be gzip compressed as they are
+written, and rotated once they reach a given size. A writer that gets
+too far ahead of the disk blocks until its log's buffer has been written
+out.
+
+Callers flush() or close() a log before reporting a failure that refers
+to it, so that the log's tail is on disk when it is read. Open logs are
+also flushed when the process exits.
+"""
+
+import atexit
+import gzip
+import os
+import sys
+import threading
+
+import farb
+
+# Buffered data that causes a log to be written out immediately
+LOG_BUFFER_SIZE = 1024 * 1024
+
+# Multiple of the buffer size at which writers block until the buffered
+# data has been written out
+LOG_BUFFER_LIMIT = 4
+
+# Seconds between writes of buffered data
+LOG_FLUSH_INTERVAL = 1.0
+
+# Number of rotated logs kept
+LOG_ROTATE_KEEP = 4
+
+# Suffix of gzip compressed logs
+COMPRESSED_SUFFIX = '.gz'
+
+class LogFileError(farb.FarbError):
+    pass
+
+def getPath(path, compress):
+    """
+    @param path: Uncompressed log path
+    @param compress: True if the log is compressed
+    @return The path the log is written to
+    """
+    if (compress):
+        return path + COMPRESSED_SUFFIX
+    return path
+
+def getRotatedPath(path, generation):
+    """
+    @param path: Log path
+    @param generation: Rotation number, from 1 for the most recent
+    @return The path of a rotated log. The number is placed before any
+        compression suffix, so build.log.gz is rotated to build.log.1.gz.
+    """
+    if (path.endswith(COMPRESSED_SUFFIX)):
+        return '%s.%d%s' % (path[:-len(COMPRESSED_SUFFIX)], generation, COMPRESSED_SUFFIX)
+    return '%s.%d' % (path, generation)
+
+class LogWriter(object):
+    """
+    Write out the buffered data of open LogFiles from a background thread
+    """
+    def __init__(self, interval=LOG_FLUSH_INTERVAL):
+        """
+        @param interval: Seconds between writes of buffered data
+        """
+        self.interval = interval
+        self._condition = threading.Condition()
+        self._logs = []
+        self._thread = None
+        self._woken = False
+        self._stopped = False
+
+    def register(self, log):
+        """
+        Start writing out a log's buffered data
+        @param log: LogFile
+        """
+        self._condition.acquire()
+        try:
+            self._logs.append(log)
+            if (self._thread is None):
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name='log-writer')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._condition.release()
+
+    def unregister(self, log):
+        """
+        Stop writing out a log's buffered data
+        @param log: LogFile
+        """
+        self._condition.acquire()
+        try:
+            if (log in self._logs):
+                self._logs.remove(log)
+        finally:
+            self._condition.release()
+
+    def wake(self):
+        """
+        Write out buffered data now, rather than at the next interval
+        """
+        self._condition.acquire()
+        try:
+            self._woken = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def stop(self):
+        """
+        Write out any buffered data, and stop the writer thread
+        """
+        self._condition.acquire()
+        try:
+            thread = self._thread
+            self._thread = None
+            self._stopped = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        if (thread is not None):
+            thread.join()
+
+    def isRunning(self):
+        """
+        @return True if the writer thread is running
+        """
+        return self._thread is not None
+
+    def getLogs(self):
+        """
+        @return A list of the open LogFiles
+        """
+        self._condition.acquire()
+        try:
+            return list(self._logs)
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        stopped = False
+        while (not stopped):
+            self._condition.acquire()
+            try:
+                # A wake() may arrive while the logs are being written out
+                if (not self._woken and not self._stopped):
+                    self._condition.wait(self.interval)
+                self._woken = False
+                stopped = self._stopped
+            finally:
+                self._condition.release()
+            for log in self.getLogs():
+                log._drain()
+
+class LogFile(object):
+    """
+    A build log, buffered in memory and written out by a LogWriter
+    """
+    def __init__(self, path, compress=False, maxSize=None, keep=LOG_ROTATE_KEEP, bufferSize=LOG_BUFFER_SIZE, writer=None):
+        """
+        Create a new LogFile, replacing any existing log and rotated logs
+        @param path: Log path
+        @param compress: gzip compress the log
+        @param maxSize: Optional number of bytes of output after which the
+            log is rotated
+        @param keep: Number of rotated logs to keep
+        @param bufferSize: Amount of buffered data that causes the log to
+            be written out immediately
+        @param writer: LogWriter, defaulting to the shared writer
+        """
+        self.path = path
+        self.compress = compress
+        self.maxSize = maxSize
+        self.keep = keep
+        self.bufferSize = bufferSize
+        if (writer is None):
+            writer = getWriter()
+        self.writer = writer
+        self.closed = False
+
+        # Buffered data, guarded by _lock, which is notified as it is
+        # written out
+        self._lock = threading.Condition(threading.Lock())
+        self._pending = []
+        self._pendingSize = 0
+        # Error writing out buffered data, raised to the next caller
+        self._error = None
+
+        # The file, guarded by _ioLock
+        self._ioLock = threading.Lock()
+        self._file = None
+        self._written = 0
+
+        try:
+            for generation in range(1, keep + 1):
+                rotated = getRotatedPath(path, generation)
+                if (os.path.exists(rotated)):
+                    os.unlink(rotated)
+            self._open()
+        except (IOError, OSError), e:
+            raise LogFileError, "Could not open log file %s: %s" % (path, e)
+        self.writer.register(self)
+
+    def _open(self):
+        if (self.compress):
+            self._file = gzip.GzipFile(self.path, 'wb')
+        else:
+            self._file = open(self.path, 'w')
+        self._written = 0
+
+    def _rotate(self):
+        """
+        Move the log to the first rotated log, shifting the older rotated
+        logs, and start a new log
+        """
+        self._file.close()
+        oldest = getRotatedPath(self.path, self.keep)
+        if (os.path.exists(oldest)):
+            os.unlink(oldest)
+        for generation in range(self.keep - 1, 0, -1):
+            rotated = getRotatedPath(self.path, generation)
+            if (os.path.exists(rotated)):
+                os.rename(rotated, getRotatedPath(self.path, generation + 1))
+        os.rename(self.path, getRotatedPath(self.path, 1))
+        self._open()
+
+    def _drain(self):
+        """
+        Write out the buffered data
+        """
+        self._ioLock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                pending = self._pending
+                self._pending = []
+                self._pendingSize = 0
+                self._lock.notifyAll()
+            finally:
+                self._lock.release()
+            if (not pending or self._file is None):
+                return
+
+            try:
+                self._file.write(''.join(pending))
+                self._file.flush()
+                self._written += sum([len(data) for data in pending])
+                if (self.maxSize and self._written >= self.maxSize):
+                    self._rotate()
+            except (IOError, OSError), e:
+                self._setError(e)
+        finally:
+            self._ioLock.release()
+
+    def _setError(self, e):
+        """
+        Record an error writing out the buffered data, to be raised to the
+        next caller, and release any blocked writers
+        @param e: IOError or OSError
+        """
+        self._lock.acquire()
+        try:
+            if (self._error is None):
+                self._error = "Could not write log file %s: %s" % (self.path, e)
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+    def _raiseError(self):
+        self._lock.acquire()
+        try:
+            error = self._error
+            self._error = None
+        finally:
+            self._lock.release()
+        if (error is not None):
+            raise LogFileError, error
+
+    def write(self, data):
+        """
+        Buffer data to be written to the log. Once the buffered data
+        reaches LOG_BUFFER_LIMIT times the buffer size, block until it has
+        been written out.
+        @param data: String
+        """
+        if (self.closed):
+            raise ValueError, "I/O operation on closed log %s" % (self.path)
+        self._raiseError()
+        self._lock.acquire()
+        try:
+            self._pending.append(data)
+            self._pendingSize += len(data)
+            full = self._pendingSize >= self.bufferSize
+        finally:
+            self._lock.release()
+        if (not full):
+            return
+
+        self.writer.wake()
+        self._lock.acquire()
+        try:
+            while (self._pendingSize >= self.bufferSize * LOG_BUFFER_LIMIT and self._error is None and self.writer.isRunning()):
+                self._lock.wait(self.writer.interval)
+        finally:
+            self._lock.release()
+        if (not self.writer.isRunning()):
+            # Nothing else will write the buffered data out
+            self._drain()
+        self._raiseError()
+
+    def flush(self):
+        """
+        Write out the buffered data now
+        """
+        self._drain()
+        self._raiseError()
+
+    def close(self, warn=False):
+        """
+        Write out the buffered data, and close the log
+        @param warn: If the buffered data could not be written out, print a
+            warning rather than raising a LogFileError. For closing a log
+            while handling another failure.
+        """
+        if (self.closed):
+            return
+        self.closed = True
+        self.writer.unregister(self)
+        self._drain()
+        self._ioLock.acquire()
+        try:
+            if (self._file is not None):
+                try:
+                    self._file.close()
+                except (IOError, OSError), e:
+                    self._setError(e)
+                self._file = None
+        finally:
+            self._ioLock.release()
+        try:
+            self._raiseError()
+        except LogFileError, e:
+            if (not warn):
+                raise
+            print >>sys.stderr, "Warning: %s" % (e)
+
+# LogWriter shared by all logs
+_writer = None
+_writerLock = threading.Lock()
+
+def getWriter():
+    """
+    @return The shared LogWriter
+    """
+    global _writer
+    _writerLock.acquire()
+    try:
+        if (_writer is None):
+            _writer = LogWriter()
+        return _writer
+    finally:
+        _writerLock.release()
+
+def _stopWriter():
+    """
+    Write out the buffered data of every open log, and stop the shared
+    writer before the interpreter shuts down
+    """
+    if (_writer is None):
+        return
+    _writer.stop()
+
+# Don't lose the tail of any log left open when the process exits
+atexit.register(_stopWriter)
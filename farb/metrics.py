@@ -0,0 +1,303 @@
+# metrics.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Build metrics, exported in the Prometheus text exposition format.
+
+Build phases record their durations and results in a Registry, which
+is written to a metrics file at the end of each phase, for collection
+by node_exporter's textfile collector. The file is replaced atomically,
+and values from earlier runs, such as the time each release was last
+built, are carried over until they are next recorded.
+"""
+
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import farb
+
+# Exported metrics: name, type, help
+METRICS = (
+    ('farbot_phase_duration_seconds', 'gauge', 'Duration of the last run of the build phase.'),
+    ('farbot_phase_success', 'gauge', 'Whether the last run of the build phase succeeded.'),
+    ('farbot_phase_last_success_timestamp_seconds', 'gauge', 'Time at which the build phase last succeeded.'),
+    ('farbot_packages_built', 'gauge', 'Packages built by the last package build of the release.'),
+    ('farbot_package_build_failures', 'gauge', 'Package builds that failed in the last package build of the release.'),
+    ('farbot_installroot_copied_bytes', 'gauge', 'Bytes copied into the install root by the last installation build.'),
+    ('farbot_installroot_size_bytes', 'gauge', 'Size of the files in the install root, including all generations.'),
+    ('farbot_replicated_bytes', 'gauge', 'Bytes copied to the NFS mirror by the last replication.'),
+)
+
+# Matches a sample line, capturing the metric name, labels and value
+SAMPLE_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)\s*$')
+
+# Matches a label within a sample line's braces
+SAMPLE_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+class MetricsError(farb.FarbError):
+    pass
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _unescape(value):
+    return value.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
+
+def _formatValue(value):
+    if (isinstance(value, float) and value != int(value)):
+        return repr(value)
+    return str(int(value))
+
+class Registry(object):
+    """
+    The current value of each exported metric, by label set
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._samples = {}
+        for name, type, help in METRICS:
+            self._types[name] = type
+            self._samples[name] = {}
+        # Paths whose previous samples have been merged
+        self._loaded = {}
+
+    def set(self, name, value, labels=None):
+        """
+        Set a metric's value
+        @param name: Metric name, from METRICS
+        @param value: Numeric value
+        @param labels: Optional dictionary of label names and values
+        """
+        if (not self._samples.has_key(name)):
+            raise MetricsError, "Unknown metric %s" % (name)
+        if (labels is None):
+            labels = {}
+        key = labels.items()
+        key.sort()
+        self._lock.acquire()
+        try:
+            self._samples[name][tuple(key)] = value
+        finally:
+            self._lock.release()
+
+    def get(self, name, labels=None):
+        """
+        @param name: Metric name
+        @param labels: Optional dictionary of label names and values
+        @return The metric's value, or None if it is not set
+        """
+        if (labels is None):
+            labels = {}
+        key = labels.items()
+        key.sort()
+        self._lock.acquire()
+        try:
+            return self._samples.get(name, {}).get(tuple(key))
+        finally:
+            self._lock.release()
+
+    def load(self, path):
+        """
+        Read samples from a metrics file written by write(), keeping any
+        values that have already been set
+        @param path: Metrics file path
+        """
+        try:
+            f = open(path, 'r')
+        except IOError:
+            # Nothing has been exported yet
+            return
+        self._lock.acquire()
+        try:
+            try:
+                for line in f:
+                    match = SAMPLE_LINE.match(line)
+                    if (not match or line.startswith('#')):
+                        continue
+                    name, labelText, value = match.groups()
+                    if (not self._samples.has_key(name)):
+                        continue
+                    key = [(label, _unescape(labelValue)) for label, labelValue in SAMPLE_LABEL.findall(labelText or '')]
+                    key.sort()
+                    key = tuple(key)
+                    if (self._samples[name].has_key(key)):
+                        continue
+                    try:
+                        self._samples[name][key] = float(value)
+                    except ValueError:
+                        continue
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+
+    def render(self):
+        """
+        @return The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        self._lock.acquire()
+        try:
+            for name, type, help in METRICS:
+                samples = self._samples[name]
+                if (not samples):
+                    continue
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+                keys = samples.keys()
+                keys.sort()
+                for key in keys:
+                    if (key):
+                        labels = ','.join(['%s="%s"' % (label, _escape(value)) for label, value in key])
+                        lines.append('%s{%s} %s' % (name, labels, _formatValue(samples[key])))
+                    else:
+                        lines.append('%s %s' % (name, _formatValue(samples[key])))
+        finally:
+            self._lock.release()
+        return ''.join([line + '\n' for line in lines])
+
+    def write(self, path):
+        """
+        Atomically replace a metrics file with the current values. The
+        first time a file is written, its previous samples are merged.
+        @param path: Metrics file path
+        """
+        if (not self._loaded.has_key(path)):
+            self.load(path)
+            self._loaded[path] = True
+
+        # Write to a temporary file in the same directory, and rename it
+        # over the metrics file, so that it's never seen half written
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            fd, tempPath = tempfile.mkstemp(prefix='.%s.' % (os.path.basename(path)), dir=directory)
+        except OSError, e:
+            raise MetricsError, "Could not create temporary metrics file in %s: %s" % (directory, e)
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(self.render())
+            finally:
+                f.close()
+            os.chmod(tempPath, 0644)
+            os.rename(tempPath, path)
+        except (IOError, OSError), e:
+            if (os.path.exists(tempPath)):
+                os.unlink(tempPath)
+            raise MetricsError, "Could not write metrics file %s: %s" % (path, e)
+
+# Registry of the current run's metrics
+_registry = Registry()
+
+# Metrics file the registry is written to, if any
+_path = None
+
+# Serialises writes of the metrics file
+_writeLock = threading.Lock()
+
+def getRegistry():
+    """
+    @return The current Registry
+    """
+    return _registry
+
+def setPath(path):
+    """
+    Set the metrics file written by publish()
+    @param path: Metrics file path, or None to disable metrics export
+    """
+    global _path
+    _path = path
+
+def getPath():
+    """
+    @return The metrics file path, or None
+    """
+    return _path
+
+def reset():
+    """
+    Discard all recorded values, and disable metrics export
+    """
+    global _registry
+    _registry = Registry()
+    setPath(None)
+
+def publish():
+    """
+    Write the current metrics to the metrics file, if one is set
+    """
+    path = _path
+    if (path is None):
+        return
+    _writeLock.acquire()
+    try:
+        _registry.write(path)
+    finally:
+        _writeLock.release()
+
+def measured(phase, release=None):
+    """
+    Decorate a build phase method, recording its duration and result,
+    and publishing the metrics once it returns or fails
+    @param phase: Phase name
+    @param release: Optional callable passed the method's arguments,
+        including the instance, returning the release name
+    """
+    def decorate(function):
+        def wrapper(self, *args, **kwargs):
+            labels = {'phase' : phase, 'release' : ''}
+            if (release is not None):
+                labels['release'] = release(self, *args, **kwargs)
+            started = time.time()
+            succeeded = False
+            try:
+                value = function(self, *args, **kwargs)
+                succeeded = True
+                return value
+            finally:
+                finished = time.time()
+                _registry.set('farbot_phase_duration_seconds', finished - started, labels)
+                _registry.set('farbot_phase_success', int(succeeded), labels)
+                if (succeeded):
+                    _registry.set('farbot_phase_last_success_timestamp_seconds', finished, labels)
+                # Failing to export metrics must not fail the build
+                try:
+                    publish()
+                except MetricsError, e:
+                    print >>sys.stderr, "Warning: %s" % (e)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorate
@@ -0,0 +1,235 @@
+# pkgindex.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Index of the binary packages in a release's package directory.
+
+The index records each package's name, origin, Latest link name, size
+and dependencies, so that an installation's complete package list can
+be resolved, in dependency order, when the installation root is
+assembled rather than by pkg_add(1) on each client.
+"""
+
+import os
+import tarfile
+
+import farb
+
+# Index file name, within the package directory
+INDEX_NAME = 'INDEX.farbot'
+
+# Package contents file within each package
+CONTENTS_NAME = '+CONTENTS'
+
+class PackageIndexError(farb.FarbError):
+    pass
+
+class Package(object):
+    """
+    A binary package
+    """
+    def __init__(self, name, origin, latest, size, dependencies):
+        """
+        @param name: Package name, including the version
+        @param origin: Port origin
+        @param latest: Latest link name, without the version
+        @param size: Size of the package file
+        @param dependencies: List of the names of required packages
+        """
+        self.name = name
+        self.origin = origin
+        self.latest = latest
+        self.size = size
+        self.dependencies = dependencies
+
+    def getPath(self):
+        """
+        @return The package file's path, relative to the package directory
+        """
+        return os.path.join('All', self.name + '.tbz')
+
+def readContents(path):
+    """
+    Read a package file's packing list.
+    @param path: Package file
+    @return Tuple of (name, origin, dependencies)
+    """
+    name = None
+    origin = None
+    dependencies = []
+
+    try:
+        tar = tarfile.open(path, 'r:*')
+        try:
+            # The packing list is the first member of the archive
+            contents = None
+            for member in tar:
+                if (member.name == CONTENTS_NAME):
+                    contents = tar.extractfile(member).read()
+                    break
+        finally:
+            tar.close()
+    except (tarfile.TarError, IOError), e:
+        raise PackageIndexError, "Could not read package %s: %s" % (path, e)
+
+    if (contents == None):
+        raise PackageIndexError, "Package %s does not contain a %s file" % (path, CONTENTS_NAME)
+
+    for line in contents.splitlines():
+        if (line.startswith('@name ')):
+            name = line[6:].strip()
+        elif (line.startswith('@pkgdep ')):
+            dependencies.append(line[8:].strip())
+        elif (line.startswith('@comment ORIGIN:')):
+            origin = line[16:].strip()
+
+    if (not name):
+        raise PackageIndexError, "Package %s has no @name entry" % (path)
+
+    return name, origin, dependencies
+
+class PackageIndex(object):
+    """
+    Index of the packages in a package directory
+    """
+    def __init__(self):
+        # Map of package name to Package
+        self.packages = {}
+        # Map of Latest link name to package name
+        self.latest = {}
+        # Map of port directory name to package name
+        self.ports = {}
+
+    def add(self, package):
+        self.packages[package.name] = package
+        if (package.latest):
+            self.latest[package.latest] = package.name
+        if (package.origin):
+            self.ports[os.path.basename(package.origin)] = package.name
+
+    def scan(self, packagedir):
+        """
+        Index the packages in packagedir/All, using the packagedir/Latest
+        links to find each package's Latest name.
+        @param packagedir: Package directory
+        """
+        latest = {}
+        latestdir = os.path.join(packagedir, 'Latest')
+        if (os.path.isdir(latestdir)):
+            for entry in os.listdir(latestdir):
+                path = os.path.join(latestdir, entry)
+                if (entry.endswith('.tbz') and os.path.islink(path)):
+                    target = os.path.basename(os.readlink(path))
+                    latest[target[:-4]] = entry[:-4]
+
+        alldir = os.path.join(packagedir, 'All')
+        if (not os.path.isdir(alldir)):
+            return
+
+        entries = os.listdir(alldir)
+        entries.sort()
+        for entry in entries:
+            if (not entry.endswith('.tbz')):
+                continue
+            path = os.path.join(alldir, entry)
+            name, origin, dependencies = readContents(path)
+            self.add(Package(name, origin, latest.get(name), os.path.getsize(path), dependencies))
+
+    def write(self, path):
+        """
+        Write the index, one package per line:
+            name|origin|latest|size|dependency dependency ...
+        @param path: Index file
+        """
+        names = self.packages.keys()
+        names.sort()
+        output = open(path, 'w')
+        try:
+            for name in names:
+                package = self.packages[name]
+                output.write('%s|%s|%s|%d|%s\n' % (package.name, package.origin or '', package.latest or '', package.size, ' '.join(package.dependencies)))
+        finally:
+            output.close()
+
+    def read(self, path):
+        """
+        Read an index written by write()
+        @param path: Index file
+        """
+        input = open(path, 'r')
+        try:
+            for line in input:
+                fields = line.rstrip('\n').split('|')
+                if (len(fields) != 5):
+                    raise PackageIndexError, "Malformed package index entry in %s: %s" % (path, line.strip())
+                name, origin, latest, size, dependencies = fields
+                self.add(Package(name, origin or None, latest or None, int(size), dependencies.split()))
+        finally:
+            input.close()
+
+    def getPackage(self, name):
+        """
+        @param name: Package name, Latest link name, or port directory name
+        @return The named Package
+        """
+        if (self.latest.has_key(name)):
+            name = self.latest[name]
+        elif (self.ports.has_key(name)):
+            name = self.ports[name]
+        if (not self.packages.has_key(name)):
+            raise PackageIndexError, "Package %s is not in the package index" % (name)
+        return self.packages[name]
+
+    def getInstallOrder(self, names):
+        """
+        Resolve a list of packages and all of their dependencies, ordered
+        so that each package follows its dependencies.
+        @param names: Package names, Latest link names, or port directory
+            names
+        @return List of Packages
+        """
+        order = []
+        visited = {}
+        for name in names:
+            self._visit(self.getPackage(name), visited, order)
+        return order
+
+    def _visit(self, package, visited, order):
+        if (visited.has_key(package.name)):
+            return
+        # Mark the package before visiting its dependencies, so a
+        # dependency cycle can not recurse indefinitely
+        visited[package.name] = True
+
+        for dependency in package.dependencies:
+            if (not self.packages.has_key(dependency)):
+                raise PackageIndexError, "Package %s requires %s, which is not in the package index" % (package.name, dependency)
+            self._visit(self.packages[dependency], visited, order)
+
+        order.append(package)
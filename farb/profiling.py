@@ -0,0 +1,304 @@
+# profiling.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Profiling of farbot's own Python code.
+
+A Profiler runs cProfile for the duration of each build phase, as
+reported by the trace spans, and for configuration loading. Nested
+phases are profiled separately, with the enclosing phase's profile
+paused while they run. Job threads started by a phase, such as the
+concurrent assemblers and replication copies, are profiled on its
+behalf. The process's peak resident set size is sampled as each phase
+begins and ends. The profiles are written once the run completes, for
+reading with pstats.
+"""
+
+import os
+import pstats
+import re
+import resource
+import threading
+import time
+
+try:
+    import cProfile
+except ImportError:
+    cProfile = None
+
+import farb
+
+# Directory in the BuildRoot the profiles are written to
+PROFILE_DIR = 'profile'
+
+# Name of the summary of all profiled phases
+SUMMARY_NAME = 'summary.txt'
+
+# Number of functions listed in each phase's report
+REPORT_LIMIT = 40
+
+# Span categories profiled
+PROFILE_CATEGORIES = ('phase',)
+
+class ProfilingError(farb.FarbError):
+    pass
+
+def getMaxRSS():
+    """
+    @return The process's peak resident set size, in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _getFileName(name):
+    """
+    @return A file name for a phase name
+    """
+    return re.sub(r'[^A-Za-z0-9._-]+', '-', name).strip('-')
+
+class PhaseProfile(object):
+    """
+    The profile of a single phase, and of the job threads run on its
+    behalf
+    """
+    def __init__(self, name):
+        """
+        @param name: Phase name
+        """
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.workers = []
+        self.started = time.time()
+        self.elapsed = None
+        self.startRSS = getMaxRSS()
+        self.peakRSS = None
+        self._lock = threading.Lock()
+
+    def addWorker(self, profile):
+        """
+        Include a job thread's profile
+        @param profile: cProfile.Profile
+        """
+        self._lock.acquire()
+        try:
+            self.workers.append(profile)
+        finally:
+            self._lock.release()
+
+    def getStats(self, stream=None):
+        """
+        @param stream: Optional file pstats reports are printed to
+        @return A pstats.Stats instance of the phase's profile
+        """
+        if (stream is not None):
+            stats = pstats.Stats(self.profile, stream=stream)
+        else:
+            stats = pstats.Stats(self.profile)
+        self._lock.acquire()
+        try:
+            for profile in self.workers:
+                stats.add(profile)
+        finally:
+            self._lock.release()
+        return stats
+
+class Profiler(object):
+    """
+    Profile build phases
+    """
+    def __init__(self, categories=PROFILE_CATEGORIES):
+        """
+        Create a new Profiler instance
+        @param categories: Span categories to profile
+        """
+        if (cProfile is None):
+            raise ProfilingError, "Profiling requires the cProfile module"
+        self.categories = categories
+        # Completed PhaseProfiles, in the order they finished
+        self.profiles = []
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._context = threading.local()
+
+    def _getStack(self):
+        stack = getattr(self._context, 'stack', None)
+        if (stack is None):
+            stack = []
+            self._context.stack = stack
+        return stack
+
+    def getCurrent(self):
+        """
+        @return The current thread's innermost PhaseProfile, or None
+        """
+        stack = self._getStack()
+        if (stack):
+            return stack[-1]
+        return None
+
+    def start(self, name):
+        """
+        Start profiling a phase in the current thread
+        @param name: Phase name
+        @return The new PhaseProfile
+        """
+        stack = self._getStack()
+        if (stack):
+            stack[-1].profile.disable()
+        phase = PhaseProfile(name)
+        stack.append(phase)
+        phase.profile.enable()
+        return phase
+
+    def stop(self, phase):
+        """
+        Stop profiling a phase started in the current thread, resuming
+        the profile of the enclosing phase
+        @param phase: PhaseProfile returned by start()
+        """
+        phase.profile.disable()
+        phase.elapsed = time.time() - phase.started
+        phase.peakRSS = getMaxRSS()
+        stack = self._getStack()
+        if (phase in stack):
+            stack.remove(phase)
+        if (stack):
+            stack[-1].profile.enable()
+        self._lock.acquire()
+        try:
+            self.profiles.append(phase)
+        finally:
+            self._lock.release()
+
+    def spanBegan(self, span):
+        """
+        trace.Tracer begin listener
+        @param span: Begin event dictionary
+        """
+        if (span['category'] in self.categories):
+            self._spans[span['id']] = self.start(span['name'])
+
+    def spanEnded(self, span):
+        """
+        trace.Tracer listener
+        @param span: Completed span dictionary
+        """
+        phase = self._spans.pop(span['id'], None)
+        if (phase is not None):
+            self.stop(phase)
+
+    def write(self, directory, limit=REPORT_LIMIT):
+        """
+        Write each phase's profile, as <phase>.prof for pstats and as a
+        <phase>.txt report of the functions with the highest cumulative
+        time, and a summary of all phases
+        @param directory: Directory to write to, created if necessary
+        @param limit: Number of functions to list in each report
+        """
+        self._lock.acquire()
+        try:
+            profiles = list(self.profiles)
+        finally:
+            self._lock.release()
+
+        try:
+            if (not os.path.isdir(directory)):
+                os.makedirs(directory)
+
+            summary = open(os.path.join(directory, SUMMARY_NAME), 'w')
+            try:
+                width = max([len('phase')] + [len(phase.name) for phase in profiles])
+                summary.write("%-*s %10s %10s %12s %12s\n" % (width, 'phase', 'wall(s)', 'python(s)', 'maxrss(M)', 'growth(M)'))
+                for phase in profiles:
+                    base = os.path.join(directory, _getFileName(phase.name))
+                    stats = phase.getStats()
+                    stats.dump_stats(base + '.prof')
+
+                    report = open(base + '.txt', 'w')
+                    try:
+                        report.write("Phase %s: %.1fs elapsed, peak RSS %.1fM (%+.1fM)\n\n" % (phase.name, phase.elapsed, phase.peakRSS / 1024.0, (phase.peakRSS - phase.startRSS) / 1024.0))
+                        stats = phase.getStats(report)
+                        stats.sort_stats('cumulative').print_stats(limit)
+                    finally:
+                        report.close()
+
+                    summary.write("%-*s %10.1f %10.1f %12.1f %+12.1f\n" % (width, phase.name, phase.elapsed, stats.total_tt, phase.peakRSS / 1024.0, (phase.peakRSS - phase.startRSS) / 1024.0))
+            finally:
+                summary.close()
+        except (IOError, OSError), e:
+            raise ProfilingError, "Could not write profiles to %s: %s" % (directory, e)
+
+# Profiler of the current run, if any
+_profiler = None
+
+def setProfiler(profiler):
+    """
+    Profile the job threads of the phases profiled by a Profiler
+    @param profiler: Profiler, or None
+    """
+    global _profiler
+    _profiler = profiler
+
+def getProfiler():
+    """
+    @return The current Profiler, or None
+    """
+    return _profiler
+
+def getCurrent():
+    """
+    @return The current thread's innermost PhaseProfile, or None
+    """
+    profiler = _profiler
+    if (profiler is None):
+        return None
+    return profiler.getCurrent()
+
+def adopt(phase):
+    """
+    Start profiling the current job thread on behalf of a phase begun by
+    another thread
+    @param phase: PhaseProfile returned by getCurrent(), or None
+    @return A cProfile.Profile to pass to release(), or None
+    """
+    if (phase is None):
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def release(phase, profile):
+    """
+    Stop profiling the current job thread
+    @param phase: PhaseProfile passed to adopt()
+    @param profile: cProfile.Profile returned by adopt()
+    """
+    if (profile is None):
+        return
+    profile.disable()
+    phase.addWorker(profile)
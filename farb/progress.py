@@ -0,0 +1,397 @@
+# progress.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Live progress reporting.
+
+A Progress tracks the tasks a run has open, as reported by the trace
+spans, the number of ports built and distribution sets extracted out of
+those known to the run, and the amount of data copied. The time
+remaining is estimated from the durations of the same tasks in previous
+runs, as recorded in the run history. A Reporter periodically shows the
+progress on a console status line, and writes it to a JSON status file
+for other programs to read.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import farb
+from farb import accounting, history, trace
+
+# Seconds between progress reports
+REPORT_INTERVAL = 1.0
+
+# Width of the console status line
+STATUS_WIDTH = 79
+
+# Span category whose historical durations estimate the remaining time.
+# Steps are the finest grained tasks, and do not nest; a task made up of
+# steps is a stage, so that its work is not counted twice.
+ESTIMATE_CATEGORY = 'step'
+
+class ProgressError(farb.FarbError):
+    pass
+
+def formatBytes(count):
+    """
+    @param count: Number of bytes
+    @return The count in human readable units
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if (count < 1024):
+            break
+        count /= 1024.0
+    else:
+        unit = 'TB'
+    if (unit == 'B'):
+        return '%d %s' % (count, unit)
+    return '%.1f %s' % (count, unit)
+
+class Progress(object):
+    """
+    Track the progress of a run
+    """
+    def __init__(self, action, estimates=None):
+        """
+        Create a new Progress instance
+        @param action: farbot action being run
+        @param estimates: Optional dictionary of estimated task durations,
+            as returned by history.History.getEstimates()
+        """
+        self.action = action
+        self.started = time.time()
+        if (estimates is None):
+            estimates = {}
+        self.estimates = estimates
+        self._lock = threading.Lock()
+        # Open tasks, by span id: (name, estimate key, start time)
+        self._running = {}
+        # Estimate keys of the tasks completed
+        self._completed = {}
+        # Completed and total count of each unit of work
+        self._units = {}
+        self._bytes = 0
+
+    def spanBegan(self, span):
+        """
+        trace.Tracer begin listener
+        @param span: Begin event dictionary
+        """
+        if (not span['category'] in history.TASK_CATEGORIES):
+            return
+        # Keyed as tasks are recorded in the run history
+        key = (span['category'], span['name'], accounting.getLabels().get('release') or '')
+        self._lock.acquire()
+        try:
+            self._running[span['id']] = (span['name'], key, span['ts'])
+        finally:
+            self._lock.release()
+
+    def spanEnded(self, span):
+        """
+        trace.Tracer listener
+        @param span: Completed span dictionary
+        """
+        self._lock.acquire()
+        try:
+            entry = self._running.pop(span['id'], None)
+            if (entry is not None and not span['results'].has_key('error')):
+                self._completed[entry[1]] = True
+        finally:
+            self._lock.release()
+
+    def addTotal(self, unit, count):
+        """
+        Add to the amount of a unit of work known to the run
+        @param unit: Unit name, such as 'ports'
+        @param count: Number of units
+        """
+        self._lock.acquire()
+        try:
+            self._units.setdefault(unit, [0, 0])[1] += count
+        finally:
+            self._lock.release()
+
+    def advance(self, unit, count=1):
+        """
+        Record completed units of work
+        @param unit: Unit name
+        @param count: Number of units completed
+        """
+        self._lock.acquire()
+        try:
+            self._units.setdefault(unit, [0, 0])[0] += count
+        finally:
+            self._lock.release()
+
+    def addBytes(self, count):
+        """
+        Record data copied
+        @param count: Number of bytes
+        """
+        self._lock.acquire()
+        try:
+            self._bytes += count
+        finally:
+            self._lock.release()
+
+    def getRemaining(self, now=None):
+        """
+        Estimate the time remaining. The estimated durations of the
+        completed tasks, and the elapsed part of the open tasks' estimates,
+        measure the work done. The remaining work is assumed to proceed at
+        the same rate.
+        @param now: Optional current time
+        @return The estimated number of seconds remaining, or None if there
+            is nothing to estimate from
+        """
+        if (now is None):
+            now = time.time()
+        total = 0.0
+        for key, estimate in self.estimates.iteritems():
+            if (key[0] == ESTIMATE_CATEGORY):
+                total += estimate
+        if (not total):
+            return None
+
+        done = 0.0
+        self._lock.acquire()
+        try:
+            for key in self._completed.iterkeys():
+                if (key[0] == ESTIMATE_CATEGORY):
+                    done += self.estimates.get(key, 0.0)
+            for name, key, started in self._running.itervalues():
+                if (key[0] == ESTIMATE_CATEGORY and self.estimates.has_key(key)):
+                    done += min(now - started, self.estimates[key])
+        finally:
+            self._lock.release()
+
+        elapsed = now - self.started
+        if (done <= 0 or elapsed <= 0):
+            return None
+        return max(total - done, 0.0) * elapsed / done
+
+    def getStatus(self, now=None):
+        """
+        @param now: Optional current time
+        @return A dictionary describing the run's progress
+        """
+        if (now is None):
+            now = time.time()
+        self._lock.acquire()
+        try:
+            # Most recently started first
+            running = self._running.values()
+            running.sort(lambda a, b: cmp(b[2], a[2]))
+            current = [name for name, key, started in running]
+            units = {}
+            for unit, (done, total) in self._units.iteritems():
+                units[unit] = {'done' : done, 'total' : total}
+            copied = self._bytes
+        finally:
+            self._lock.release()
+
+        return {
+            'action' : self.action,
+            'pid' : os.getpid(),
+            'started' : self.started,
+            'updated' : now,
+            'elapsed' : now - self.started,
+            'current' : current,
+            'units' : units,
+            'bytes' : copied,
+            'remaining' : self.getRemaining(now)
+        }
+
+def formatStatus(status):
+    """
+    @param status: Status dictionary returned by Progress.getStatus()
+    @return A one line summary of the status
+    """
+    parts = [history.formatDuration(status['elapsed'])]
+    current = status['current']
+    if (current):
+        task = current[0]
+        if (len(current) > 1):
+            task += ' (+%d)' % (len(current) - 1)
+        parts.append(task)
+    units = status['units'].keys()
+    units.sort()
+    for unit in units:
+        parts.append('%s %d/%d' % (unit, status['units'][unit]['done'], status['units'][unit]['total']))
+    if (status['bytes']):
+        parts.append(formatBytes(status['bytes']))
+    if (status['remaining'] is not None):
+        parts.append('ETA %s' % (history.formatDuration(status['remaining'])))
+    return ' | '.join(parts)
+
+def writeStatus(path, status):
+    """
+    Atomically replace a status file
+    @param path: Status file path
+    @param status: Status dictionary returned by Progress.getStatus()
+    """
+    if (trace.json is None):
+        raise ProgressError, "Writing a status file requires the json or simplejson module"
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        fd, tempPath = tempfile.mkstemp(prefix='.%s.' % (os.path.basename(path)), dir=directory)
+    except OSError, e:
+        raise ProgressError, "Could not create temporary status file in %s: %s" % (directory, e)
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            trace.json.dump(status, f)
+            f.write('\n')
+        finally:
+            f.close()
+        os.chmod(tempPath, 0644)
+        os.rename(tempPath, path)
+    except (IOError, OSError), e:
+        if (os.path.exists(tempPath)):
+            os.unlink(tempPath)
+        raise ProgressError, "Could not write status file %s: %s" % (path, e)
+
+class Reporter(object):
+    """
+    Periodically report a run's progress from a background thread
+    """
+    def __init__(self, progress, statusPath=None, console=None, interval=REPORT_INTERVAL):
+        """
+        Create a new Reporter instance
+        @param progress: Progress to report
+        @param statusPath: Optional path of a JSON status file to maintain
+        @param console: Optional terminal file to show a status line on
+        @param interval: Seconds between reports
+        """
+        self.progress = progress
+        self.statusPath = statusPath
+        self.console = console
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._error = None
+
+    def report(self, finished=False):
+        """
+        Report the current progress
+        @param finished: True if the run has finished
+        """
+        status = self.progress.getStatus()
+        status['finished'] = finished
+        if (self.statusPath is not None):
+            try:
+                writeStatus(self.statusPath, status)
+            except ProgressError, e:
+                # Warn once, rather than every interval
+                if (str(e) != self._error):
+                    print >>sys.stderr, "Warning: %s" % (e)
+                self._error = str(e)
+        if (self.console is not None):
+            if (finished):
+                line = ''
+            else:
+                line = formatStatus(status)[:STATUS_WIDTH]
+            self.console.write('\r%-*s\r' % (STATUS_WIDTH, line))
+            if (not finished):
+                # Leave the cursor after the status line
+                self.console.write(line)
+            self.console.flush()
+
+    def _run(self):
+        while (True):
+            self._stopped.wait(self.interval)
+            if (self._stopped.isSet()):
+                break
+            self.report()
+
+    def start(self):
+        """
+        Start reporting
+        """
+        self._thread = threading.Thread(target=self._run, name='progress')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop reporting, clearing the status line and marking the status
+        file finished
+        """
+        self._stopped.set()
+        if (self._thread):
+            self._thread.join()
+            self._thread = None
+        self.report(finished=True)
+
+# Progress of the current run, if any
+_progress = None
+
+def setProgress(progress):
+    """
+    Report units of work and data copied to a Progress
+    @param progress: Progress, or None
+    """
+    global _progress
+    _progress = progress
+
+def getProgress():
+    """
+    @return The current Progress, or None
+    """
+    return _progress
+
+def addTotal(unit, count):
+    """
+    Add to the amount of a unit of work known to the current run. Does
+    nothing if there is no Progress.
+    """
+    progress = _progress
+    if (progress is not None):
+        progress.addTotal(unit, count)
+
+def advance(unit, count=1):
+    """
+    Record completed units of work in the current run
+    """
+    progress = _progress
+    if (progress is not None):
+        progress.advance(unit, count)
+
+def addBytes(count):
+    """
+    Record data copied by the current run
+    """
+    progress = _progress
+    if (progress is not None):
+        progress.addBytes(count)
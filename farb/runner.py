@@ -30,9 +30,11 @@
 import glob
 import os
 import shutil
+import sys
+import threading
 
 import farb
-from farb import builder, sysinstall
+from farb import accounting, builder, logfile, metrics, progress, sysinstall, tftp, trace, utils
 
 # Exceptions
 class ReleaseBuildRunnerError(farb.FarbError):
@@ -44,6 +46,185 @@ class PackageBuildRunnerError(farb.FarbError):
 class NetInstallAssemblerRunnerError(farb.FarbError):
     pass
 
+class InstallRootRollbackRunnerError(farb.FarbError):
+    pass
+
+class InstallRootReplicationRunnerError(farb.FarbError):
+    pass
+
+class TFTPServerRunnerError(farb.FarbError):
+    pass
+
+class TaskSchedulerError(farb.FarbError):
+    pass
+
+# Build pipeline phases, in order
+PIPELINE_PHASES = ('release', 'package', 'install')
+
+# Serializes portsnap(8) snapshot fetches between concurrent package builds
+_portsnapLock = threading.Lock()
+
+# Serializes distfile fetches into the distfiles cache shared by concurrent
+# package builds
+_distfilesLock = threading.Lock()
+
+class Task(object):
+    """
+    A unit of work scheduled by a TaskScheduler
+    """
+    def __init__(self, name, function, dependencies):
+        """
+        Create a new Task instance
+        @param name: Unique task name
+        @param function: Callable that performs the task
+        @param dependencies: Names of the tasks that must complete first
+        """
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+
+class TaskScheduler(object):
+    """
+    Run a graph of tasks, starting each task once all of its dependencies
+    have completed, using up to maxJobs threads. Tasks are started in the
+    order they were added, as their dependencies allow. If a task raises
+    an exception, no further tasks are started, and the exception is
+    re-raised once the running tasks have finished.
+    """
+    def __init__(self, maxJobs=1):
+        """
+        Create a new TaskScheduler instance
+        @param maxJobs: Maximum number of tasks to run concurrently
+        """
+        self.maxJobs = maxJobs
+        self.tasks = []
+        self._names = {}
+
+    def add(self, name, function, dependencies=()):
+        """
+        Add a task to the graph
+        @param name: Unique task name
+        @param function: Callable that performs the task
+        @param dependencies: Names of the tasks that must complete first
+        @return The new Task
+        """
+        if (self._names.has_key(name)):
+            raise TaskSchedulerError, "Duplicate task \"%s\"" % (name)
+        task = Task(name, function, dependencies)
+        self.tasks.append(task)
+        self._names[name] = task
+        return task
+
+    def getOrder(self):
+        """
+        Verify the task graph, and compute the order in which the tasks
+        would be run by a single thread
+        @return A list of Tasks
+        """
+        for task in self.tasks:
+            for dependency in task.dependencies:
+                if (not self._names.has_key(dependency)):
+                    raise TaskSchedulerError, "Task \"%s\" depends on unknown task \"%s\"" % (task.name, dependency)
+
+        order = []
+        done = {}
+        pending = self.tasks[:]
+        while (pending):
+            for task in pending:
+                ready = True
+                for dependency in task.dependencies:
+                    if (not done.has_key(dependency)):
+                        ready = False
+                        break
+                if (ready):
+                    break
+            else:
+                raise TaskSchedulerError, "Tasks %s have circular dependencies" % (', '.join([task.name for task in pending]))
+            pending.remove(task)
+            done[task.name] = True
+            order.append(task)
+        return order
+
+    def _runTask(self, task):
+        span = trace.begin(task.name, 'task')
+        try:
+            task.function()
+        except:
+            trace.end(span, {'error' : str(sys.exc_info()[1])})
+            raise
+        trace.end(span)
+
+    def run(self):
+        """
+        Run all tasks
+        """
+        order = self.getOrder()
+        if (self.maxJobs <= 1):
+            for task in order:
+                self._runTask(task)
+            return
+
+        condition = threading.Condition()
+        done = {}
+        errors = []
+        state = {'running' : 0}
+
+        parent = trace.getCurrent()
+        labels = accounting.getLabels()
+
+        def worker(task):
+            trace.adopt(parent)
+            accounting.adopt(labels)
+            try:
+                try:
+                    self._runTask(task)
+                except:
+                    condition.acquire()
+                    try:
+                        errors.append(sys.exc_info())
+                    finally:
+                        condition.release()
+            finally:
+                condition.acquire()
+                try:
+                    done[task.name] = True
+                    state['running'] -= 1
+                    condition.notify()
+                finally:
+                    condition.release()
+
+        pending = order
+        condition.acquire()
+        try:
+            while True:
+                # Start every task whose dependencies have completed, as
+                # job slots allow
+                if (not errors):
+                    for task in pending[:]:
+                        if (state['running'] >= self.maxJobs):
+                            break
+                        ready = True
+                        for dependency in task.dependencies:
+                            if (not done.has_key(dependency)):
+                                ready = False
+                                break
+                        if (not ready):
+                            continue
+                        pending.remove(task)
+                        state['running'] += 1
+                        thread = threading.Thread(target=worker, args=(task,), name=task.name)
+                        thread.start()
+
+                if (state['running'] == 0):
+                    break
+                condition.wait()
+        finally:
+            condition.release()
+
+        if (errors):
+            type, value, traceback = errors[0]
+            raise type, value, traceback
+
 class BuildRunner(object):
     """
     BuildRunner abstract superclass.
@@ -54,9 +235,25 @@ class BuildRunner(object):
         # ZConfig instance of a parsed farbot config file
         self.config = config
     
+    def _getLogPath(self, path):
+        """
+        @param path: Uncompressed log path
+        @return The path the log is written to
+        """
+        return logfile.getPath(path, self.config.Releases.compresslogs)
+
+    def _openLog(self, path):
+        """
+        Open a buffered log file, compressed and rotated as configured
+        @param path: Log path, as returned by _getLogPath()
+        @return A logfile.LogFile
+        """
+        return logfile.LogFile(path, compress=self.config.Releases.compresslogs, maxSize=self.config.Releases.logrotatesize)
+
     def _closeLog(self):
         if self.log:
-            self.log.close()
+            # Don't replace the error being reported with one writing the log
+            self.log.close(warn=True)
 
 class ReleaseBuildRunner(BuildRunner):
     """
@@ -64,76 +261,99 @@ class ReleaseBuildRunner(BuildRunner):
     """
     def __init__(self, config):
         super(ReleaseBuildRunner, self).__init__(config)
-        # Used for MDMountCommand instance for the current release
-        self.isomount = None
     
-    def _copyFromISO(self, release):
+    def _copyFromISO(self, release, log):
+        """
+        Mount a release's ISO and copy its contents to the release root
+        @return The MDMountCommand for the mounted ISO
+        """
         # Create the ISOs mount point if needed
         mountpoint = os.path.join(release.buildroot, 'mnt')
         if (not os.path.exists(mountpoint)):
-            self.log.write("Creating mount point \"%s\" for ISO\n" % mountpoint)
+            log.write("Creating mount point \"%s\" for ISO\n" % mountpoint)
             os.mkdir(mountpoint)
 
         # Mount the ISO
-        self.log.write("Mount ISO at \"%s\"\n" % mountpoint)
+        log.write("Mount ISO at \"%s\"\n" % mountpoint)
         mdconfig = builder.MDConfigCommand(release.iso)                
-        self.isomount = builder.MDMountCommand(mdconfig, mountpoint, fstype='cd9660')
-        self.isomount.mount(self.log)
+        isomount = builder.MDMountCommand(mdconfig, mountpoint, fstype='cd9660')
+        isomount.mount(log)
     
         # Copy ISO contents to release directory
-        self.log.write("Release %s copying to %s\n" % (release.getSectionName(), release.releaseroot))
+        log.write("Release %s copying to %s\n" % (release.getSectionName(), release.releaseroot))
         isoReader = builder.ISOReader(mountpoint, release.releaseroot)
-        isoReader.copy(self.log)
-    
+        try:
+            isoReader.copy(log)
+        except:
+            isomount.umount(log)
+            raise
+        return isomount
+
+    def isUsed(self, release):
+        """
+        @param release: ZConfig Release section
+        @return True if the release is referenced by an Installation
+        """
+        releaseName = release.getSectionName()
+        for install in self.config.Installations.Installation:
+            if (releaseName == install.release.lower()):
+                return True
+        return False
+
+    @trace.traced('phase', lambda self, release: 'release %s' % (release.getSectionName()))
+    @accounting.labelled(lambda self, release: {'phase' : 'release', 'release' : release.getSectionName()})
+    @metrics.measured('release', lambda self, release: release.getSectionName())
+    def buildRelease(self, release):
+        """
+        Build a single release, or copy it from its ISO
+        @param release: ZConfig Release section
+        """
+        releaseName = release.getSectionName()
+        logPath = self._getLogPath(os.path.join(release.buildroot, 'build.log'))
+        log = None
+        isomount = None
+        try:
+            try:
+                # Create the build directory
+                if (not os.path.exists(release.buildroot)):
+                    os.makedirs(release.buildroot)
+        
+                # Open the build log file
+                log = self._openLog(logPath)
+        
+                if (release.binaryrelease):
+                    isomount = self._copyFromISO(release, log)
+                else:
+                    # Instantiate our builder
+                    log.write("Starting build of release %s\n" % releaseName)
+                    releaseBuilder = builder.ReleaseBuilder(release.cvsroot, release.cvstag, release.releaseroot, release.installcds)
+                    releaseBuilder.build(log)
+        
+            except builder.ReleaseBuildError, e:
+                 raise ReleaseBuildRunnerError, "Build of release %s failed: %s\nMore details may be found in %s" % (releaseName, e, logPath)
+            except builder.ISOReaderError, e:
+                 raise ReleaseBuildRunnerError, "Failed to copy release %s from ISO: %s\nMore details may be found in %s" % (releaseName, e, logPath)
+            except Exception, e:
+                 raise ReleaseBuildRunnerError, "Unhandled error while building release %s: %s\nMore details may be found in %s" % (releaseName, e, logPath)
+
+        finally:
+            # Unmount any ISO and detach its MD device.
+            if isomount:
+                log.write("Unmounting ISO at \"%s\"\n" % isomount.mountpoint)
+                isomount.umount(log)
+            
+            # Close our log file
+            if log:
+                log.close(warn=True)
+
     def run(self):
         # Iterate through all releases, starting a release build for all
         # releases referenced by an Installation.
         for release in self.config.Releases.Release:
-            releaseName = release.getSectionName()
-            
-            # Check all installations for a reference to this release
-            for install in self.config.Installations.Installation:
-                releaseFound = False
-                if (releaseName == install.release.lower()):
-                    releaseFound = True
-                    break
-            if (not releaseFound):
+            if (not self.isUsed(release)):
                 # Skip the release, it's not used by any installation
                 continue
-
-            logPath = os.path.join(release.buildroot, 'build.log')
-            try:
-                try:
-                    # Create the build directory
-                    if (not os.path.exists(release.buildroot)):
-                        os.makedirs(release.buildroot)
-            
-                    # Open the build log file
-                    self.log = open(logPath, 'w', 0)
-            
-                    if (release.binaryrelease):
-                        self._copyFromISO(release)
-                    else:
-                        # Instantiate our builder
-                        self.log.write("Starting build of release %s\n" % releaseName)
-                        releaseBuilder = builder.ReleaseBuilder(release.cvsroot, release.cvstag, release.releaseroot, release.installcds)
-                        releaseBuilder.build(self.log)
-            
-                except builder.ReleaseBuildError, e:
-                     raise ReleaseBuildRunnerError, "Build of release %s failed: %s\nMore details may be found in %s" % (releaseName, e, logPath)
-                except builder.ISOReaderError, e:
-                     raise ReleaseBuildRunnerError, "Failed to copy release %s from ISO: %s\nMore details may be found in %s" % (releaseName, e, logPath)
-                except Exception, e:
-                     raise ReleaseBuildRunnerError, "Unhandled error while building release %s: %s\nMore details may be found in %s" % (releaseName, e, logPath)
-
-            finally:
-                # Unmount any ISO and detach its MD device.
-                if self.isomount:
-                    self.log.write("Unmounting ISO at \"%s\"\n" % self.isomount.mountpoint)
-                    self.isomount.umount(self.log)
-                
-                # Close our log file
-                self._closeLog()
+            self.buildRelease(release)
 
 class PackageBuildRunner(BuildRunner):
     """
@@ -141,128 +361,191 @@ class PackageBuildRunner(BuildRunner):
     """
     def __init__(self, config):
         super(PackageBuildRunner, self).__init__(config)
+        self.distfilescache = None
+        if self.config.PackageSets:
+            self.distfilescache = self.config.PackageSets.distfilescache
     
-    def run(self):
+    def prepare(self):
+        """
+        Create the distfiles cache directory shared by the package builds
+        """
+        try:
+            # Create the distfiles cache directory if necessary
+            if (self.distfilescache and not os.path.exists(self.distfilescache)):
+                os.makedirs(self.distfilescache)
+        except Exception, e:
+            raise PackageBuildRunnerError, "Failed to create distfiles cache directory %s: %s" % (self.distfilescache, e)
+
+    @trace.traced('phase', lambda self, release: 'package %s' % (release.getSectionName()))
+    @accounting.labelled(lambda self, release: {'phase' : 'package', 'release' : release.getSectionName()})
+    @metrics.measured('package', lambda self, release: release.getSectionName())
+    def buildPackages(self, release):
+        """
+        Populate a release's package chroot, fetch its ports tree, and
+        build its packages and package images. The distfiles cache must
+        have been prepared.
+        @param release: ZConfig Release section
+        """
+        releaseName = release.getSectionName()
+        distfilescache = self.distfilescache
         devmount = None
         distfilesmount = None
+        log = None
+        built = 0
+        failed = 0
+
+        logPath = self._getLogPath(os.path.join(release.buildroot, 'packaging.log'))
+        try:
+            try:
+                # Open a packaging log file
+                log = self._openLog(logPath)
         
-        if self.config.PackageSets:
-            distfilescache = self.config.PackageSets.distfilescache
+                # Get list of distribution sets to use. If src or kernels 
+                # are the defined dist, we'll need to get a sub-list of 
+                # distribution sets from SourceDists and/or KernelDists
+                dists = sysinstall.DistSetConfig(release, self.config).distSets
         
-        try:
-            # Create the distfiles cache directory if necessary
-            if (distfilescache and not os.path.exists(distfilescache)):
-                os.makedirs(distfilescache)
-        except Exception, e:
-            raise builder.PackageBuildRunnerError, "Failed to create distfiles cache directory %s: %s" % (distfilescache, e)
+                # Populate a new package chroot from the release binaries we 
+                # built or extracted from an ISO.
+                log.write("Extracting release binaries to \"%s\"\n" % release.pkgroot)
+                assembler = builder.PackageChrootAssembler(release.releaseroot, release.pkgroot)
+                assembler.extract(dists, log)
+
+                # Mount devfs in the chroot
+                log.write("Mount devfs in \"%s\"\n" % release.pkgroot)
+                devmount = builder.MountCommand('devfs', os.path.join(release.pkgroot, 'dev'), fstype='devfs')
+                devmount.mount(log)
+                
+                # If we're using portsnap, run portsnap fetch now to get an 
+                # updated snapshot.
+                if (release.useportsnap):
+                    # Concurrent release package builds share portsnap's
+                    # snapshot
+                    _portsnapLock.acquire()
+                    try:
+                        log.write("Fetching up-to-date ports snapshot\n")
+                        pc = builder.PortsnapCommand()
+                        pc.fetch(log)
+            
+                        # Then portsnap extract a fresh ports tree in the chroot
+                        log.write("Extracting ports tree in \"%s\"\n" % release.portsdir)
+                        pc.extract(release.portsdir, log)
+                    finally:
+                        _portsnapLock.release()
+                
+                else:
+                    # Otherwise checkout the ports tree into the chroot with cvs
+                    log.write("%s release cvs checkout of \"%s\"\n" % (releaseName, release.portsdir))
+                    cvs = builder.CVSCommand(release.cvsroot)
+                    cvs.checkout('HEAD', 'ports', release.portsdir, log)
+                
+                # Mount distfiles cache directory in chroot if configured
+                if distfilescache:
+                    mntpoint = os.path.join(release.pkgroot, 'usr', 'ports', 'distfiles')
+                    
+                    # The distfiles directory should always need to be 
+                    # created because we are working with a freshly created 
+                    # ports tree. 
+                    log.write("Creating \"%s\" directory\n" % mntpoint)
+                    os.mkdir(mntpoint)
+                    
+                    log.write("Mount nullfs in \"%s\"\n" % release.pkgroot)
+                    nullfs = builder.MountCommand(distfilescache, mntpoint, fstype='nullfs')
+                    distfilesmount = nullfs
+                    nullfs.mount(log)
+                
+                # Make the packages directory. 
+                log.write("Creating \"%s\" directory\n" % release.packagedir)
+                os.mkdir(release.packagedir)
+                
+                # Fire off a builder for each package
+                for package in release.packages:
+                    log.write("Starting build of package \"%s\" for release \"%s\"\n" % (package.port, releaseName))
+
+                    # Grab the package build options
+                    buildoptions = {}
+                    if release.PackageBuildOptions:
+                        buildoptions.update(release.PackageBuildOptions.Options)
+                    if package.BuildOptions:
+                        buildoptions.update(package.BuildOptions.Options)
+
+                    # Build it
+                    pb = builder.PackageBuilder(release.pkgroot, package.port, buildoptions)
+                    try:
+                        # Concurrent release package builds share the
+                        # distfiles cache. Fetch into it one build at a
+                        # time, so that a distfile is never fetched by two
+                        # builds at once.
+                        if distfilescache:
+                            _distfilesLock.acquire()
+                            try:
+                                pb.fetch(log)
+                            finally:
+                                _distfilesLock.release()
+                        pb.build(log)
+                    except builder.PackageBuildError:
+                        failed += 1
+                        raise
+                    built += 1
+                    progress.advance('ports')
+
+                # Build package images for the release's installations
+                for install in self.config.Installations.Installation:
+                    if (install.release.lower() != releaseName or not install.packageimage):
+                        continue
+
+                    installConfig = sysinstall.InstallationConfig(install, self.config)
+                    if (not installConfig.packages):
+                        continue
+
+                    log.write("Building package image for installation \"%s\"\n" % (install.getSectionName()))
+                    imagePath = os.path.join(release.imagedir, install.getSectionName() + farb.PACKAGE_IMAGE_SUFFIX)
+                    pib = builder.PackageImageBuilder(release.releaseroot, release.packagedir, release.imageroot, installConfig.packages)
+                    pib.build(dists, imagePath, log)
+    
+            # Catch any exception. If it's from a command or package builder
+            # the relevant details should be contained in the exception 
+            # text.
+            except Exception, e:
+                raise PackageBuildRunnerError, "Package build for release %s failed: %s\nFor more information, refer to the package build log \"%s\"" % (releaseName, e, logPath)
+    
+        finally:
+            metrics.getRegistry().set('farbot_packages_built', built, {'release' : releaseName})
+            metrics.getRegistry().set('farbot_package_build_failures', failed, {'release' : releaseName})
+
+            # Unmount any devfs and distfiles nullfs mounts
+            if devmount:
+                log.write("Unmounting devfs at %s\n" % devmount.mountpoint)
+                devmount.umount(log)
+            if distfilesmount:
+                log.write("Unmounting distfiles cache at %s\n" % distfilesmount.mountpoint)
+                distfilesmount.umount(log)
+        
+            # Close our log file
+            if log:
+                log.close(warn=True)
+
+    def getPackageCount(self):
+        """
+        @return The number of packages to build, for all releases
+        """
+        count = 0
+        for release in self.config.Releases.Release:
+            if (release.packages):
+                count += len(release.packages)
+        return count
+
+    def run(self):
+        self.prepare()
+        progress.addTotal('ports', self.getPackageCount())
 
         # Iterate through all releases, starting a package build for all
         # listed packages
         for release in self.config.Releases.Release:
-            releaseName = release.getSectionName()
             # Grab the list of packages set by verifyPackages()
             if (not release.packages):
                 continue
-            
-            logPath = os.path.join(release.buildroot, 'packaging.log')
-            try:
-                try:
-                    # Open a packaging log file
-                    self.log = open(logPath, 'w', 0)
-            
-                    # Get list of distribution sets to use. If src or kernels 
-                    # are the defined dist, we'll need to get a sub-list of 
-                    # distribution sets from SourceDists and/or KernelDists
-                    dists = {}
-                    for dist in release.dists:
-                        if dist == 'src':
-                            dists[dist] = release.sourcedists
-                        elif dist == 'kernels':
-                            dists[dist] = release.kerneldists
-                        else:
-                            dists[dist] = [dist]
-            
-                    # Populate a new package chroot from the release binaries we 
-                    # built or extracted from an ISO.
-                    self.log.write("Extracting release binaries to \"%s\"\n" % release.pkgroot)
-                    assembler = builder.PackageChrootAssembler(release.releaseroot, release.pkgroot)
-                    assembler.extract(dists, self.log)
-
-                    # Mount devfs in the chroot
-                    self.log.write("Mount devfs in \"%s\"\n" % release.pkgroot)
-                    devmount = builder.MountCommand('devfs', os.path.join(release.pkgroot, 'dev'), fstype='devfs')
-                    devmount.mount(self.log)
-                    
-                    # If we're using portsnap, run portsnap fetch now to get an 
-                    # updated snapshot.
-                    if (release.useportsnap):
-                        self.log.write("Fetching up-to-date ports snapshot\n")
-                        pc = builder.PortsnapCommand()
-                        pc.fetch(self.log)
-                
-                        # Then portsnap extract a fresh ports tree in the chroot
-                        self.log.write("Extracting ports tree in \"%s\"\n" % release.portsdir)
-                        pc.extract(release.portsdir, self.log)
-                    
-                    else:
-                        # Otherwise checkout the ports tree into the chroot with cvs
-                        self.log.write("%s release cvs checkout of \"%s\"\n" % (releaseName, release.portsdir))
-                        cvs = builder.CVSCommand(release.cvsroot)
-                        cvs.checkout('HEAD', 'ports', release.portsdir, self.log)
-                    
-                    # Mount distfiles cache directory in chroot if configured
-                    if distfilescache:
-                        mntpoint = os.path.join(release.pkgroot, 'usr', 'ports', 'distfiles')
-                        
-                        # The distfiles directory should always need to be 
-                        # created because we are working with a freshly created 
-                        # ports tree. 
-                        self.log.write("Creating \"%s\" directory\n" % mntpoint)
-                        os.mkdir(mntpoint)
-                        
-                        self.log.write("Mount nullfs in \"%s\"\n" % release.pkgroot)
-                        nullfs = builder.MountCommand(distfilescache, mntpoint, fstype='nullfs')
-                        distfilesmount = nullfs
-                        nullfs.mount(self.log)
-                    
-                    # Make the packages directory. 
-                    self.log.write("Creating \"%s\" directory\n" % release.packagedir)
-                    os.mkdir(release.packagedir)
-                    
-                    # Fire off a builder for each package
-                    for package in release.packages:
-                        self.log.write("Starting build of package \"%s\" for release \"%s\"\n" % (package.port, releaseName))
-
-                        # Grab the package build options
-                        buildoptions = {}
-                        if release.PackageBuildOptions:
-                            buildoptions.update(release.PackageBuildOptions.Options)
-                        if package.BuildOptions:
-                            buildoptions.update(package.BuildOptions.Options)
-
-                        # Build it
-                        pb = builder.PackageBuilder(release.pkgroot, package.port, buildoptions)
-                        pb.build(self.log)
-        
-                # Catch any exception. If it's from a command or package builder
-                # the relevant details should be contained in the exception 
-                # text.
-                except Exception, e:
-                    raise PackageBuildRunnerError, "Package build for release %s failed: %s\nFor more information, refer to the package build log \"%s\"" % (releaseName, e, logPath)
-        
-            finally:
-                # Unmount any devfs and distfiles nullfs mounts
-                if devmount:
-                    self.log.write("Unmounting devfs at %s\n" % devmount.mountpoint)
-                    devmount.umount(self.log)
-                    devmount = None
-                if distfilesmount:
-                    self.log.write("Unmounting distfiles cache at %s\n" % distfilesmount.mountpoint)
-                    distfilesmount.umount(self.log)
-                    distfilesmount = None
-            
-                # Close our log file
-                self._closeLog()
+            self.buildPackages(release)
 
 class NetInstallAssemblerRunner(BuildRunner):
     """
@@ -271,21 +554,51 @@ class NetInstallAssemblerRunner(BuildRunner):
     def __init__(self, config):
         super(NetInstallAssemblerRunner, self).__init__(config)
 
+    @trace.traced('phase', 'install')
+    @accounting.labelled(lambda self: {'phase' : 'install'})
+    @metrics.measured('install')
     def run(self):
         liveReleases = {}
+        releaseDists = {}
         installAssemblers = []
         releaseAssemblers = []
 
-        logPath = os.path.join(self.config.Releases.buildroot, 'install.log')        
+        # Install root generation being assembled, until it is committed
+        uncommitted = None
+
+        logPath = self._getLogPath(os.path.join(self.config.Releases.buildroot, 'install.log'))
         try:
             try:
                 # Open the build log file
-                self.log = open(logPath, 'w', 0)
+                self.log = self._openLog(logPath)
 
-                # Clean the InstallRoot
-                if (os.path.exists(self.config.Releases.installroot)):
-                    for directory in os.listdir(self.config.Releases.installroot):
-                        shutil.rmtree(os.path.join(self.config.Releases.installroot, directory))
+                # Either assemble into a fresh install root generation, or
+                # clean the InstallRoot and assemble directly into it
+                generations = None
+                installroot = self.config.Releases.installroot
+                if (self.config.Releases.installrootgenerations):
+                    generations = builder.InstallRootGenerations(self.config.Releases.installroot, self.config.Releases.installrootgenerations)
+                    generation = generations.create(self.log)
+                    uncommitted = generation
+                    installroot = generations.getPath(generation)
+                elif (os.path.exists(self.config.Releases.installroot)):
+                    for entry in os.listdir(self.config.Releases.installroot):
+                        path = os.path.join(self.config.Releases.installroot, entry)
+                        if (os.path.isdir(path) and not os.path.islink(path)):
+                            shutil.rmtree(path)
+                        else:
+                            os.unlink(path)
+
+                # Decompressed mfsroot images are cached in the BuildRoot
+                mfsCache = os.path.join(self.config.Releases.buildroot, 'mfsroot-cache')
+
+                # Bootstrap install.cfg paths for shared release mfsroots
+                bootstrapConfigs = {}
+
+                # Kernel modules to install in the tftproot, or None for all
+                kernelModules = None
+                if (self.config.Releases.prunekernelmodules):
+                    kernelModules = self.config.Releases.kernelmodules
 
                 # Iterate through all installations
                 for install in self.config.Installations.Installation:
@@ -308,30 +621,274 @@ class NetInstallAssemblerRunner(BuildRunner):
                     installConfig.serialize(outputFile)
                     outputFile.close()
 
+                    # Add the installation's distribution sets to those
+                    # required from its release
+                    dists = releaseDists.setdefault(release.getSectionName(), {})
+                    for dist, subdists in installConfig.distSetConfig.distSets.iteritems():
+                        required = dists.setdefault(dist, [])
+                        for subdist in subdists:
+                            if (not subdist in required):
+                                required.append(subdist)
+
+                    # Generate the release's bootstrap install.cfg, if the
+                    # installation's install.cfg is to be loaded over NFS
+                    bootstrapConfigPath = None
+                    loaderVariables = {}
+                    if (self.config.Releases.sharedmfsroot):
+                        if (not bootstrapConfigs.has_key(release.getSectionName())):
+                            bootstrapConfig = sysinstall.BootstrapConfig()
+                            path = os.path.join(self.config.Releases.buildroot, '%s-bootstrap.cfg' % (release.getSectionName()))
+                            self.log.write("Generating bootstrap install configuration file %s\n" % path)
+                            outputFile = file(path, 'w')
+                            bootstrapConfig.serialize(outputFile)
+                            outputFile.close()
+                            bootstrapConfigs[release.getSectionName()] = path
+
+                        bootstrapConfigPath = bootstrapConfigs[release.getSectionName()]
+                        loaderVariables['netDev'] = install.networkdevice
+                        loaderVariables['nfs'] = installConfig.networkConfig.nfs
+
+                    # Batch package installations read their dependency
+                    # ordered package list from the release data
+                    packages = None
+                    if (install.batchpackages and installConfig.packages):
+                        packages = installConfig.packages
+
+                    # Package image installations extract the image built
+                    # with the release's packages
+                    packageImage = None
+                    if (install.packageimage and installConfig.packages):
+                        packageImage = os.path.join(release.imagedir, installName + farb.PACKAGE_IMAGE_SUFFIX)
+
                     # Instantiate the installation assembler
                     self.log.write("Beginning %s installation build\n" % installName)
-                    ia = builder.InstallAssembler(installName, install.description, release.releaseroot, installConfigPath)
+                    ia = builder.InstallAssembler(installName, install.description, release.releaseroot, installConfigPath, release=release.getSectionName(), mfsCache=mfsCache, bootstrapConfigPath=bootstrapConfigPath, loaderVariables=loaderVariables, compress=self.config.Releases.compressbootfiles, kernelModules=kernelModules, packages=packages, packageImage=packageImage)
                     installAssemblers.append(ia)
 
                 # Iterate over "live" releases
                 for releaseName, release in liveReleases.iteritems():
                     # Instantiate the release assembler
                     if (len(release.localdata)):
-                        ra = builder.ReleaseAssembler(releaseName, release.releaseroot, release.pkgroot, localData = release.localdata)
+                        ra = builder.ReleaseAssembler(releaseName, release.releaseroot, release.pkgroot, localData = release.localdata, dists = releaseDists[releaseName])
                     else:
-                        ra = builder.ReleaseAssembler(releaseName, release.releaseroot, release.pkgroot)
+                        ra = builder.ReleaseAssembler(releaseName, release.releaseroot, release.pkgroot, dists = releaseDists[releaseName])
 
                     releaseAssemblers.append(ra)
 
                 # Instantiate our NetInstall Assembler
-                nia = builder.NetInstallAssembler(self.config.Releases.installroot, releaseAssemblers, installAssemblers)
-                nia.build(self.log)
+                nia = builder.NetInstallAssembler(installroot, releaseAssemblers, installAssemblers, jobs=self.config.Releases.assemblerjobs, compress=self.config.Releases.compressbootfiles, kernelModules=kernelModules)
+
+                # Run the concurrent assemblers' commands from a single
+                # supervisor, which multiplexes their output into the log
+                # and cancels them all should one assembler fail
+                supervisor = None
+                if (self.config.Releases.assemblerjobs > 1):
+                    supervisor = builder.CommandSupervisor()
+                    supervisor.start()
+                    builder.setCommandSupervisor(supervisor)
+                try:
+                    nia.build(self.log)
+                finally:
+                    if (supervisor):
+                        builder.setCommandSupervisor(None)
+                        supervisor.stop()
+                        supervisor.close()
+
+                # Everything in the freshly assembled install root was
+                # copied in by this build
+                if (metrics.getPath()):
+                    metrics.getRegistry().set('farbot_installroot_copied_bytes', utils.getTreeSize(installroot))
+
+                # Serve the newly assembled generation
+                if (generations):
+                    generations.commit(generation, self.log)
+                    uncommitted = None
+
+                if (metrics.getPath()):
+                    metrics.getRegistry().set('farbot_installroot_size_bytes', utils.getTreeSize(self.config.Releases.installroot))
+
+                # Mirror the install root to the NFS mirrors
+                for mirror in self.config.Releases.NFSMirror:
+                    if (mirror.replicaroot):
+                        replicator = builder.InstallRootReplicator(self.config.Releases.installroot, mirror.replicaroot, jobs=self.config.Releases.replicationjobs)
+                        stats = replicator.replicate(self.log)
+                        metrics.getRegistry().set('farbot_replicated_bytes', stats.bytes, {'mirror' : mirror.getSectionName()})
             
             except builder.NetInstallAssembleError, e:
                 raise NetInstallAssemblerRunnerError, "Failure setting up installation data: %s.\nFor more information, refer to the installation assembler log \"%s\"" % (e, logPath)
+            except builder.InstallRootGenerationsError, e:
+                raise NetInstallAssemblerRunnerError, "Failure switching install root generations: %s.\nFor more information, refer to the installation assembler log \"%s\"" % (e, logPath)
+            except builder.InstallRootReplicatorError, e:
+                raise NetInstallAssemblerRunnerError, "Failure replicating the install root: %s.\nFor more information, refer to the installation assembler log \"%s\"" % (e, logPath)
             except Exception, e:
                 raise NetInstallAssemblerRunnerError, "Unhandled installation build error: %s" % (e)
 
+        finally:
+            # Remove a partly assembled generation
+            if (uncommitted is not None):
+                generations.discard(uncommitted, self.log)
+
+            # Close our log file
+            self._closeLog()
+
+class InstallRootRollbackRunner(BuildRunner):
+    """
+    Serve the previous generation of the installation root
+    """
+    def __init__(self, config):
+        super(InstallRootRollbackRunner, self).__init__(config)
+
+    def run(self):
+        """
+        @return The generation number now being served
+        """
+        logPath = self._getLogPath(os.path.join(self.config.Releases.buildroot, 'rollback.log'))
+        try:
+            try:
+                # Open the rollback log file
+                self.log = self._openLog(logPath)
+
+                generations = builder.InstallRootGenerations(self.config.Releases.installroot, self.config.Releases.installrootgenerations)
+                return generations.rollback(self.log)
+
+            except builder.InstallRootGenerationsError, e:
+                raise InstallRootRollbackRunnerError, "Failure rolling back the installation root: %s" % (e)
+            except Exception, e:
+                raise InstallRootRollbackRunnerError, "Unhandled installation root rollback error: %s" % (e)
+
+        finally:
+            # Close our log file
+            self._closeLog()
+
+class InstallRootReplicationRunner(BuildRunner):
+    """
+    Bring the NFS mirrors' copies of the installation root up to date
+    """
+    def __init__(self, config):
+        super(InstallRootReplicationRunner, self).__init__(config)
+
+    @trace.traced('phase', 'replicate')
+    @accounting.labelled(lambda self: {'phase' : 'replicate'})
+    @metrics.measured('replicate')
+    def run(self):
+        """
+        @return A list of (NFSMirror name, builder.ReplicationStats) tuples
+        """
+        mirrors = []
+        for mirror in self.config.Releases.NFSMirror:
+            if (mirror.replicaroot):
+                mirrors.append(mirror)
+        if (not mirrors):
+            raise InstallRootReplicationRunnerError, "No NFSMirror has a ReplicaRoot to replicate the installation root to"
+
+        logPath = self._getLogPath(os.path.join(self.config.Releases.buildroot, 'replicate.log'))
+        try:
+            try:
+                # Open the replication log file
+                self.log = self._openLog(logPath)
+
+                results = []
+                for mirror in mirrors:
+                    replicator = builder.InstallRootReplicator(self.config.Releases.installroot, mirror.replicaroot, jobs=self.config.Releases.replicationjobs)
+                    stats = replicator.replicate(self.log)
+                    metrics.getRegistry().set('farbot_replicated_bytes', stats.bytes, {'mirror' : mirror.getSectionName()})
+                    results.append((mirror.getSectionName(), stats))
+                return results
+
+            except builder.InstallRootReplicatorError, e:
+                raise InstallRootReplicationRunnerError, "Failure replicating the installation root: %s.\nFor more information, refer to the replication log \"%s\"" % (e, logPath)
+            except Exception, e:
+                raise InstallRootReplicationRunnerError, "Unhandled installation root replication error: %s" % (e)
+
+        finally:
+            # Close our log file
+            self._closeLog()
+
+class PipelineRunner(BuildRunner):
+    """
+    Run the release, package and installation phases as a graph of tasks,
+    overlapping the independent work of different releases. Each release's
+    packages are built once the release has been built, and the
+    installation root is assembled once every release's packages are
+    built.
+    """
+    def __init__(self, config, phases=PIPELINE_PHASES):
+        """
+        Create a new PipelineRunner instance
+        @param config: ZConfig Farbot Config
+        @param phases: Phases to run, from PIPELINE_PHASES
+        """
+        super(PipelineRunner, self).__init__(config)
+        self.phases = phases
+
+    def createScheduler(self):
+        """
+        @return A TaskScheduler containing the pipeline's tasks
+        """
+        scheduler = TaskScheduler(self.config.Releases.pipelinejobs)
+        rbr = ReleaseBuildRunner(self.config)
+        pbr = PackageBuildRunner(self.config)
+        installDependencies = []
+
+        if ('package' in self.phases):
+            scheduler.add('distfiles', pbr.prepare)
+
+        for release in self.config.Releases.Release:
+            releaseName = release.getSectionName()
+            dependencies = []
+
+            if ('release' in self.phases and rbr.isUsed(release)):
+                task = scheduler.add('release:%s' % (releaseName), lambda release=release: rbr.buildRelease(release))
+                dependencies = [task.name]
+
+            # Grab the list of packages set by verifyPackages()
+            if ('package' in self.phases and release.packages):
+                task = scheduler.add('package:%s' % (releaseName), lambda release=release: pbr.buildPackages(release), dependencies + ['distfiles'])
+                dependencies = [task.name]
+
+            installDependencies.extend(dependencies)
+
+        if ('install' in self.phases):
+            scheduler.add('install', NetInstallAssemblerRunner(self.config).run, installDependencies)
+
+        return scheduler
+
+    @trace.traced('phase', 'pipeline')
+    def run(self):
+        if ('package' in self.phases):
+            progress.addTotal('ports', PackageBuildRunner(self.config).getPackageCount())
+        self.createScheduler().run()
+
+class TFTPServerRunner(BuildRunner):
+    """
+    Serve the installation root's tftproot over TFTP
+    """
+    def __init__(self, config):
+        super(TFTPServerRunner, self).__init__(config)
+
+    def run(self):
+        """
+        Serve requests until interrupted
+        """
+        logPath = self._getLogPath(os.path.join(self.config.Releases.buildroot, 'tftp.log'))
+        try:
+            try:
+                # Open the TFTP server log file
+                self.log = self._openLog(logPath)
+
+                server = tftp.TFTPServer(self.config.Releases.tftproot, self.config.Releases.tftpaddress, self.log)
+                try:
+                    server.serveForever()
+                finally:
+                    server.close()
+
+            except tftp.TFTPServerError, e:
+                raise TFTPServerRunnerError, "Failure serving the tftproot: %s" % (e)
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                raise TFTPServerRunnerError, "Unhandled TFTP server error: %s" % (e)
+
         finally:
             # Close our log file
             self._closeLog()
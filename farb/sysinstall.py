@@ -30,6 +30,7 @@
 import copy
 import os
 import string
+import zlib
 import farb
 
 class ConfigSection(object):
@@ -104,15 +105,74 @@ class NetworkConfig(ConfigSection):
         self.netDev = section.networkdevice
 
         # FarBot-wide Options
-        self.nfshost = config.Releases.nfshost
+        self.nfshost = self._assignNFSHost(section, config)
         self.nfspath = os.path.join(config.Releases.installroot, section.release.lower())
         self.nfs = self.nfshost + ':' + self.nfspath
 
+    def _assignNFSHost(self, section, config):
+        """
+        Assign the installation to the NFSHost or one of the NFS mirrors,
+        using the configured NFSAssignment strategy:
+            roundrobin: By the installation's position in the configuration
+            pin: The installation's NFSMirror, or the NFSHost if unset
+            hash: By a hash of the installation's host name
+        @param section: ZConfig Installation section
+        @param config: ZConfig Farbot Config
+        @return The NFS host name
+        """
+        hosts = config.Releases.nfshosts
+        strategy = config.Releases.nfsassignment
+
+        if (strategy == 'pin'):
+            if (section.nfsmirror):
+                for mirror in config.Releases.NFSMirror:
+                    if (mirror.getSectionName() == section.nfsmirror.lower()):
+                        return mirror.host
+            return config.Releases.nfshost
+
+        if (strategy == 'hash'):
+            return hosts[(zlib.crc32(section.hostname) & 0xffffffff) % len(hosts)]
+
+        return hosts[config.Installations.Installation.index(section) % len(hosts)]
+
     def serialize(self, output):
         self._serializeOptions(output)
         self._serializeCommands(output)
 
 
+class BootstrapConfig(ConfigSection):
+    """
+    install.cfg(8) for an mfsroot shared by all installations of a
+    release. It mounts the release's NFS installation data and loads
+    the installation-specific install.cfg named by the configFile
+    variable. The configFile and nfs variables are set by each
+    installation's boot loader configuration, so that each installation
+    mounts the NFS host it is assigned to.
+    """
+    # Section option names
+    sectionOptions = (
+        'debug',
+        'nonInteractive',
+        'noWarn',
+        'tryDHCP'       # DHCP an address
+    )
+    # Default option values
+    debug = 'YES'
+    nonInteractive = 'YES'
+    noWarn = 'YES'
+    tryDHCP = 'YES'
+
+    # Section commands
+    sectionCommands = (
+        'mediaSetNFS',  # Select the NFS installation media
+        'mediaOpen',    # Mount it
+        'loadConfig'    # Load and execute configFile
+    )
+
+    def serialize(self, output):
+        self._serializeOptions(output)
+        self._serializeCommands(output)
+
 class DistSetConfig(ConfigSection):
     """
     install.cfg(8) distribution set configuration section.
@@ -134,6 +194,18 @@ class DistSetConfig(ConfigSection):
         @param release: ZConfig Release section
         @param config: ZConfig Farbot Config
         """
+        # Map of distribution set names to the names of the subdistribution
+        # sets to install. Distribution sets without subdistributions map to
+        # a list containing only their own name.
+        self.distSets = {}
+        for dist in release.dists:
+            if dist == 'src':
+                self.distSets[dist] = release.sourcedists
+            elif dist == 'kernels':
+                self.distSets[dist] = release.kerneldists
+            else:
+                self.distSets[dist] = [dist]
+
         # Flatten lists of dists, source dists, and kernel dists, inserting the 
         # sub lists after src or kernels. Not sure if it really necessary to have 
         # those sub lists in that exact location, but let's be safe.
@@ -273,7 +345,7 @@ class PackageConfig(SystemCommandConfig):
     We skip the sysinstall package installation code entirely and
     use a SystemCommand to call pkg_add(8) ourselves post-install.
     """
-    installPackageScript = os.path.join('/dist', os.path.basename(farb.INSTALL_PACKAGE_SH))
+    installPackageScript = os.path.join(farb.SYSINSTALL_MEDIA_PATH, os.path.basename(farb.INSTALL_PACKAGE_SH))
 
     def __init__(self, section):
         """
@@ -286,6 +358,50 @@ class PackageConfig(SystemCommandConfig):
         cmd = "%s %s" % (self.installPackageScript, self.package)
         super(PackageConfig, self).__init__(cmd)
 
+class PackageBatchConfig(SystemCommandConfig):
+    """
+    install.cfg(8) package install configuration section, installing
+    all of an installation's packages with a single SystemCommand.
+
+    This avoids starting a shell and sysinstall system command for
+    each package.
+    """
+    def __init__(self, packages, listPath=None):
+        """
+        Initialize batch package install configuration for a given
+        installation.
+        @param packages: List of package names, in installation order
+        @param listPath: Optional path of a file listing the packages to
+            install, one per line, in place of the package names
+        """
+        self.packages = packages
+        self.listPath = listPath
+        if (listPath):
+            # /dist/install_package.sh -l <package list>
+            cmd = "%s -l %s" % (PackageConfig.installPackageScript, listPath)
+        else:
+            # /dist/install_package.sh <package name> [<package name> ...]
+            cmd = "%s %s" % (PackageConfig.installPackageScript, ' '.join(packages))
+        super(PackageBatchConfig, self).__init__(cmd)
+
+class PackageImageConfig(SystemCommandConfig):
+    """
+    install.cfg(8) package install configuration section, extracting an
+    image of all of an installation's installed packages with a single
+    SystemCommand.
+    """
+    tarPath = '/usr/bin/tar'
+
+    def __init__(self, imagePath):
+        """
+        Initialize package image configuration for a given installation.
+        @param imagePath: Path to the installation's package image
+        """
+        # /usr/bin/tar -xpzf <package image> -C /
+        self.imagePath = imagePath
+        cmd = "%s -xpzf %s -C /" % (self.tarPath, imagePath)
+        super(PackageImageConfig, self).__init__(cmd)
+
 class InstallationConfig(ConfigSection):
     """
     InstallationConfig instances represent a
@@ -357,6 +473,20 @@ class InstallationConfig(ConfigSection):
                 pkgc = PackageConfig(package)
                 self.packageConfigs.append(pkgc)
 
+        # Names of all packages, in package set order
+        self.packages = [pkgc.package for pkgc in self.packageConfigs]
+
+        # Extract all installed packages from the package image built with
+        # the packages, or install all packages in one pass, from the
+        # package list written to the release data directory when the
+        # installation is assembled
+        if (section.packageimage and self.packageConfigs):
+            imagePath = os.path.join(farb.SYSINSTALL_MEDIA_PATH, farb.PACKAGE_IMAGE_DIR, self.name + farb.PACKAGE_IMAGE_SUFFIX)
+            self.packageConfigs = [PackageImageConfig(imagePath)]
+        elif (section.batchpackages and self.packageConfigs):
+            listPath = os.path.join(farb.SYSINSTALL_MEDIA_PATH, farb.INSTALL_CONFIG_DIR, self.name + farb.PACKAGE_LIST_SUFFIX)
+            self.packageConfigs = [PackageBatchConfig(self.packages, listPath)]
+
         # System Commands
         self.systemCommandConfigs = []
         if (section.PostInstall):
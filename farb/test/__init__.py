@@ -29,7 +29,7 @@
 
 import os
 
-__all__ = ['test_builder', 'test_config', 'test_runner', 'test_sysinstall', 'test_utils']
+__all__ = ['test_accounting', 'test_builder', 'test_config', 'test_history', 'test_logfile', 'test_metrics', 'test_pkgindex', 'test_profiling', 'test_progress', 'test_runner', 'test_sysinstall', 'test_tftp', 'test_trace', 'test_ufs', 'test_utils']
 
 # Useful Constants
 INSTALL_DIR = os.path.dirname(__file__)
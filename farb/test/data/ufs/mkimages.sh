@@ -0,0 +1,21 @@
+#!/bin/sh
+# Generate the UFS1 and UFS2 image fixtures used by test_ufs.py.
+# Run on FreeBSD; makefs(8) is used rather than newfs(8) so that the
+# images don't depend on the running system's disk devices, and don't
+# pick up metadata check hashes, which farb.ufs doesn't support.
+
+set -e
+
+cd `dirname $0`
+root=`mktemp -d -t ufsroot`
+trap "rm -rf $root" EXIT
+
+mkdir $root/etc
+printf 'Welcome to the test image.\n' > $root/etc/motd
+printf 'hostname="fixture"\n' > $root/etc/rc.conf
+
+for version in 1 2; do
+    rm -f ufs$version.img ufs$version.img.gz
+    makefs -t ffs -s 4m -o version=$version,bsize=8192,fsize=1024 ufs$version.img $root
+    gzip -9 ufs$version.img
+done
@@ -0,0 +1,132 @@
+# test_accounting.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Resource Accounting Unit Tests """
+
+import os
+import StringIO
+import unittest
+
+from farb import accounting, builder
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+SH_PATH = '/bin/sh'
+ACCOUNTING_LOG = os.path.join(DATA_DIR, 'accounting.log')
+
+class Labelled(object):
+    def __init__(self, port):
+        self.port = port
+
+    @accounting.labelled(lambda self, log: {'port' : self.port})
+    def build(self, log):
+        return builder._runCommand([SH_PATH, '-c', 'true'], log, builder.CommandError)
+
+class ResourceUsageTestCase(unittest.TestCase):
+    def test_add(self):
+        """ Test that times are summed and the maximum RSS is kept """
+        usage = accounting.ResourceUsage(1.0, 0.5, 0.25, 1000, 1, 2, 3, 4)
+        usage.add(accounting.ResourceUsage(2.0, 1.5, 0.75, 500, 10, 20, 30, 40))
+        self.assertEquals(usage.commands, 2)
+        self.assertEquals(usage.wallTime, 3.0)
+        self.assertEquals(usage.userTime, 2.0)
+        self.assertEquals(usage.systemTime, 1.0)
+        self.assertEquals(usage.maxRSS, 1000)
+        self.assertEquals((usage.inBlocks, usage.outBlocks), (11, 22))
+        self.assertEquals((usage.voluntarySwitches, usage.involuntarySwitches), (33, 44))
+
+    def test_copy(self):
+        """ Test that a copy is independent of the original """
+        usage = accounting.ResourceUsage(1.0, 0.5)
+        copy = usage.copy()
+        copy.add(usage)
+        self.assertEquals(usage.asDict()['commands'], 1)
+        self.assertEquals(copy.asDict()['commands'], 2)
+        self.assertEquals(copy.userTime, 1.0)
+
+class AccountantTestCase(unittest.TestCase):
+    def test_record(self):
+        """ Test aggregation by phase, release and port """
+        accountant = accounting.Accountant()
+        labels = {'phase' : 'package', 'release' : '6.2', 'port' : 'net/samba3'}
+        accountant.record(accounting.ResourceUsage(1.0, 1.0), labels)
+        accountant.record(accounting.ResourceUsage(2.0, 2.0), labels)
+        accountant.record(accounting.ResourceUsage(4.0, 4.0), {'phase' : 'release', 'release' : '6.2'})
+        accountant.record(accounting.ResourceUsage(8.0, 8.0), {'phase' : 'install'})
+
+        self.assertEquals(accountant.totals['phase']['package'].userTime, 3.0)
+        self.assertEquals(accountant.totals['phase']['install'].commands, 1)
+        self.assertEquals(accountant.totals['release']['6.2'].commands, 3)
+        self.assertEquals(accountant.totals['release']['6.2'].wallTime, 7.0)
+        self.assertEquals(accountant.totals['port'].keys(), ['net/samba3 (6.2)'])
+
+    def test_writeSummary(self):
+        """ Test the summary table """
+        accountant = accounting.Accountant()
+        output = StringIO.StringIO()
+        accountant.writeSummary(output)
+        self.assertEquals(output.getvalue(), '')
+
+        accountant.record(accounting.ResourceUsage(1.0, 1.0, maxRSS=2048), {'phase' : 'release'})
+        accountant.writeSummary(output)
+        lines = output.getvalue().splitlines()
+        self.assertEquals(lines[0], 'Resource usage by phase:')
+        self.assertEquals(lines[1].split()[:2], ['phase', 'commands'])
+        self.assertEquals(lines[2].split()[:6], ['release', '1', '1.0', '1.0', '0.0', '2.0'])
+        self.assertEquals(len(lines), 3)
+
+class CommandAccountingTestCase(unittest.TestCase):
+    def setUp(self):
+        accounting.reset()
+        self.log = open(ACCOUNTING_LOG, 'w+')
+
+    def tearDown(self):
+        self.log.close()
+        os.unlink(ACCOUNTING_LOG)
+        accounting.reset()
+
+    def test_commandUsage(self):
+        """ Test that a command's resource usage is returned and recorded """
+        result = Labelled('net/samba3').build(self.log)
+        self.assertNotEquals(result.usage, None)
+        self.assert_(result.usage.userTime >= 0)
+        self.assert_(result.usage.maxRSS > 0)
+
+        totals = accounting.getAccountant().totals
+        self.assertEquals(totals['port']['net/samba3'].commands, 1)
+        self.assertEquals(totals['phase'], {})
+        self.assertEquals(accounting.getLabels(), {})
+
+    def test_unlabelled(self):
+        """ Test that commands run without labels are not aggregated """
+        builder._runCommand([SH_PATH, '-c', 'true'], self.log, builder.CommandError)
+        totals = accounting.getAccountant().totals
+        for dimension in accounting.DIMENSIONS:
+            self.assertEquals(totals[dimension], {})
@@ -29,15 +29,24 @@
 
 """ Builder Unit Tests """
 
+import errno
+import gzip
 import os
+import re
 import shutil
+import sys
+import tarfile
+import time
 import unittest
+from distutils.spawn import find_executable
 
 import farb
-from farb import builder, utils
+from farb import builder, pkgindex, ufs, utils
 
 # Useful Constants
 from farb.test import DATA_DIR, CMD_DIR, rewrite_config
+from farb.test.test_pkgindex import makePackage
+from farb.test.test_ufs import makeImage
 
 FREEBSD_REL_PATH = os.path.join(DATA_DIR, 'buildtest')
 PROCESS_LOG = os.path.join(FREEBSD_REL_PATH, 'process.log')
@@ -78,6 +87,197 @@ builder.PORTSNAP_PATH = PORTSNAP_PATH
 builder.TAR_PATH = TAR_PATH
 builder.CHFLAGS_PATH = CHFLAGS_PATH
 builder.ROOT_PATH = ROOT_PATH
+builder.PKG_ADD_PATH = ECHO_PATH
+
+# Timestamp prefixed to each line of command output in the log
+LOG_TIMESTAMP = re.compile(r'^\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\] ')
+
+# Exit status logged for each command, following the job name, if any
+LOG_STATUS = re.compile(r'^(\[[^]]+\] )?Command \S+ (exited with code|was cancelled) ')
+
+def readCommandOutput(log):
+    """
+    Read the lines of command output written to a log, without their
+    timestamps and the commands' exit status
+    @param log: Open log file
+    """
+    log.seek(0)
+    lines = []
+    for line in log:
+        match = LOG_TIMESTAMP.match(line)
+        if (match is None):
+            continue
+        line = line[match.end():]
+        if (LOG_STATUS.match(line)):
+            continue
+        lines.append(line)
+    return lines
+
+class RunCommandTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = open(PROCESS_LOG, 'w+')
+
+    def tearDown(self):
+        self.log.close()
+        os.unlink(PROCESS_LOG)
+
+    def test_output(self):
+        result = builder._runCommand([SH_PATH, '-c', 'echo out; echo err >&2'], self.log, builder.CommandError)
+        self.assertEquals(result.exitCode, 0)
+        self.assert_(result.duration >= 0)
+        self.assertEquals(result.output, None)
+        lines = readCommandOutput(self.log)
+        lines.sort()
+        self.assertEquals(lines, ['err\n', 'out\n'])
+        # The exit status is logged
+        self.log.seek(0)
+        self.assert_(self.log.read().find('Command %s exited with code 0' % (SH_PATH)) != -1)
+
+    def test_returnOut(self):
+        # Output larger than a pipe buffer must not block the command
+        script = 'import sys; sys.stdout.write("x" * 1048576); sys.stderr.write("done\\n")'
+        result = builder._runCommand([sys.executable, '-c', script], self.log, builder.CommandError, returnOut=True)
+        self.assertEquals(result.output, 'x' * 1048576)
+        self.assertEquals(readCommandOutput(self.log), ['done\n'])
+
+    def test_tee(self):
+        result = builder._runCommand([ECHO_PATH, 'tee'], self.log, builder.CommandError, returnOut=True, tee=True)
+        self.assertEquals(result.output, 'tee\n')
+        self.assertEquals(readCommandOutput(self.log), ['tee\n'])
+
+    def test_input(self):
+        input = ['a' * 100000, 'b' * 100000]
+        result = builder._runCommand(['/bin/cat'], self.log, builder.CommandError, returnOut=True, input=input)
+        self.assertEquals(result.output, ''.join(input))
+
+    def test_exitCode(self):
+        self.assertRaises(builder.CommandError, builder._runCommand, [SH_PATH, '-c', 'exit 3'], self.log, builder.CommandError)
+
+class FullLog(object):
+    """ A log on a full disk """
+    def write(self, data):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+class CommandSupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = open(PROCESS_LOG, 'w+')
+        self.supervisor = builder.CommandSupervisor()
+
+    def tearDown(self):
+        builder.setCommandSupervisor(None)
+        self.supervisor.close()
+        self.log.close()
+        os.unlink(PROCESS_LOG)
+
+    def test_concurrent(self):
+        started = time.time()
+        first = self.supervisor.submit([SH_PATH, '-c', 'sleep 0.5; echo first'], self.log, builder.CommandError, name='first')
+        second = self.supervisor.submit([SH_PATH, '-c', 'sleep 0.5; echo second'], self.log, builder.CommandError, name='second')
+        self.supervisor.run()
+        self.assert_(time.time() - started < 0.9)
+        self.assertEquals(first.wait().exitCode, 0)
+        self.assertEquals(second.wait().exitCode, 0)
+        # Each job's output is prefixed with its name
+        lines = readCommandOutput(self.log)
+        lines.sort()
+        self.assertEquals(lines, ['[first] first\n', '[second] second\n'])
+
+    def test_maxJobs(self):
+        self.supervisor.maxJobs = 1
+        started = time.time()
+        for i in range(2):
+            self.supervisor.submit([SH_PATH, '-c', 'sleep 0.3'], self.log, builder.CommandError)
+        self.supervisor.run()
+        self.assert_(time.time() - started >= 0.6)
+
+    def test_cancel(self):
+        self.supervisor.maxJobs = 1
+        running = self.supervisor.submit([SH_PATH, '-c', 'exec sleep 10'], self.log, builder.CommandError)
+        queued = self.supervisor.submit([ECHO_PATH, 'queued'], self.log, builder.CommandError)
+        self.supervisor.poll(0)
+        started = time.time()
+        queued.cancel()
+        running.cancel()
+        self.supervisor.run()
+        self.assert_(time.time() - started < 5)
+        self.assert_(running.isDone() and queued.isDone())
+        self.assertRaises(builder.CommandError, running.wait)
+        self.assertRaises(builder.CommandError, queued.wait)
+        self.assertEquals(readCommandOutput(self.log), [])
+
+    def test_logBackpressure(self):
+        # Output is read no faster than it can be logged, and none is lost
+        self.supervisor.logBufferSize = 1024
+        script = 'import sys\nfor i in range(10000): sys.stdout.write("%d\\n" % i)'
+        job = self.supervisor.submit([sys.executable, '-c', script], self.log, builder.CommandError)
+        self.supervisor.run()
+        job.wait()
+        self.assertEquals(readCommandOutput(self.log), ['%d\n' % i for i in range(10000)])
+
+    def test_background(self):
+        # Commands run by concurrent jobs share the supervisor
+        self.supervisor.start()
+        builder.setCommandSupervisor(self.supervisor)
+        try:
+            jobs = []
+            for i in range(2):
+                jobs.append(lambda: builder._runCommand([SH_PATH, '-c', 'sleep 0.3; echo done'], self.log, builder.CommandError))
+            builder._runJobs(jobs, 2)
+        finally:
+            builder.setCommandSupervisor(None)
+            self.supervisor.stop()
+        lines = readCommandOutput(self.log)
+        lines.sort()
+        self.assertEquals(lines, ['[job1] done\n', '[job2] done\n'])
+
+    def test_backgroundFailure(self):
+        # A failed job cancels the other jobs' commands
+        self.supervisor.start()
+        builder.setCommandSupervisor(self.supervisor)
+        started = time.time()
+        try:
+            jobs = [
+                lambda: builder._runCommand([SH_PATH, '-c', 'exec sleep 10'], self.log, builder.CommandError),
+                lambda: builder._runCommand([SH_PATH, '-c', 'sleep 0.2; exit 1'], self.log, builder.CommandError)
+            ]
+            self.assertRaises(builder.CommandError, builder._runJobs, jobs, 2)
+        finally:
+            builder.setCommandSupervisor(None)
+            self.supervisor.stop()
+        self.assert_(time.time() - started < 5)
+
+    def test_logFailure(self):
+        # A job whose log can't be written fails, without stopping the
+        # loop or leaving its caller waiting
+        self.supervisor.start()
+        builder.setCommandSupervisor(self.supervisor)
+        try:
+            failed = self.supervisor.submit([ECHO_PATH, 'failed'], FullLog(), builder.CommandError)
+            job = self.supervisor.submit([ECHO_PATH, 'logged'], self.log, builder.CommandError)
+            self.assertRaises(IOError, failed.wait)
+            self.assertEquals(job.wait().exitCode, 0)
+        finally:
+            builder.setCommandSupervisor(None)
+            self.supervisor.stop()
+        self.assertEquals(readCommandOutput(self.log), ['logged\n'])
+
+    def test_loopFailure(self):
+        # If the loop itself fails, every queued job is failed
+        self.supervisor.maxJobs = 1
+        def poll(timeout=None):
+            raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+        self.supervisor.poll = poll
+        self.supervisor.start()
+        try:
+            first = self.supervisor.submit([ECHO_PATH, 'first'], self.log, builder.CommandError)
+            second = self.supervisor.submit([ECHO_PATH, 'second'], self.log, builder.CommandError)
+            self.supervisor._thread.join(5)
+            self.assertRaises(OSError, first.wait)
+            self.assertRaises(OSError, second.wait)
+            # Jobs submitted later fail at once
+            self.assertRaises(OSError, self.supervisor.submit([ECHO_PATH, 'late'], self.log, builder.CommandError).wait)
+        finally:
+            self.supervisor.stop()
 
 class CVSCommandTestCase(unittest.TestCase):
     def setUp(self):
@@ -113,8 +313,7 @@ class MountCommandTestCase(unittest.TestCase):
 
     def test_mount(self):
         self.mc.mount(self.log)
-        self.log.seek(0)
-        self.assertEquals(self.log.read(), '/dev/md0\n/mnt/md0\n')
+        self.assertEquals(''.join(readCommandOutput(self.log)), '/dev/md0\n/mnt/md0\n')
 
     def test_umount(self):
         self.mc.umount(self.log)
@@ -130,8 +329,7 @@ class MountCommandTypeTestCase(unittest.TestCase):
 
     def test_mount(self):
         self.mc.mount(self.log)
-        self.log.seek(0)
-        self.assertEquals(self.log.read(), 'devfs\n/dev\ndevfs\n')
+        self.assertEquals(''.join(readCommandOutput(self.log)), 'devfs\n/dev\ndevfs\n')
 
 class MDMountCommandTestCase(unittest.TestCase):
     def setUp(self):
@@ -187,10 +385,9 @@ class MakeCommandTestCase(unittest.TestCase):
         (head, tail) = os.path.split(BUILDROOT)
         mc = builder.MakeCommand(os.path.sep + tail, ('makecommand',), chrootdir=head) 
         mc.make(self.log)
-        self.log.seek(0)
         # take just the first line as make tells us what directories it
         # is entering and exiting on certain platforms
-        self.assertEquals(self.log.read().splitlines(1)[0], '%s %s %s -C %s makecommand\n' % (CHROOT_PATH, head, builder.MAKE_PATH, os.path.sep + tail))
+        self.assertEquals(readCommandOutput(self.log)[0], '%s %s %s -C %s makecommand\n' % (CHROOT_PATH, head, builder.MAKE_PATH, os.path.sep + tail))
 
 class PortsnapCommandTestCase(unittest.TestCase):
 	def setUp(self):
@@ -409,12 +606,69 @@ class PackageBuilderTestCase(unittest.TestCase):
         o = open(PROCESS_OUT, 'r')
         self.assertEquals(o.read(), 'PackageBuilder: 1 2\n')
         o.close()
+
+    def test_fetch(self):
+        self.builder.fetch(self.log)
+        o = open(PROCESS_OUT, 'r')
+        self.assertEquals(o.read(), 'PackageFetcher: 1 2\n')
+        o.close()
+
+    def test_fetchFailure(self):
+        self.builder.fetchTarget = ('error',)
+        self.assertRaises(builder.PackageBuildError, self.builder.fetch, self.log)
     
     def test_buildFailure(self):
         # Reach into our builder and force an implosion
         self.builder.makeTarget = ('error',)
         self.assertRaises(builder.PackageBuildError, self.builder.build, self.log)
 
+class PackageImageBuilderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = open(PROCESS_LOG, 'w+')
+        self.imageroot = os.path.join(BUILDROOT, 'imageroot')
+        self.packagedir = os.path.join(BUILDROOT, 'packages')
+        self.image = os.path.join(BUILDROOT, 'images', 'test.tgz')
+        self.dists = {'base' : ['base']}
+        # Copy in a release to RELEASEROOT
+        rewrite_config(CDROM_INF_IN, CDROM_INF, {'@CD_VERSION_LINE@' : 'CD_VERSION = 6.2-RELEASE'})
+        utils.copyRecursive(ISO_MOUNTPOINT, os.path.join(RELEASEROOT, builder.RELEASE_CD_PATH))
+        makePackage(self.packagedir, 'perl-5.8.8', 'lang/perl5.8', latest='perl')
+        makePackage(self.packagedir, 'sudo-1.6.9', 'security/sudo', ['perl-5.8.8'], latest='sudo')
+
+        # The fake tar can't create archives; use the real one
+        builder.TAR_PATH = find_executable('tar')
+
+    def tearDown(self):
+        builder.TAR_PATH = TAR_PATH
+        self.log.close()
+        if (os.path.exists(PROCESS_LOG)):
+            os.unlink(PROCESS_LOG)
+        for path in (self.imageroot, self.packagedir, os.path.dirname(self.image), RELEASEROOT):
+            if (os.path.exists(path)):
+                shutil.rmtree(path)
+        if (os.path.exists(CDROM_INF)):
+            os.unlink(CDROM_INF)
+
+    def test_build(self):
+        pib = builder.PackageImageBuilder(os.path.abspath(RELEASEROOT), self.packagedir, self.imageroot, ['sudo'])
+        pib.build(self.dists, self.image, self.log)
+
+        # The packages were installed in dependency order
+        installed = [line.strip() for line in readCommandOutput(self.log) if line.startswith('/mnt/')]
+        self.assertEquals(installed, ['/mnt/All/perl-5.8.8.tbz', '/mnt/All/sudo-1.6.9.tbz'])
+
+        # The installed packages were archived, and the chroot discarded
+        tar = tarfile.open(self.image, 'r:gz')
+        names = tar.getnames()
+        tar.close()
+        self.assert_('usr/local' in names)
+        self.assert_('var/db/pkg' in names)
+        self.assertEquals(os.listdir(self.imageroot), [])
+
+    def test_buildUnknownPackage(self):
+        pib = builder.PackageImageBuilder(RELEASEROOT, self.packagedir, self.imageroot, ['emacs'])
+        self.assertRaises(builder.PackageImageBuildError, pib.build, self.dists, self.image, self.log)
+
 class InstallAssemblerTestCase(unittest.TestCase):
     def setUp(self):
         self.log = open(PROCESS_LOG, 'w+')
@@ -461,12 +715,131 @@ class InstallAssemblerTestCase(unittest.TestCase):
         # Check to see if the install.cfg got copied to the mountPoint
         self.assert_(os.path.exists(self.installCfg))
 
+        # Check to see if boot.conf was created, and that it references the
+        # release's shared kernel
+        self.assert_(os.path.exists(self.bootConf))
+        o = open(self.bootConf, 'r')
+        self.assert_('bootfile="/releases/6.2-RELEASE/kernel/kernel"\n' in o.readlines())
+        o.close()
+
+    def test_buildShared(self):
+        shareddir = os.path.join(TFTPROOT, self.builder.getSharedBootDir())
+        self.builder.buildShared(shareddir, self.log)
+
         # Check to see if the kernel module was copied
-        kmod = os.path.join(self.destdir, 'kernel', 'righthook.ko')
+        kmod = os.path.join(shareddir, 'kernel', 'righthook.ko')
         self.assert_(os.path.exists(kmod))
 
-        # Check to see if boot.conf was created
-        self.assert_(os.path.exists(self.bootConf))
+        # Building again replaces the previous copy
+        self.builder.buildShared(shareddir, self.log)
+        self.assert_(os.path.exists(kmod))
+
+    def test_buildCached(self):
+        mfsCache = os.path.join(TFTPROOT, 'mfsroot-cache')
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, mfsCache=mfsCache)
+        ia.build(self.destdir, self.log)
+
+        # Make sure the decompressed image was cached
+        self.assertEquals(len(os.listdir(mfsCache)), 1)
+
+        # Build a second installation from the cached image
+        otherdir = os.path.join(TFTPROOT, 'otherinstall')
+        os.mkdir(otherdir)
+        ia = builder.InstallAssembler('otherinstall', 'Other Install', RELEASEROOT, INSTALL_CFG, mfsCache=mfsCache)
+        ia.build(otherdir, self.log)
+        self.assertEquals(len(os.listdir(mfsCache)), 1)
+
+        for mfsroot in (self.mfsroot, os.path.join(otherdir, 'mfsroot')):
+            o = open(mfsroot, 'r')
+            self.assertEquals(o.read(), 'Uncompress worked.\n')
+            o.close()
+
+    def test_buildUFS(self):
+        # Replace the release's mfsroot with a real file system image
+        makeImage(self.mfsroot, ufs2=True)
+        output = gzip.GzipFile(self.builder.mfsCompressed, 'wb')
+        input = open(self.mfsroot, 'rb')
+        output.write(input.read())
+        input.close()
+        output.close()
+
+        # The install.cfg is written without mounting the image
+        self.builder.build(self.destdir, self.log)
+        self.assert_(not os.path.exists(os.path.join(self.destdir, 'mnt')))
+
+        image = ufs.UFSImage(self.mfsroot)
+        installConfig = open(INSTALL_CFG, 'r')
+        self.assertEquals(image.readFile('/install.cfg'), installConfig.read())
+        installConfig.close()
+        image.close()
+
+    def test_buildSharedMFSRoot(self):
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, bootstrapConfigPath=INSTALL_CFG, loaderVariables={'netDev' : 'em0'})
+        shareddir = os.path.join(TFTPROOT, ia.getSharedBootDir())
+        ia.buildShared(shareddir, self.log)
+        self.assert_(os.path.exists(os.path.join(shareddir, 'mfsroot')))
+
+        # The installation only gets a boot.conf, referencing the shared
+        # mfsroot and its install.cfg
+        ia.build(self.destdir, self.log)
+        self.assert_(not os.path.exists(self.mfsroot))
+        o = open(self.bootConf, 'r')
+        lines = o.readlines()
+        o.close()
+        self.assert_('mfsroot_name="/releases/6.2-RELEASE/mfsroot"\n' in lines)
+        self.assert_('configFile="/dist/install/testinstall.cfg"\n' in lines)
+        self.assert_('netDev="em0"\n' in lines)
+
+        # The install.cfg is copied to the release data
+        releasedir = os.path.join(TFTPROOT, 'releasedata')
+        os.mkdir(releasedir)
+        ia.buildReleaseData(releasedir, self.log)
+        self.assert_(os.path.exists(os.path.join(releasedir, 'install', 'testinstall.cfg')))
+
+    def test_buildSharedPruned(self):
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, kernelModules=[])
+        shareddir = os.path.join(TFTPROOT, ia.getSharedBootDir())
+        ia.buildShared(shareddir, self.log)
+        self.assert_(os.path.exists(os.path.join(shareddir, 'kernel', 'kernel')))
+        self.assert_(not os.path.exists(os.path.join(shareddir, 'kernel', 'righthook.ko')))
+
+        # Allowed modules are installed
+        shutil.rmtree(shareddir)
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, kernelModules=['righthook'])
+        ia.buildShared(shareddir, self.log)
+        self.assert_(os.path.exists(os.path.join(shareddir, 'kernel', 'righthook.ko')))
+
+    def test_buildPackageList(self):
+        releasedir = os.path.join(TFTPROOT, 'releasedata')
+        packagedir = os.path.join(releasedir, 'packages')
+        makePackage(packagedir, 'perl-5.8.8', 'lang/perl5.8', latest='perl')
+        makePackage(packagedir, 'sudo-1.6.9', 'security/sudo', ['perl-5.8.8'], latest='sudo')
+        index = pkgindex.PackageIndex()
+        index.scan(packagedir)
+        index.write(os.path.join(packagedir, pkgindex.INDEX_NAME))
+
+        # The packages and their dependencies are listed in installation order
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, packages=['sudo'])
+        ia.buildReleaseData(releasedir, self.log)
+        self.assertEquals(open(os.path.join(releasedir, ia.getPackageListName())).read(), '/dist/packages/All/perl-5.8.8.tbz\n/dist/packages/All/sudo-1.6.9.tbz\n')
+        self.assert_(not os.path.exists(os.path.join(releasedir, ia.getInstallConfigName())))
+
+        # Unknown packages can not be resolved
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, packages=['emacs'])
+        self.assertRaises(builder.InstallAssembleError, ia.buildReleaseData, releasedir, self.log)
+
+        # Package images are copied to the release data
+        image = os.path.join(TFTPROOT, 'test.tgz')
+        open(image, 'w').close()
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, packageImage=image)
+        ia.buildReleaseData(releasedir, self.log)
+        self.assert_(os.path.exists(os.path.join(releasedir, 'images', 'testinstall.tgz')))
+
+        # Without an index, packages are listed by name
+        shutil.rmtree(packagedir)
+        ia = builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, packages=['sudo'])
+        ia.buildReleaseData(releasedir, self.log)
+        self.assertEquals(open(os.path.join(releasedir, ia.getPackageListName())).read(), 'sudo\n')
 
     def test_buildFailure(self):
         # Reach into our builder and force an implosion
@@ -513,6 +886,30 @@ class ReleaseAssemblerTestCase(unittest.TestCase):
         # Verify that the local directory was not created
         self.assert_(not os.path.exists(os.path.join(self.destdir, 'local')))
 
+    def test_buildPackageIndex(self):
+        packagedir = os.path.join(PKGROOT, builder.RELEASE_PACKAGE_PATH)
+        makePackage(packagedir, 'sudo-1.6.9', 'security/sudo', latest='sudo')
+        try:
+            rib = builder.ReleaseAssembler('6.2', RELEASEROOT, PKGROOT)
+            rib.build(self.destdir, self.log)
+        finally:
+            shutil.rmtree(os.path.join(PKGROOT, 'usr'))
+
+        # Verify that the packages were copied and indexed
+        self.assert_(os.path.exists(os.path.join(self.destdir, 'packages', 'All', 'sudo-1.6.9.tbz')))
+        index = pkgindex.PackageIndex()
+        index.read(os.path.join(self.destdir, 'packages', pkgindex.INDEX_NAME))
+        self.assertEquals(index.getPackage('sudo').origin, 'security/sudo')
+
+    def test_buildDists(self):
+        # Copy only the given distribution sets
+        rib = builder.ReleaseAssembler('6.2', RELEASEROOT, PKGROOT, dists={'base' : ['base'], 'src' : ['szomg']})
+        rib.build(self.destdir, self.log)
+        self.assert_(os.path.exists(os.path.join(self.destdir, 'base', 'base.ac')))
+        self.assert_(os.path.exists(os.path.join(self.destdir, 'src', 'szomg.ab')))
+        self.assert_(not os.path.exists(os.path.join(self.destdir, 'src', 'swtf.aa')))
+        self.assert_(not os.path.exists(os.path.join(self.destdir, 'kernels')))
+
     def test_buildLocalData(self):
         # Copy in a regular file and a directory
         localData = [RELEASEROOT, INSTALL_CFG]
@@ -560,10 +957,16 @@ class NetInstallAssemblerTestCase(unittest.TestCase):
 
         tftproot = os.path.join(INSTALLROOT, 'tftproot')
 
+        ## Verify Per-Release Boot Data
+        # Check to see if the release kernel module was copied
+        kmod = os.path.join(tftproot, 'releases', '6.2-RELEASE', 'kernel', 'righthook.ko')
+        self.failUnless(os.path.exists(kmod), msg='The per-release kernel was not copied to the tftproot directory.')
+
+        # Check that the shared kernel is not stored twice
+        bootkmod = os.path.join(tftproot, 'boot', 'kernel', 'righthook.ko')
+        self.assertEquals(os.stat(kmod).st_ino, os.stat(bootkmod).st_ino)
+
         ## Verify Per-Install Data
-        # Check to see if the install kernel module was copied
-        kmod = os.path.join(tftproot, 'testinstall', 'kernel', 'righthook.ko')
-        self.failUnless(os.path.exists(kmod), msg='The pre-install kernel was not copied to the tftproot directory.')
 
         # Check to see if boot.conf was created
         self.failUnless(os.path.exists(os.path.join(tftproot, 'testinstall', 'boot.conf')), msg='The per-install boot.conf file was not created.')
@@ -577,6 +980,225 @@ class NetInstallAssemblerTestCase(unittest.TestCase):
         self.failUnless(os.path.exists(os.path.join(tftproot, 'boot', 'loader.conf')), msg='The FarBot loader.conf file was not copied to the tftproot directory.')
         self.failUnless(os.path.exists(os.path.join(tftproot, 'boot', 'loader.rc')), msg='The FarBot loader.rc file was not copied to the tftproot directory.')
 
+    def test_buildConcurrent(self):
+        installs = [
+            builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG),
+            builder.InstallAssembler('otherinstall', 'Other Install', RELEASEROOT, INSTALL_CFG),
+            builder.InstallAssembler('thirdinstall', 'Third Install', RELEASEROOT, INSTALL_CFG)
+        ]
+        irb = builder.NetInstallAssembler(INSTALLROOT, self.releaseInstalls, installs, jobs=3)
+        irb.build(self.log)
+
+        self.assert_(os.path.exists(os.path.join(INSTALLROOT, '6.2', 'base', 'base.aa')))
+        for install in installs:
+            self.assert_(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', install.name, 'mfsroot')))
+
+    def test_buildCompressed(self):
+        installs = [builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, compress=True),]
+        irb = builder.NetInstallAssembler(INSTALLROOT, self.releaseInstalls, installs, compress=True)
+        irb.build(self.log)
+
+        tftproot = os.path.join(INSTALLROOT, 'tftproot')
+        self.assert_(os.path.exists(os.path.join(tftproot, 'testinstall', 'mfsroot.gz')))
+        self.assert_(not os.path.exists(os.path.join(tftproot, 'testinstall', 'mfsroot')))
+
+        # Identical compressed kernels are still shared
+        kmod = os.path.join(tftproot, 'releases', '6.2-RELEASE', 'kernel', 'righthook.ko.gz')
+        bootkmod = os.path.join(tftproot, 'boot', 'kernel', 'righthook.ko.gz')
+        self.assertEquals(os.stat(kmod).st_ino, os.stat(bootkmod).st_ino)
+
+    def test_buildPruned(self):
+        installs = [builder.InstallAssembler('testinstall', 'Test Install', RELEASEROOT, INSTALL_CFG, kernelModules=[]),]
+        irb = builder.NetInstallAssembler(INSTALLROOT, self.releaseInstalls, installs, kernelModules=[])
+        irb.build(self.log)
+
+        tftproot = os.path.join(INSTALLROOT, 'tftproot')
+        self.assert_(os.path.exists(os.path.join(tftproot, 'boot', 'kernel', 'kernel')))
+        self.assert_(not os.path.exists(os.path.join(tftproot, 'boot', 'kernel', 'righthook.ko')))
+        self.assert_(not os.path.exists(os.path.join(tftproot, 'releases', '6.2-RELEASE', 'kernel', 'righthook.ko')))
+
+    def test_buildConcurrentFailure(self):
+        install = builder.InstallAssembler('badinstall', 'Bad Install', RELEASEROOT, INSTALL_CFG)
+        install.mfsCompressed = '/nonexistent'
+        installs = [self.installs[0], install]
+        irb = builder.NetInstallAssembler(INSTALLROOT, self.releaseInstalls, installs, jobs=2)
+        self.assertRaises(builder.NetInstallAssembleError, irb.build, self.log)
+
+class KernelKeepFilesTestCase(unittest.TestCase):
+    def test_kernelKeepFiles(self):
+        keep = builder._kernelKeepFiles(['if_em'])
+        self.assert_(keep.has_key('kernel'))
+        self.assert_(keep.has_key('if_em.ko'))
+        # Referenced by boot.conf
+        self.assert_(keep.has_key('acpi.ko'))
+        self.assert_(not keep.has_key('righthook.ko'))
+
+class InstallRootGenerationsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = open(PROCESS_LOG, 'w+')
+        os.mkdir(INSTALLROOT)
+        self.generations = builder.InstallRootGenerations(INSTALLROOT, 2)
+
+    def tearDown(self):
+        self.log.close()
+
+        # Clean up process log
+        if (os.path.exists(PROCESS_LOG)):
+            os.unlink(PROCESS_LOG)
+
+        # Clean up the install root
+        if (os.path.exists(INSTALLROOT)):
+            shutil.rmtree(INSTALLROOT)
+
+    def _build(self, content):
+        """
+        Assemble a fake generation containing a release and a tftproot
+        """
+        generation = self.generations.create(self.log)
+        path = self.generations.getPath(generation)
+        utils.copyRecursive(os.path.join(ISO_MOUNTPOINT, '6.2-RELEASE'), os.path.join(path, '6.2'))
+        os.mkdir(os.path.join(path, 'tftproot'))
+        f = open(os.path.join(path, 'tftproot', 'boot.conf'), 'w')
+        f.write(content)
+        f.close()
+        self.generations.commit(generation, self.log)
+        return generation
+
+    def _read(self):
+        f = open(os.path.join(INSTALLROOT, 'tftproot', 'boot.conf'), 'r')
+        content = f.read()
+        f.close()
+        return content
+
+    def test_commit(self):
+        self.assertEquals(self._build('first'), 1)
+        self.assertEquals(self.generations.getCurrent(), 1)
+        self.assert_(os.path.islink(os.path.join(INSTALLROOT, '6.2')))
+        self.assert_(os.path.exists(os.path.join(INSTALLROOT, '6.2', 'base', 'base.aa')))
+        self.assertEquals(self._read(), 'first')
+
+    def test_sharedFiles(self):
+        self._build('first')
+        self._build('second')
+        # Unchanged release data is shared, changed files are not
+        first = os.stat(os.path.join(self.generations.getPath(1), '6.2', 'base', 'base.aa'))
+        second = os.stat(os.path.join(self.generations.getPath(2), '6.2', 'base', 'base.aa'))
+        self.assertEquals(first.st_ino, second.st_ino)
+        first = os.stat(os.path.join(self.generations.getPath(1), 'tftproot', 'boot.conf'))
+        second = os.stat(os.path.join(self.generations.getPath(2), 'tftproot', 'boot.conf'))
+        self.assertNotEquals(first.st_ino, second.st_ino)
+
+    def test_discard(self):
+        self._build('first')
+        generation = self.generations.create(self.log)
+        self.generations.discard(generation, self.log)
+        self.assertEquals(self.generations.getGenerations(), [1])
+        # The served generation is kept
+        self.generations.discard(1, self.log)
+        self.assertEquals(self.generations.getGenerations(), [1])
+
+    def test_rollback(self):
+        self._build('first')
+        self._build('second')
+        self.assertEquals(self._read(), 'second')
+        self.assertEquals(self.generations.rollback(self.log), 1)
+        self.assertEquals(self._read(), 'first')
+
+    def test_rollbackOldest(self):
+        self._build('first')
+        self.assertRaises(builder.InstallRootGenerationsError, self.generations.rollback, self.log)
+
+    def test_prune(self):
+        self._build('first')
+        self._build('second')
+        self._build('third')
+        self.assertEquals(self.generations.getGenerations(), [2, 3])
+        self.assertEquals(self._read(), 'third')
+
+    def test_replaceInstallRoot(self):
+        # Directories left over from a non-generational build are replaced
+        os.mkdir(os.path.join(INSTALLROOT, 'tftproot'))
+        self._build('first')
+        self.assertEquals(self._read(), 'first')
+
+class InstallRootReplicatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = open(PROCESS_LOG, 'w+')
+        os.mkdir(INSTALLROOT)
+        self.replicaroot = INSTALLROOT + '.replica'
+        os.mkdir(self.replicaroot)
+        self.replicator = builder.InstallRootReplicator(INSTALLROOT, self.replicaroot, jobs=2)
+
+    def tearDown(self):
+        self.log.close()
+
+        # Clean up process log
+        if (os.path.exists(PROCESS_LOG)):
+            os.unlink(PROCESS_LOG)
+
+        # Clean up the install root and replica
+        for path in (INSTALLROOT, self.replicaroot):
+            if (os.path.exists(path)):
+                shutil.rmtree(path)
+
+    def _build(self):
+        """
+        Assemble a generation containing a release
+        """
+        generations = builder.InstallRootGenerations(INSTALLROOT, 2)
+        generation = generations.create(self.log)
+        path = generations.getPath(generation)
+        utils.copyRecursive(os.path.join(ISO_MOUNTPOINT, '6.2-RELEASE'), os.path.join(path, '6.2'))
+        generations.commit(generation, self.log)
+
+    def test_replicate(self):
+        self._build()
+
+        # Stale replica content is removed
+        os.mkdir(os.path.join(self.replicaroot, 'stale'))
+
+        stats = self.replicator.replicate(self.log)
+        self.assert_(stats.files > 0)
+        self.assertEquals(stats.removed, 1)
+        # Generation links are resolved and the generations are not copied
+        self.assert_(not os.path.islink(os.path.join(self.replicaroot, '6.2')))
+        self.assert_(os.path.exists(os.path.join(self.replicaroot, '6.2', 'base', 'base.aa')))
+        self.assert_(not os.path.exists(os.path.join(self.replicaroot, builder.GENERATIONS_DIR)))
+        self.assert_(not os.path.exists(os.path.join(self.replicaroot, 'stale')))
+        self.assertEquals(self.replicator.readManifest(), self.replicator.getManifest()[0])
+
+    def test_replicateDelta(self):
+        self._build()
+        self.replicator.replicate(self.log)
+
+        # Nothing changed
+        stats = self.replicator.replicate(self.log)
+        self.assertEquals((stats.files, stats.bytes, stats.removed), (0, 0, 0))
+
+        # Only the changed file is copied, removed files are deleted
+        basedir = os.path.join(INSTALLROOT, '6.2', 'base')
+        f = open(os.path.join(basedir, 'base.aa'), 'a')
+        f.write('changed')
+        f.close()
+        os.unlink(os.path.join(INSTALLROOT, '6.2', 'base', 'base.ac'))
+        stats = self.replicator.replicate(self.log)
+        self.assertEquals((stats.files, stats.removed), (1, 1))
+        self.assertEquals(stats.bytes, os.path.getsize(os.path.join(basedir, 'base.aa')))
+        self.assert_(not os.path.exists(os.path.join(self.replicaroot, '6.2', 'base', 'base.ac')))
+
+    def test_replicateWithoutManifest(self):
+        # A replica without a manifest is compared by its contents
+        self._build()
+        self.replicator.replicate(self.log)
+        os.unlink(os.path.join(self.replicaroot, builder.REPLICA_MANIFEST))
+        stats = self.replicator.replicate(self.log)
+        self.assertEquals(stats.files, 0)
+        self.assert_(os.path.exists(os.path.join(self.replicaroot, builder.REPLICA_MANIFEST)))
+
+    def test_replicateFailure(self):
+        self.replicator.replicaroot = os.path.join(self.replicaroot, 'missing')
+        self.assertRaises(builder.InstallRootReplicatorError, self.replicator.replicate, self.log)
+
 class GetCDReleaseTestCase(unittest.TestCase):
     def tearDown(self):
         if (os.path.exists(CDROM_INF)):
@@ -63,9 +63,23 @@ CONFIG_SUBS = {
     '@PORTSOURCE@' : 'UsePortsnap True',
     '@ISO@' : 'ISO ' + os.path.join(DATA_DIR, 'fake_cd.iso'),
     '@DISTFILESCACHE@' : 'DistfilesCache ' + os.path.join(BUILDROOT, 'distfiles'),
-    '@DISTS@' : 'src base kernels'
+    '@DISTS@' : 'src base kernels',
+    '@GENERATIONS@' : '',
+    '@SHAREDMFSROOT@' : '',
+    '@NFSMIRRORS@' : '',
+    '@NFSMIRRORPIN@' : ''
 }
 
+# NFS mirror configuration, for use as the @NFSMIRRORS@ substitution
+NFS_MIRRORS = """
+	<NFSMirror Mirror1>
+		Host	10.0.50.2
+	</NFSMirror>
+	<NFSMirror Mirror2>
+		Host	10.0.50.3
+	</NFSMirror>
+"""
+
 class ConfigParsingTestCase(unittest.TestCase):
     def setUp(self):
         # Load ZConfig schema
@@ -269,3 +283,60 @@ class ConfigParsingTestCase(unittest.TestCase):
 
         # Kaboom?
         self.assertRaises(ZConfig.ConfigurationError, config.verifyReferences, self.config)
+
+    def test_nfsMirrors(self):
+        """ Load a configuration with NFS mirrors """
+        subs = CONFIG_SUBS.copy()
+        subs['@NFSMIRRORS@'] = 'NFSAssignment Hash\n' + NFS_MIRRORS
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        self.config, handler = ZConfig.loadConfig(self.schema, RELEASE_CONFIG_FILE)
+        self.assertEquals(self.config.Releases.nfsassignment, 'hash')
+        self.assertEquals(self.config.Releases.nfshosts, [self.config.Releases.nfshost, '10.0.50.2', '10.0.50.3'])
+
+    def test_nfsAssignment(self):
+        """ Test handling of an invalid NFSAssignment """
+        subs = CONFIG_SUBS.copy()
+        subs['@NFSMIRRORS@'] = 'NFSAssignment Random'
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        self.assertRaises(ZConfig.ConfigurationError, ZConfig.loadConfig, self.schema, RELEASE_CONFIG_FILE)
+
+    def test_missingNFSMirror(self):
+        """
+        Test handling of a missing pinned NFSMirror
+        """
+        # Break referential integrity
+        subs = CONFIG_SUBS.copy()
+        subs['@NFSMIRRORS@'] = NFS_MIRRORS
+        subs['@NFSMIRRORPIN@'] = 'NFSMirror DoesNotExist'
+
+        # Rewrite and reload config
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        self.config, handler = ZConfig.loadConfig(self.schema, RELEASE_CONFIG_FILE)
+
+        # Kaboom?
+        self.assertRaises(ZConfig.ConfigurationError, config.verifyReferences, self.config)
+
+    def test_history(self):
+        """ Test the run history defaults """
+        self.config, handler = ZConfig.loadConfig(self.schema, RELEASE_CONFIG_FILE)
+        self.assertEquals(self.config.Releases.historydatabase, os.path.join(self.config.Releases.buildroot, 'history.sqlite'))
+        self.assertEquals(self.config.Releases.historywindow, 10)
+        self.assertEquals(self.config.Releases.regressionthreshold, 50)
+
+    def test_historyWindow(self):
+        """ Test handling of an invalid HistoryWindow """
+        subs = CONFIG_SUBS.copy()
+        subs['@NFSMIRRORS@'] = 'HistoryWindow 0'
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        self.assertRaises(ZConfig.ConfigurationError, ZConfig.loadConfig, self.schema, RELEASE_CONFIG_FILE)
+
+    def test_logRotateSize(self):
+        """ Test handling of an invalid LogRotateSize """
+        self.config, handler = ZConfig.loadConfig(self.schema, RELEASE_CONFIG_FILE)
+        self.assertEquals(self.config.Releases.compresslogs, False)
+        self.assertEquals(self.config.Releases.logrotatesize, None)
+
+        subs = CONFIG_SUBS.copy()
+        subs['@NFSMIRRORS@'] = 'LogRotateSize 0'
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        self.assertRaises(ZConfig.ConfigurationError, ZConfig.loadConfig, self.schema, RELEASE_CONFIG_FILE)
@@ -0,0 +1,198 @@
+# test_history.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Run History Unit Tests """
+
+import os
+import StringIO
+import unittest
+
+from farb import accounting, history, trace
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+HISTORY_FILE = os.path.join(DATA_DIR, 'history.sqlite')
+
+class Labelled(object):
+    def __init__(self, port):
+        self.port = port
+
+    @trace.traced('step', 'build package %(port)s')
+    def build(self, fail=False):
+        if (fail):
+            raise history.HistoryError, "boom"
+
+    @accounting.labelled(lambda self, release: {'release' : release})
+    def buildRelease(self, release):
+        self.build()
+
+def makeTasks(durations, outcome=history.OUTCOME_SUCCEEDED):
+    """
+    @param durations: Dictionary of step names and durations
+    @return List of (Task, started) tuples
+    """
+    tasks = []
+    started = 0
+    for name, duration in durations.items():
+        tasks.append((history.Task('step', name, '6.2', duration, outcome), started))
+        started += duration
+    return tasks
+
+class MedianTestCase(unittest.TestCase):
+    def test_median(self):
+        self.assertEquals(history.median([3]), 3)
+        self.assertEquals(history.median([5, 1, 3]), 3)
+        self.assertEquals(history.median([4, 1, 3, 2]), 2.5)
+
+    def test_formatDuration(self):
+        self.assertEquals(history.formatDuration(1.25), '1.2s')
+        self.assertEquals(history.formatDuration(125), '2:05')
+        self.assertEquals(history.formatDuration(3725), '1:02:05')
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.history = history.History(HISTORY_FILE)
+
+    def tearDown(self):
+        self.history.close()
+        os.unlink(HISTORY_FILE)
+
+    def _addRuns(self, durations):
+        run = None
+        for duration in durations:
+            run = self.history.addRun('release', 0, duration, history.OUTCOME_SUCCEEDED, makeTasks({'build package net/samba3' : duration, 'build package www/apache22' : 60.0}))
+        return run
+
+    def test_getRuns(self):
+        """ Test that runs are returned newest first """
+        self._addRuns([10.0, 20.0, 30.0])
+        runs = self.history.getRuns(2)
+        self.assertEquals([run.getDuration() for run in runs], [30.0, 20.0])
+        self.assertEquals(runs[0].action, 'release')
+
+        # Runs persist
+        self.history.close()
+        self.history = history.History(HISTORY_FILE)
+        self.assertEquals(len(self.history.getRuns()), 3)
+
+    def test_getTasks(self):
+        """ Test the median of the previous runs' durations """
+        run = self._addRuns([60.0, 70.0, 80.0, 150.0])
+        tasks = self.history.getTasks(run.id, window=2)
+        self.assertEquals(len(tasks), 2)
+        samba = [task for task in tasks if task.name == 'build package net/samba3'][0]
+        self.assertEquals(samba.duration, 150.0)
+        self.assertEquals(samba.median, 75.0)
+        self.assertEquals(samba.samples, 2)
+        self.assertEquals(samba.getChange(), 100.0)
+
+        # The first run has nothing to compare against
+        first = self.history.getTasks(self.history.getRuns()[-1].id)
+        self.assertEquals(first[0].median, None)
+        self.assert_(not first[0].isRegression())
+
+    def test_findRegressions(self):
+        """ Test flagging of tasks slower than their median """
+        run = self._addRuns([60.0, 62.0, 58.0, 100.0])
+        regressions = self.history.findRegressions(run.id)
+        self.assertEquals([task.name for task in regressions], ['build package net/samba3'])
+        self.assertEquals(self.history.findRegressions(run.id, threshold=80), [])
+        self.assertEquals(self.history.findRegressions(run.id, minDuration=120), [])
+
+    def test_failedTasks(self):
+        """ Test that failed tasks neither regress nor count towards the median """
+        self._addRuns([60.0])
+        self.history.addRun('release', 0, 1000.0, history.OUTCOME_FAILED, makeTasks({'build package net/samba3' : 1000.0}, history.OUTCOME_FAILED))
+        run = self._addRuns([70.0])
+        tasks = self.history.getTasks(run.id)
+        self.assertEquals(tasks[0].median, 60.0)
+
+        failed = self.history.getTasks(run.id - 1)
+        self.assert_(not failed[0].isRegression())
+
+    def test_getEstimates(self):
+        """ Test estimating task durations from the last successful run """
+        self.assertEquals(self.history.getEstimates('release'), {})
+        self._addRuns([60.0, 70.0, 80.0])
+        self.history.addRun('release', 0, 10.0, history.OUTCOME_FAILED, makeTasks({'build package net/samba3' : 10.0}, history.OUTCOME_FAILED))
+        estimates = self.history.getEstimates('release', window=2)
+        self.assertEquals(estimates[('step', 'build package net/samba3', '6.2')], 75.0)
+        self.assertEquals(estimates[('step', 'build package www/apache22', '6.2')], 60.0)
+        self.assertEquals(self.history.getEstimates('install'), {})
+
+        # Runs of different phases are estimated separately
+        self.history.addRun('release+package+install', 0, 10.0, history.OUTCOME_SUCCEEDED, makeTasks({'assemble install root' : 10.0}))
+        self.assertEquals(self.history.getEstimates('release', window=2).has_key(('step', 'assemble install root', '6.2')), False)
+        self.assertEquals(self.history.getEstimates('release+package+install').keys(), [('step', 'assemble install root', '6.2')])
+
+    def test_writeReport(self):
+        """ Test the history report """
+        output = StringIO.StringIO()
+        self.assertEquals(history.writeReport(self.history, output), 0)
+        self.assertEquals(output.getvalue(), 'No runs recorded in %s.\n' % (HISTORY_FILE))
+
+        self._addRuns([60.0, 62.0, 58.0, 100.0])
+        output = StringIO.StringIO()
+        self.assertEquals(history.writeReport(self.history, output), 1)
+        lines = output.getvalue().splitlines()
+        flagged = [line for line in lines if line.startswith('  !')]
+        self.assertEquals(len(flagged), 1)
+        self.assert_(flagged[0].find('net/samba3 (6.2)') != -1)
+        self.assert_(flagged[0].find('+67%') != -1)
+
+class RecorderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.history = history.History(HISTORY_FILE)
+        self.tracer = trace.Tracer()
+        trace.setTracer(self.tracer)
+
+    def tearDown(self):
+        trace.setTracer(None)
+        self.tracer.close()
+        self.history.close()
+        os.unlink(HISTORY_FILE)
+
+    def test_record(self):
+        """ Test recording completed spans as a run's tasks """
+        recorder = history.Recorder('package')
+        self.tracer.addListener(recorder.spanEnded)
+        Labelled('net/samba3').buildRelease('6.2')
+        self.assertRaises(history.HistoryError, Labelled('www/apache22').build, True)
+        # Commands are not recorded
+        trace.end(trace.begin('/bin/sh', 'command'))
+
+        run = recorder.save(self.history, history.OUTCOME_FAILED)
+        self.assertEquals(run.outcome, history.OUTCOME_FAILED)
+        tasks = self.history.getTasks(run.id)
+        self.assertEquals([(task.name, task.release, task.outcome) for task in tasks], [
+            ('build package net/samba3', '6.2', history.OUTCOME_SUCCEEDED),
+            ('build package www/apache22', '', history.OUTCOME_FAILED)
+        ])
+        self.assertEquals(tasks[1].error, 'boom')
@@ -0,0 +1,200 @@
+# test_logfile.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Buffered Log Unit Tests """
+
+import errno
+import gzip
+import os
+import time
+import unittest
+
+from farb import logfile
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+LOG_FILE = os.path.join(DATA_DIR, 'buffered.log')
+
+class FullFile(object):
+    """ A file on a full disk """
+    def write(self, data):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def readLog(path):
+    if (path.endswith(logfile.COMPRESSED_SUFFIX)):
+        f = gzip.open(path, 'rb')
+    else:
+        f = open(path, 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+class LogFileTestCase(unittest.TestCase):
+    def setUp(self):
+        # Don't write out buffered data during the tests unless woken
+        self.writer = logfile.LogWriter(interval=60)
+        self.paths = [LOG_FILE]
+
+    def tearDown(self):
+        self.writer.stop()
+        for path in self.paths:
+            for generation in range(0, logfile.LOG_ROTATE_KEEP + 2):
+                if (generation):
+                    rotated = logfile.getRotatedPath(path, generation)
+                else:
+                    rotated = path
+                if (os.path.exists(rotated)):
+                    os.unlink(rotated)
+
+    def _waitFor(self, path, data):
+        for i in range(100):
+            if (readLog(path) == data):
+                return
+            time.sleep(0.01)
+        self.assertEquals(readLog(path), data)
+
+    def test_paths(self):
+        self.assertEquals(logfile.getPath('build.log', False), 'build.log')
+        self.assertEquals(logfile.getPath('build.log', True), 'build.log.gz')
+        self.assertEquals(logfile.getRotatedPath('build.log', 2), 'build.log.2')
+        self.assertEquals(logfile.getRotatedPath('build.log.gz', 1), 'build.log.1.gz')
+
+    def test_buffered(self):
+        """ Test that output is buffered until flushed """
+        log = logfile.LogFile(LOG_FILE, writer=self.writer)
+        log.write('line 1\n')
+        log.write('line 2\n')
+        self.assertEquals(readLog(LOG_FILE), '')
+        log.flush()
+        self.assertEquals(readLog(LOG_FILE), 'line 1\nline 2\n')
+        log.write('line 3\n')
+        log.close()
+        self.assertEquals(readLog(LOG_FILE), 'line 1\nline 2\nline 3\n')
+        self.assertRaises(ValueError, log.write, 'line 4\n')
+        # Closing twice is harmless
+        log.close()
+
+    def test_periodicFlush(self):
+        """ Test that the writer thread writes out buffered output """
+        writer = logfile.LogWriter(interval=0.01)
+        log = logfile.LogFile(LOG_FILE, writer=writer)
+        try:
+            log.write('line 1\n')
+            self._waitFor(LOG_FILE, 'line 1\n')
+        finally:
+            log.close()
+            writer.stop()
+        self.assertEquals(writer.getLogs(), [])
+
+    def test_bufferFull(self):
+        """ Test that a full buffer is written out without waiting """
+        log = logfile.LogFile(LOG_FILE, bufferSize=16, writer=self.writer)
+        try:
+            log.write('short\n')
+            log.write('enough to fill the buffer\n')
+            self._waitFor(LOG_FILE, 'short\nenough to fill the buffer\n')
+        finally:
+            log.close()
+
+    def test_bufferLimit(self):
+        """ Test that a writer far ahead of the disk blocks """
+        log = logfile.LogFile(LOG_FILE, bufferSize=4, writer=self.writer)
+        try:
+            for i in range(10):
+                log.write('line %d\n' % (i))
+                self.assert_(log._pendingSize < 4 * logfile.LOG_BUFFER_LIMIT)
+        finally:
+            log.close()
+        self.assertEquals(readLog(LOG_FILE), ''.join(['line %d\n' % (i) for i in range(10)]))
+
+    def test_writeFailure(self):
+        """ Test that an error writing out the log is raised to the caller """
+        log = logfile.LogFile(LOG_FILE, writer=self.writer)
+        log._file = FullFile()
+        log.write('line 1\n')
+        self.assertRaises(logfile.LogFileError, log.flush)
+        log.write('line 2\n')
+        self.assertRaises(logfile.LogFileError, log.close)
+
+        # Closing while handling another failure only warns
+        log = logfile.LogFile(LOG_FILE, writer=self.writer)
+        log._file = FullFile()
+        log.write('line 1\n')
+        log.close(warn=True)
+
+    def test_compress(self):
+        """ Test writing a compressed log """
+        path = logfile.getPath(LOG_FILE, True)
+        self.paths.append(path)
+        log = logfile.LogFile(path, compress=True, writer=self.writer)
+        log.write('line 1\n' * 1000)
+        log.close()
+        self.assert_(os.path.getsize(path) < 7000)
+        self.assertEquals(readLog(path), 'line 1\n' * 1000)
+
+    def test_rotate(self):
+        """ Test rotating a log once it reaches its maximum size """
+        log = logfile.LogFile(LOG_FILE, maxSize=10, keep=2, writer=self.writer)
+        for i in range(4):
+            log.write('line %d\n' % (i))
+            log.write('more %d\n' % (i))
+            log.flush()
+        log.write('tail\n')
+        log.close()
+        self.assertEquals(readLog(LOG_FILE), 'tail\n')
+        self.assertEquals(readLog(LOG_FILE + '.1'), 'line 3\nmore 3\n')
+        self.assertEquals(readLog(LOG_FILE + '.2'), 'line 2\nmore 2\n')
+        self.assertFalse(os.path.exists(LOG_FILE + '.3'))
+
+        # A new log replaces the old rotated logs
+        log = logfile.LogFile(LOG_FILE, maxSize=10, keep=2, writer=self.writer)
+        log.close()
+        self.assertFalse(os.path.exists(LOG_FILE + '.1'))
+        self.assertEquals(readLog(LOG_FILE), '')
+
+    def test_stop(self):
+        """ Test that stopping the writer writes out buffered output """
+        log = logfile.LogFile(LOG_FILE, writer=self.writer)
+        log.write('line 1\n')
+        self.writer.stop()
+        self.assertEquals(readLog(LOG_FILE), 'line 1\n')
+        log.close()
+
+    def test_openFailure(self):
+        path = os.path.join(DATA_DIR, 'does-not-exist', 'build.log')
+        self.assertRaises(logfile.LogFileError, logfile.LogFile, path, writer=self.writer)
+        self.assertEquals(self.writer.getLogs(), [])
@@ -0,0 +1,146 @@
+# test_metrics.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Metrics Export Unit Tests """
+
+import os
+import stat
+import unittest
+
+from farb import metrics
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+METRICS_FILE = os.path.join(DATA_DIR, 'farbot.prom')
+
+class Phase(object):
+    def __init__(self, release):
+        self.release = release
+
+    @metrics.measured('package', lambda self, fail=False: self.release)
+    def build(self, fail=False):
+        metrics.getRegistry().set('farbot_packages_built', 3, {'release' : self.release})
+        if (fail):
+            raise metrics.MetricsError, "boom"
+
+class RegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def tearDown(self):
+        if (os.path.exists(METRICS_FILE)):
+            os.unlink(METRICS_FILE)
+
+    def test_render(self):
+        """ Test the text exposition format """
+        self.assertEquals(self.registry.render(), '')
+        self.registry.set('farbot_installroot_size_bytes', 1024)
+        self.registry.set('farbot_phase_duration_seconds', 1.5, {'phase' : 'release', 'release' : '6.2'})
+        self.registry.set('farbot_phase_duration_seconds', 42.0, {'phase' : 'install', 'release' : ''})
+        self.assertEquals(self.registry.render(),
+            '# HELP farbot_phase_duration_seconds Duration of the last run of the build phase.\n'
+            '# TYPE farbot_phase_duration_seconds gauge\n'
+            'farbot_phase_duration_seconds{phase="install",release=""} 42\n'
+            'farbot_phase_duration_seconds{phase="release",release="6.2"} 1.5\n'
+            '# HELP farbot_installroot_size_bytes Size of the files in the install root, including all generations.\n'
+            '# TYPE farbot_installroot_size_bytes gauge\n'
+            'farbot_installroot_size_bytes 1024\n')
+
+    def test_unknownMetric(self):
+        self.assertRaises(metrics.MetricsError, self.registry.set, 'farbot_bogus', 1)
+
+    def test_write(self):
+        """ Test writing and reading back a metrics file """
+        labels = {'phase' : 'release', 'release' : 'quote"back\\slash'}
+        self.registry.set('farbot_phase_last_success_timestamp_seconds', 1215000000.25, labels)
+        self.registry.write(METRICS_FILE)
+        self.assertEquals(stat.S_IMODE(os.stat(METRICS_FILE).st_mode), 0644)
+        self.assertEquals([name for name in os.listdir(DATA_DIR) if name.startswith('.farbot.prom')], [])
+
+        registry = metrics.Registry()
+        registry.load(METRICS_FILE)
+        self.assertEquals(registry.get('farbot_phase_last_success_timestamp_seconds', labels), 1215000000.25)
+        self.assertEquals(registry.render(), self.registry.render())
+
+    def test_merge(self):
+        """ Test that values from an earlier run are kept until replaced """
+        self.registry.set('farbot_packages_built', 10, {'release' : '6.0'})
+        self.registry.set('farbot_packages_built', 20, {'release' : '6.2'})
+        self.registry.write(METRICS_FILE)
+
+        registry = metrics.Registry()
+        registry.set('farbot_packages_built', 30, {'release' : '6.2'})
+        registry.write(METRICS_FILE)
+        registry = metrics.Registry()
+        registry.load(METRICS_FILE)
+        self.assertEquals(registry.get('farbot_packages_built', {'release' : '6.0'}), 10)
+        self.assertEquals(registry.get('farbot_packages_built', {'release' : '6.2'}), 30)
+
+class MeasuredTestCase(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        metrics.setPath(METRICS_FILE)
+
+    def tearDown(self):
+        metrics.reset()
+        if (os.path.exists(METRICS_FILE)):
+            os.unlink(METRICS_FILE)
+
+    def _load(self):
+        registry = metrics.Registry()
+        registry.load(METRICS_FILE)
+        return registry
+
+    def test_success(self):
+        """ Test that a successful phase is recorded and published """
+        Phase('6.2').build()
+        registry = self._load()
+        labels = {'phase' : 'package', 'release' : '6.2'}
+        self.assertEquals(registry.get('farbot_phase_success', labels), 1)
+        self.assertNotEquals(registry.get('farbot_phase_duration_seconds', labels), None)
+        self.assertNotEquals(registry.get('farbot_phase_last_success_timestamp_seconds', labels), None)
+        self.assertEquals(registry.get('farbot_packages_built', {'release' : '6.2'}), 3)
+
+    def test_failure(self):
+        """ Test that a failed phase keeps its last success time """
+        Phase('6.2').build()
+        labels = {'phase' : 'package', 'release' : '6.2'}
+        succeeded = self._load().get('farbot_phase_last_success_timestamp_seconds', labels)
+
+        self.assertRaises(metrics.MetricsError, Phase('6.2').build, True)
+        registry = self._load()
+        self.assertEquals(registry.get('farbot_phase_success', labels), 0)
+        self.assertEquals(registry.get('farbot_phase_last_success_timestamp_seconds', labels), succeeded)
+
+    def test_disabled(self):
+        """ Test that nothing is written without a metrics file """
+        metrics.setPath(None)
+        Phase('6.2').build()
+        self.assertFalse(os.path.exists(METRICS_FILE))
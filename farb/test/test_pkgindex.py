@@ -0,0 +1,134 @@
+# test_pkgindex.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+
+""" Package Index Unit Tests """
+
+import os
+import shutil
+import tarfile
+import unittest
+from cStringIO import StringIO
+
+from farb import pkgindex
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+PACKAGE_DIR = os.path.join(DATA_DIR, 'test_packages')
+
+def makePackage(packagedir, name, origin, dependencies=[], latest=None):
+    """
+    Create a package file, containing only a packing list, in
+    packagedir/All, and its Latest link.
+    @param packagedir: Package directory
+    @param name: Package name, including the version
+    @param origin: Port origin
+    @param dependencies: Names of required packages
+    @param latest: Latest link name
+    """
+    for subdir in ('All', 'Latest'):
+        if (not os.path.exists(os.path.join(packagedir, subdir))):
+            os.makedirs(os.path.join(packagedir, subdir))
+
+    contents = '@comment PKG_FORMAT_REVISION:1.1\n@name %s\n' % (name)
+    for dependency in dependencies:
+        contents += '@pkgdep %s\n@comment DEPORIGIN:misc/%s\n' % (dependency, dependency)
+    contents += '@comment ORIGIN:%s\n@cwd /usr/local\nbin/%s\n' % (origin, name)
+
+    tar = tarfile.open(os.path.join(packagedir, 'All', name + '.tbz'), 'w:bz2')
+    info = tarfile.TarInfo(pkgindex.CONTENTS_NAME)
+    info.size = len(contents)
+    tar.addfile(info, StringIO(contents))
+    tar.close()
+
+    if (latest):
+        os.symlink(os.path.join('..', 'All', name + '.tbz'), os.path.join(packagedir, 'Latest', latest + '.tbz'))
+
+class PackageIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        makePackage(PACKAGE_DIR, 'perl-5.8.8', 'lang/perl5.8', latest='perl')
+        makePackage(PACKAGE_DIR, 'mysql-client-5.0.45', 'databases/mysql50-client', ['perl-5.8.8'], latest='mysql-client')
+        makePackage(PACKAGE_DIR, 'mysql-server-5.0.45', 'databases/mysql50-server', ['perl-5.8.8', 'mysql-client-5.0.45'], latest='mysql-server')
+        makePackage(PACKAGE_DIR, 'sudo-1.6.9', 'security/sudo', latest='sudo')
+        self.index = pkgindex.PackageIndex()
+        self.index.scan(PACKAGE_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(PACKAGE_DIR)
+
+    def test_scan(self):
+        package = self.index.getPackage('mysql-server')
+        self.assertEquals(package.name, 'mysql-server-5.0.45')
+        self.assertEquals(package.origin, 'databases/mysql50-server')
+        self.assertEquals(package.latest, 'mysql-server')
+        self.assertEquals(package.dependencies, ['perl-5.8.8', 'mysql-client-5.0.45'])
+        self.assertEquals(package.size, os.path.getsize(os.path.join(PACKAGE_DIR, 'All', 'mysql-server-5.0.45.tbz')))
+        self.assertEquals(package.getPath(), os.path.join('All', 'mysql-server-5.0.45.tbz'))
+        self.assertEquals(len(self.index.packages), 4)
+
+    def test_writeRead(self):
+        path = os.path.join(PACKAGE_DIR, pkgindex.INDEX_NAME)
+        self.index.write(path)
+        index = pkgindex.PackageIndex()
+        index.read(path)
+        for name, package in self.index.packages.items():
+            self.assertEquals(index.packages[name].__dict__, package.__dict__)
+        self.assertEquals(index.latest, self.index.latest)
+
+    def test_readMalformed(self):
+        path = os.path.join(PACKAGE_DIR, pkgindex.INDEX_NAME)
+        output = open(path, 'w')
+        output.write('sudo-1.6.9|security/sudo\n')
+        output.close()
+        self.assertRaises(pkgindex.PackageIndexError, pkgindex.PackageIndex().read, path)
+
+    def test_getInstallOrder(self):
+        order = [package.name for package in self.index.getInstallOrder(['sudo', 'mysql-server', 'perl-5.8.8'])]
+        self.assertEquals(order, ['sudo-1.6.9', 'perl-5.8.8', 'mysql-client-5.0.45', 'mysql-server-5.0.45'])
+
+    def test_getInstallOrderCycle(self):
+        self.index.getPackage('perl').dependencies.append('mysql-server-5.0.45')
+        order = [package.name for package in self.index.getInstallOrder(['perl'])]
+        self.assertEquals(order, ['mysql-client-5.0.45', 'mysql-server-5.0.45', 'perl-5.8.8'])
+
+    def test_getPackagePort(self):
+        # Packages are named after their port directory by default
+        self.assertEquals(self.index.getPackage('mysql50-server').name, 'mysql-server-5.0.45')
+        self.assertEquals(self.index.getPackage('sudo-1.6.9').name, 'sudo-1.6.9')
+
+    def test_unknownPackage(self):
+        self.assertRaises(pkgindex.PackageIndexError, self.index.getInstallOrder, ['emacs'])
+
+    def test_missingDependency(self):
+        self.index.getPackage('sudo').dependencies.append('libiconv-1.11')
+        self.assertRaises(pkgindex.PackageIndexError, self.index.getInstallOrder, ['sudo'])
+
+    def test_noContents(self):
+        path = os.path.join(PACKAGE_DIR, 'All', 'empty-1.0.tbz')
+        tarfile.open(path, 'w:bz2').close()
+        self.assertRaises(pkgindex.PackageIndexError, pkgindex.readContents, path)
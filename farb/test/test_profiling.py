@@ -0,0 +1,132 @@
+# test_profiling.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Profiling Unit Tests """
+
+import os
+import pstats
+import shutil
+import unittest
+
+from farb import builder, profiling, trace
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+PROFILE_DIR = os.path.join(DATA_DIR, 'profile')
+
+def busy(count=1000):
+    total = 0
+    for i in range(count):
+        total += i
+    return total
+
+def busyJob():
+    busy()
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+
+    @trace.traced('phase', 'phase %(name)s')
+    def run(self, inner=None):
+        busy()
+        if (inner):
+            inner.run()
+
+    @trace.traced('phase', 'jobs %(name)s')
+    def runJobs(self):
+        builder._runJobs([busyJob, busyJob], 2)
+
+def getFunctions(stats):
+    return [function for filename, line, function in stats.stats.keys()]
+
+def getCalls(stats, name):
+    calls = 0
+    for (filename, line, function), (primitive, total, tt, ct, callers) in stats.stats.items():
+        if (function == name):
+            calls += total
+    return calls
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.profiler = profiling.Profiler()
+        self.tracer = trace.Tracer()
+        self.tracer.addBeginListener(self.profiler.spanBegan)
+        self.tracer.addListener(self.profiler.spanEnded)
+        trace.setTracer(self.tracer)
+        profiling.setProfiler(self.profiler)
+
+    def tearDown(self):
+        profiling.setProfiler(None)
+        trace.setTracer(None)
+        self.tracer.close()
+        if (os.path.exists(PROFILE_DIR)):
+            shutil.rmtree(PROFILE_DIR)
+
+    def test_phases(self):
+        """ Test that nested phases are profiled separately """
+        Phase('outer').run(Phase('inner'))
+        self.assertEquals([phase.name for phase in self.profiler.profiles], ['phase inner', 'phase outer'])
+        inner, outer = self.profiler.profiles
+        # The outer phase's profile excludes the inner phase's call
+        self.assertEquals(getCalls(outer.getStats(), 'busy'), 1)
+        self.assertEquals(getCalls(inner.getStats(), 'busy'), 1)
+        self.assert_(outer.elapsed >= inner.elapsed)
+        self.assert_(outer.peakRSS >= outer.startRSS)
+        self.assertEquals(self.profiler.getCurrent(), None)
+
+    def test_jobs(self):
+        """ Test that job threads are profiled on behalf of their phase """
+        Phase('a').runJobs()
+        phase = self.profiler.profiles[0]
+        self.assertEquals(len(phase.workers), 2)
+        self.assert_('busyJob' in getFunctions(phase.getStats()))
+
+    def test_start(self):
+        """ Test profiling outside of a traced phase """
+        phase = self.profiler.start('config')
+        busy()
+        self.assertEquals(profiling.getCurrent(), phase)
+        self.profiler.stop(phase)
+        self.assertEquals(profiling.getCurrent(), None)
+        self.assert_('busy' in getFunctions(phase.getStats()))
+
+    def test_write(self):
+        """ Test writing the profiles and summary """
+        Phase('6.2-release').run()
+        self.profiler.write(PROFILE_DIR)
+        stats = pstats.Stats(os.path.join(PROFILE_DIR, 'phase-6.2-release.prof'))
+        self.assert_('busy' in getFunctions(stats))
+        report = open(os.path.join(PROFILE_DIR, 'phase-6.2-release.txt')).read()
+        self.assert_(report.startswith('Phase phase 6.2-release: '))
+        self.assert_(report.find('busy') != -1)
+        summary = open(os.path.join(PROFILE_DIR, profiling.SUMMARY_NAME)).readlines()
+        self.assertEquals(len(summary), 2)
+        self.assertEquals(summary[1].split()[:2], ['phase', '6.2-release'])
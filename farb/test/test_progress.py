@@ -0,0 +1,180 @@
+# test_progress.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Progress Reporting Unit Tests """
+
+import os
+import StringIO
+import time
+import unittest
+
+from farb import progress, trace
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+STATUS_FILE = os.path.join(DATA_DIR, 'farbot.status')
+
+class Step(object):
+    def __init__(self, name):
+        self.name = name
+
+    @trace.traced('step', 'step %(name)s')
+    def run(self, inner=None):
+        if (inner):
+            inner()
+
+class Stage(Step):
+    @trace.traced('stage', 'stage %(name)s')
+    def run(self, inner=None):
+        if (inner):
+            inner()
+
+class ProgressTestCase(unittest.TestCase):
+    def setUp(self):
+        self.progress = progress.Progress('release', {('step', 'step a', '') : 10.0, ('step', 'step b', '') : 30.0, ('phase', 'release', '') : 40.0})
+        self.tracer = trace.Tracer()
+        self.tracer.addBeginListener(self.progress.spanBegan)
+        self.tracer.addListener(self.progress.spanEnded)
+        trace.setTracer(self.tracer)
+
+    def tearDown(self):
+        trace.setTracer(None)
+        self.tracer.close()
+        if (os.path.exists(STATUS_FILE)):
+            os.unlink(STATUS_FILE)
+
+    def test_formatBytes(self):
+        self.assertEquals(progress.formatBytes(512), '512 B')
+        self.assertEquals(progress.formatBytes(1536), '1.5 KB')
+        self.assertEquals(progress.formatBytes(3 * 1024 * 1024 * 1024), '3.0 GB')
+
+    def test_current(self):
+        """ Test tracking of the open tasks """
+        current = []
+        def inner():
+            current.extend(self.progress.getStatus()['current'])
+        Step('a').run(lambda: Step('b').run(inner))
+        self.assertEquals(current, ['step b', 'step a'])
+        self.assertEquals(self.progress.getStatus()['current'], [])
+        # Commands are not tasks
+        span = trace.begin('/bin/sh', 'command')
+        self.assertEquals(self.progress.getStatus()['current'], [])
+        trace.end(span)
+
+    def test_units(self):
+        """ Test counting units of work and data copied """
+        self.progress.addTotal('ports', 3)
+        self.progress.advance('ports')
+        self.progress.addTotal('ports', 2)
+        self.progress.addBytes(100)
+        self.progress.addBytes(24)
+        status = self.progress.getStatus()
+        self.assertEquals(status['units'], {'ports' : {'done' : 1, 'total' : 5}})
+        self.assertEquals(status['bytes'], 124)
+
+    def test_remaining(self):
+        """ Test estimating the time remaining from previous durations """
+        self.assertEquals(self.progress.getRemaining(), None)
+        Step('a').run()
+        now = time.time()
+        self.progress.started = now - 20
+        # A quarter of the estimated work took 20 seconds
+        self.assertEquals(self.progress.getRemaining(now), 60.0)
+
+        # Open tasks count for the part of their estimate that has elapsed
+        self.progress.spanBegan({'id' : 100, 'category' : 'step', 'name' : 'step b', 'ts' : now - 10})
+        self.assertEquals(self.progress.getRemaining(now), 20.0)
+
+        # Tasks that failed did not complete
+        self.progress.spanEnded({'id' : 100, 'results' : {'error' : 'boom'}})
+        self.assertEquals(self.progress.getRemaining(now), 60.0)
+
+    def test_nestedSteps(self):
+        """ Test that the steps of a stage are not counted twice """
+        self.progress.estimates[('stage', 'stage ab', '')] = 40.0
+        Stage('ab').run(lambda: Step('a').run())
+        now = time.time()
+        self.progress.started = now - 20
+        self.assertEquals(self.progress.getRemaining(now), 60.0)
+
+    def test_noEstimates(self):
+        """ Test that nothing is estimated without a history """
+        self.progress.estimates = {}
+        Step('a').run()
+        self.assertEquals(self.progress.getRemaining(), None)
+
+    def test_formatStatus(self):
+        status = {
+            'elapsed' : 125,
+            'current' : ['build package net/samba3', 'build package www/apache22'],
+            'units' : {'ports' : {'done' : 3, 'total' : 12}, 'dists' : {'done' : 9, 'total' : 9}},
+            'bytes' : 1536,
+            'remaining' : 3725
+        }
+        self.assertEquals(progress.formatStatus(status), '2:05 | build package net/samba3 (+1) | dists 9/9 | ports 3/12 | 1.5 KB | ETA 1:02:05')
+
+    def test_reporter(self):
+        """ Test reporting to a status file and console """
+        self.progress.addTotal('ports', 2)
+        console = StringIO.StringIO()
+        reporter = progress.Reporter(self.progress, statusPath=STATUS_FILE, console=console)
+        reporter.report()
+        self.assert_(console.getvalue().endswith('ports 0/2'))
+        status = trace.json.load(open(STATUS_FILE))
+        self.assertEquals(status['action'], 'release')
+        self.assertEquals(status['units']['ports'], {'done' : 0, 'total' : 2})
+        self.assertEquals(status['finished'], False)
+
+        reporter.start()
+        reporter.stop()
+        self.assert_(console.getvalue().endswith('\r%s\r' % (' ' * progress.STATUS_WIDTH)))
+        status = trace.json.load(open(STATUS_FILE))
+        self.assertEquals(status['finished'], True)
+        self.assertEquals([name for name in os.listdir(DATA_DIR) if name.startswith('.farbot.status')], [])
+
+class ModuleTestCase(unittest.TestCase):
+    def tearDown(self):
+        progress.setProgress(None)
+
+    def test_noProgress(self):
+        """ Test that reporting work without a Progress does nothing """
+        progress.addTotal('ports', 1)
+        progress.advance('ports')
+        progress.addBytes(1)
+
+    def test_progress(self):
+        tracker = progress.Progress('install')
+        progress.setProgress(tracker)
+        progress.addTotal('dists', 2)
+        progress.advance('dists')
+        progress.addBytes(10)
+        status = tracker.getStatus()
+        self.assertEquals(status['units']['dists'], {'done' : 1, 'total' : 2})
+        self.assertEquals(status['bytes'], 10)
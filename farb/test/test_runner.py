@@ -32,11 +32,12 @@
 import copy
 import os
 import shutil
+import time
 import unittest
 import ZConfig
 
 import farb
-from farb import config, runner, utils
+from farb import config, metrics, runner, sysinstall, utils
 
 # Useful Constants
 from farb.test import DATA_DIR, rewrite_config
@@ -47,6 +48,96 @@ SCHEMA = ZConfig.loadSchema(farb.CONFIG_SCHEMA)
 RELEASE_NAMES = ['6.0', '6.2-release']
 DISTFILES_CACHE = os.path.join(BUILDROOT, 'distfiles')
 PACKAGEDIR = os.path.join(DATA_DIR, 'fake_pkgs')
+REPLICAROOT = INSTALLROOT + '.replica'
+METRICS_FILE = os.path.join(BUILDROOT, 'farbot.prom')
+
+class TaskSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = runner.TaskScheduler(2)
+        self.events = []
+
+    def _task(self, name, delay=0.0):
+        def task():
+            self.events.append(('start', name))
+            time.sleep(delay)
+            self.events.append(('end', name))
+        return task
+
+    def test_order(self):
+        """ Test that tasks run after their dependencies """
+        self.scheduler.maxJobs = 1
+        self.scheduler.add('install', self._task('install'), ['package:a', 'package:b'])
+        self.scheduler.add('package:a', self._task('package:a'), ['release:a'])
+        self.scheduler.add('release:a', self._task('release:a'))
+        self.scheduler.add('package:b', self._task('package:b'))
+        self.assertEquals([task.name for task in self.scheduler.getOrder()], ['release:a', 'package:a', 'package:b', 'install'])
+        self.scheduler.run()
+        self.assertEquals(self.events[-2:], [('start', 'install'), ('end', 'install')])
+
+    def test_overlap(self):
+        """ Test that independent tasks overlap """
+        self.scheduler.add('release:a', self._task('release:a', 0.4))
+        self.scheduler.add('release:b', self._task('release:b', 0.1))
+        self.scheduler.add('package:b', self._task('package:b', 0.1), ['release:b'])
+        self.scheduler.add('package:a', self._task('package:a'), ['release:a'])
+        self.scheduler.run()
+        # Release b's packages are built while release a is still building
+        self.assert_(self.events.index(('end', 'package:b')) < self.events.index(('end', 'release:a')))
+        self.assert_(self.events.index(('end', 'release:a')) < self.events.index(('start', 'package:a')))
+
+    def test_failure(self):
+        """ Test that dependents of a failed task are not run """
+        def fail():
+            raise runner.PackageBuildRunnerError, "boom"
+        self.scheduler.add('release:a', fail)
+        self.scheduler.add('release:b', self._task('release:b', 0.1))
+        self.scheduler.add('package:a', self._task('package:a'), ['release:a'])
+        self.assertRaises(runner.PackageBuildRunnerError, self.scheduler.run)
+        self.assertEquals(self.events, [('start', 'release:b'), ('end', 'release:b')])
+
+    def test_invalidGraph(self):
+        """ Test handling of unknown and circular dependencies """
+        self.scheduler.add('a', self._task('a'), ['b'])
+        self.assertRaises(runner.TaskSchedulerError, self.scheduler.run)
+        self.scheduler.add('b', self._task('b'), ['a'])
+        self.assertRaises(runner.TaskSchedulerError, self.scheduler.run)
+        self.assertRaises(runner.TaskSchedulerError, self.scheduler.add, 'a', self._task('a'))
+        self.assertEquals(self.events, [])
+
+class PipelineRunnerTestCase(unittest.TestCase):
+    def setUp(self):
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, CONFIG_SUBS)
+        self.farbconfig, handler = ZConfig.loadConfig(SCHEMA, RELEASE_CONFIG_FILE)
+        config.verifyPackages(self.farbconfig)
+
+    def tearDown(self):
+        os.unlink(RELEASE_CONFIG_FILE)
+
+    def _getGraph(self, phases):
+        graph = {}
+        for task in runner.PipelineRunner(self.farbconfig, phases).createScheduler().tasks:
+            graph[task.name] = task.dependencies
+        return graph
+
+    def test_graph(self):
+        """ Test the per-release task graph """
+        self.assertEquals(self._getGraph(runner.PIPELINE_PHASES), {
+            'distfiles' : [],
+            'release:6.0' : [],
+            'package:6.0' : ['release:6.0', 'distfiles'],
+            'release:6.2-release' : [],
+            'package:6.2-release' : ['release:6.2-release', 'distfiles'],
+            'install' : ['package:6.0', 'package:6.2-release']
+        })
+
+    def test_graphPhases(self):
+        """ Test the task graph of a subset of the phases """
+        self.assertEquals(self._getGraph(('package', 'install')), {
+            'distfiles' : [],
+            'package:6.0' : ['distfiles'],
+            'package:6.2-release' : ['distfiles'],
+            'install' : ['package:6.0', 'package:6.2-release']
+        })
 
 class ReleaseBuildRunnerTestCase(unittest.TestCase):
     def setUp(self):
@@ -165,6 +256,7 @@ class NetInstallAssemblerRunnerTestCase(unittest.TestCase):
         os.unlink(os.path.join(BUILDROOT, 'test1-install.cfg'))
         os.unlink(os.path.join(BUILDROOT, 'test2-install.cfg'))
         os.unlink(os.path.join(BUILDROOT, 'test3-install.cfg'))
+        shutil.rmtree(os.path.join(BUILDROOT, 'mfsroot-cache'))
         shutil.rmtree(INSTALLROOT)
         for release in RELEASE_NAMES:
             releaseroot = os.path.join(BUILDROOT, release)
@@ -204,6 +296,12 @@ class NetInstallAssemblerRunnerTestCase(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, '6.2-release', 'packages', 'All', 'mysql-client-5.0.45_1.tbz')))
         self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, '6.0', 'src', 'szomg.aa')))
         self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, '6.2-release', 'base', 'base.aa')))
+
+    def test_packageList(self):
+        """ Test that batch installations' package lists are in dependency order """
+        packageList = os.path.join(INSTALLROOT, '6.0', 'install', 'test2.packages')
+        self.assertEquals(open(packageList).read(), '/dist/packages/All/sudo-1.6.9.6.tbz\n/dist/packages/All/mysql-client-5.0.45_1.tbz\n/dist/packages/All/mysql-server-5.0.45_1.tbz\n')
+        self.assertTrue(not os.path.exists(os.path.join(INSTALLROOT, '6.0', 'install', 'test1.packages')))
         
     def test_localData(self):
         """ Test that local data is copied into the release's InstallRoot """
@@ -215,6 +313,164 @@ class NetInstallAssemblerRunnerTestCase(unittest.TestCase):
         """ Test that the tftproot directory has necessary files """
         self.assertTrue(os.path.isdir(os.path.join(INSTALLROOT, 'tftproot')))
         self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'boot', 'netinstall.4th')))
-        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'test1', 'kernel', 'kernel')))
+        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'releases', '6.0', 'kernel', 'kernel')))
+        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'releases', '6.2-release', 'kernel', 'kernel')))
+        self.assertFalse(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'test1', 'kernel')))
         self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'test2', 'mfsroot')))
         self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'test3', 'boot.conf')))
+
+class NetInstallAssemblerRunnerSharedMFSRootTestCase(unittest.TestCase):
+    def setUp(self):
+        subs = copy.deepcopy(CONFIG_SUBS)
+        subs['@INSTALLROOT@'] = INSTALLROOT
+        subs['@SHAREDMFSROOT@'] = 'SharedMFSRoot yes'
+        subs['@NFSMIRRORS@'] = '<NFSMirror Mirror1>\nHost 10.0.50.2\n</NFSMirror>'
+        os.mkdir(INSTALLROOT)
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        farbconfig, handler = ZConfig.loadConfig(SCHEMA, RELEASE_CONFIG_FILE)
+
+        # Copy in each release and package root needed
+        for release in RELEASE_NAMES:
+            rewrite_config(CDROM_INF_IN, CDROM_INF, {'@CD_VERSION_LINE@' : 'CD_VERSION = ' + release.upper()})
+            releasedest = os.path.join(BUILDROOT, release, 'releaseroot', builder.RELEASE_CD_PATH)
+            utils.copyRecursive(ISO_MOUNTPOINT, releasedest)
+            os.rename(os.path.join(releasedest, '6.2-RELEASE'), os.path.join(releasedest, release.upper()))
+            pkgdest = os.path.join(BUILDROOT, release, 'pkgroot', 'usr', 'ports', 'packages')
+            utils.copyRecursive(PACKAGEDIR, pkgdest)
+
+        self.nbr = runner.NetInstallAssemblerRunner(farbconfig)
+        self.nbr.run()
+
+    def tearDown(self):
+        os.unlink(RELEASE_CONFIG_FILE)
+        os.unlink(os.path.join(BUILDROOT, 'install.log'))
+        for name in ('test1-install.cfg', 'test2-install.cfg', 'test3-install.cfg', '6.0-bootstrap.cfg', '6.2-release-bootstrap.cfg'):
+            os.unlink(os.path.join(BUILDROOT, name))
+        shutil.rmtree(os.path.join(BUILDROOT, 'mfsroot-cache'))
+        shutil.rmtree(INSTALLROOT)
+        for release in RELEASE_NAMES:
+            releaseroot = os.path.join(BUILDROOT, release)
+            if os.path.exists(releaseroot):
+                shutil.rmtree(releaseroot)
+
+    def test_sharedMFSRoot(self):
+        """ Test that installations share their release's mfsroot """
+        tftproot = os.path.join(INSTALLROOT, 'tftproot')
+        self.assertTrue(os.path.exists(os.path.join(tftproot, 'releases', '6.0', 'mfsroot')))
+        self.assertTrue(os.path.exists(os.path.join(tftproot, 'releases', '6.2-release', 'mfsroot')))
+        self.assertFalse(os.path.exists(os.path.join(tftproot, 'test1', 'mfsroot')))
+
+        bootConf = open(os.path.join(tftproot, 'test1', 'boot.conf'), 'r').readlines()
+        self.assertTrue('mfsroot_name="/releases/6.0/mfsroot"\n' in bootConf)
+        self.assertTrue('configFile="/dist/install/test1.cfg"\n' in bootConf)
+
+        # Each installation mounts the NFS host it is assigned to
+        for install in self.nbr.config.Installations.Installation:
+            installConfig = sysinstall.InstallationConfig(install, self.nbr.config)
+            bootConf = open(os.path.join(tftproot, install.getSectionName(), 'boot.conf'), 'r').readlines()
+            self.assertTrue('nfs="%s"\n' % (installConfig.networkConfig.nfs) in bootConf)
+        self.assertNotEquals(sysinstall.InstallationConfig(self.nbr.config.Installations.Installation[1], self.nbr.config).networkConfig.nfshost, self.nbr.config.Releases.nfshost)
+
+    def test_installConfigs(self):
+        """ Test that install.cfg files are copied to the release data """
+        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, '6.0', 'install', 'test1.cfg')))
+        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, '6.2-release', 'install', 'test3.cfg')))
+
+class NetInstallAssemblerRunnerGenerationsTestCase(unittest.TestCase):
+    def setUp(self):
+        subs = copy.deepcopy(CONFIG_SUBS)
+        subs['@INSTALLROOT@'] = INSTALLROOT
+        subs['@GENERATIONS@'] = 'InstallRootGenerations 2'
+        subs['@NFSMIRRORS@'] = '<NFSMirror Mirror1>\nHost 10.0.50.2\nReplicaRoot %s\n</NFSMirror>' % (REPLICAROOT)
+        os.mkdir(INSTALLROOT)
+        os.mkdir(REPLICAROOT)
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        self.farbconfig, handler = ZConfig.loadConfig(SCHEMA, RELEASE_CONFIG_FILE)
+
+        # Copy in each release and package root needed
+        for release in RELEASE_NAMES:
+            rewrite_config(CDROM_INF_IN, CDROM_INF, {'@CD_VERSION_LINE@' : 'CD_VERSION = ' + release.upper()})
+            releasedest = os.path.join(BUILDROOT, release, 'releaseroot', builder.RELEASE_CD_PATH)
+            utils.copyRecursive(ISO_MOUNTPOINT, releasedest)
+            os.rename(os.path.join(releasedest, '6.2-RELEASE'), os.path.join(releasedest, release.upper()))
+            pkgdest = os.path.join(BUILDROOT, release, 'pkgroot', 'usr', 'ports', 'packages')
+            utils.copyRecursive(PACKAGEDIR, pkgdest)
+
+        self.nbr = runner.NetInstallAssemblerRunner(self.farbconfig)
+        self.nbr.run()
+
+    def tearDown(self):
+        os.unlink(RELEASE_CONFIG_FILE)
+        os.unlink(os.path.join(BUILDROOT, 'install.log'))
+        os.unlink(os.path.join(BUILDROOT, 'test1-install.cfg'))
+        os.unlink(os.path.join(BUILDROOT, 'test2-install.cfg'))
+        os.unlink(os.path.join(BUILDROOT, 'test3-install.cfg'))
+        if os.path.exists(os.path.join(BUILDROOT, 'rollback.log')):
+            os.unlink(os.path.join(BUILDROOT, 'rollback.log'))
+        if os.path.exists(os.path.join(BUILDROOT, 'replicate.log')):
+            os.unlink(os.path.join(BUILDROOT, 'replicate.log'))
+        if os.path.exists(METRICS_FILE):
+            os.unlink(METRICS_FILE)
+        metrics.reset()
+        shutil.rmtree(os.path.join(BUILDROOT, 'mfsroot-cache'))
+        shutil.rmtree(INSTALLROOT)
+        shutil.rmtree(REPLICAROOT)
+        for release in RELEASE_NAMES:
+            releaseroot = os.path.join(BUILDROOT, release)
+            if os.path.exists(releaseroot):
+                shutil.rmtree(releaseroot)
+
+    def test_generation(self):
+        """ Test that the install root is served from a generation """
+        self.assertTrue(os.path.islink(os.path.join(INSTALLROOT, 'tftproot')))
+        self.assertTrue(os.path.islink(os.path.join(INSTALLROOT, '6.0')))
+        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, '6.0', 'src', 'szomg.aa')))
+        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'test1', 'boot.conf')))
+
+    def test_rollback(self):
+        """ Test rolling back to the previous generation """
+        self.nbr.run()
+        rbr = runner.InstallRootRollbackRunner(self.farbconfig)
+        self.assertEquals(rbr.run(), 1)
+        self.assertTrue(os.path.exists(os.path.join(INSTALLROOT, 'tftproot', 'test1', 'boot.conf')))
+        # There is nothing older than the first generation
+        self.assertRaises(runner.InstallRootRollbackRunnerError, rbr.run)
+
+    def test_failedGeneration(self):
+        """ Test that a failed build's generation is removed """
+        shutil.rmtree(os.path.join(BUILDROOT, RELEASE_NAMES[0], 'releaseroot'))
+        self.assertRaises(runner.NetInstallAssemblerRunnerError, self.nbr.run)
+        generations = builder.InstallRootGenerations(INSTALLROOT, 2)
+        self.assertEquals(generations.getGenerations(), [1])
+        self.assertEquals(generations.getCurrent(), 1)
+
+    def test_metrics(self):
+        """ Test exporting install and replication metrics """
+        metrics.setPath(METRICS_FILE)
+        self.nbr.run()
+        registry = metrics.Registry()
+        registry.load(METRICS_FILE)
+        labels = {'phase' : 'install', 'release' : ''}
+        self.assertEquals(registry.get('farbot_phase_success', labels), 1)
+        self.assert_(registry.get('farbot_phase_duration_seconds', labels) > 0)
+        self.assert_(registry.get('farbot_phase_last_success_timestamp_seconds', labels) <= time.time())
+
+        # The second generation shares its unchanged files with the first
+        copied = registry.get('farbot_installroot_copied_bytes')
+        size = registry.get('farbot_installroot_size_bytes')
+        self.assert_(copied > 0)
+        self.assert_(size >= copied and size < copied * 2)
+        self.assertNotEquals(registry.get('farbot_replicated_bytes', {'mirror' : 'mirror1'}), None)
+
+    def test_replicate(self):
+        """ Test replicating the served generation to an NFS mirror """
+        self.assertTrue(os.path.exists(os.path.join(REPLICAROOT, '6.0', 'src', 'szomg.aa')))
+        self.assertTrue(os.path.exists(os.path.join(REPLICAROOT, 'tftproot', 'test1', 'boot.conf')))
+        self.assertTrue(os.path.exists(os.path.join(REPLICAROOT, builder.REPLICA_MANIFEST)))
+        self.assertFalse(os.path.exists(os.path.join(REPLICAROOT, builder.GENERATIONS_DIR)))
+        # The replica is already up to date
+        irr = runner.InstallRootReplicationRunner(self.farbconfig)
+        results = irr.run()
+        self.assertEquals(len(results), 1)
+        self.assertEquals(results[0][0], 'mirror1')
+        self.assertEquals(results[0][1].files, 0)
@@ -34,6 +34,7 @@ import ZConfig
 from cStringIO import StringIO
 import string
 import unittest
+import zlib
 
 import farb
 from farb import sysinstall
@@ -41,7 +42,7 @@ from farb import sysinstall
 # Useful Constants
 from farb.test import DATA_DIR
 from farb.test.test_config import RELEASE_CONFIG_FILE, RELEASE_CONFIG_FILE_IN
-from farb.test.test_config import CONFIG_SUBS, rewrite_config
+from farb.test.test_config import CONFIG_SUBS, NFS_MIRRORS, rewrite_config
 
 class MockConfigSection(sysinstall.ConfigSection):
     sectionOptions = [
@@ -127,12 +128,68 @@ class NetworkConfigTestCase(ConfigTestCase, unittest.TestCase):
         nc.serialize(output)
         self.assertEquals(output.getvalue(), expectedOutput)
 
+    def _loadMirrors(self, assignment, pin=''):
+        """
+        Reload the configuration with NFS mirrors
+        @param assignment: NFSAssignment strategy
+        @param pin: Pinned NFSMirror line for the Test2 installation
+        """
+        subs = CONFIG_SUBS.copy()
+        subs['@NFSMIRRORS@'] = 'NFSAssignment %s\n%s' % (assignment, NFS_MIRRORS)
+        subs['@NFSMIRRORPIN@'] = pin
+        rewrite_config(RELEASE_CONFIG_FILE_IN, RELEASE_CONFIG_FILE, subs)
+        self.config, handler = ZConfig.loadConfig(self.schema, RELEASE_CONFIG_FILE)
+
+    def test_roundRobin(self):
+        """
+        Assign installations to NFS hosts in turn
+        """
+        self._loadMirrors('RoundRobin')
+        hosts = []
+        for inst in self.config.Installations.Installation:
+            hosts.append(sysinstall.NetworkConfig(inst, self.config).nfshost)
+        self.assertEquals(hosts, self.config.Releases.nfshosts[:len(hosts)])
+
+    def test_pin(self):
+        """
+        Assign pinned installations to their NFS mirror
+        """
+        self._loadMirrors('Pin', 'NFSMirror Mirror2')
+        insts = self.config.Installations.Installation
+        self.assertEquals(sysinstall.NetworkConfig(insts[0], self.config).nfshost, self.config.Releases.nfshost)
+        self.assertEquals(sysinstall.NetworkConfig(insts[1], self.config).nfshost, '10.0.50.3')
+
+    def test_hash(self):
+        """
+        Assign installations to NFS hosts by host name
+        """
+        self._loadMirrors('Hash')
+        hosts = self.config.Releases.nfshosts
+        for inst in self.config.Installations.Installation:
+            nc = sysinstall.NetworkConfig(inst, self.config)
+            self.assertEquals(nc.nfshost, hosts[(zlib.crc32(inst.hostname) & 0xffffffff) % len(hosts)])
+            # Stable across invocations
+            self.assertEquals(sysinstall.NetworkConfig(inst, self.config).nfshost, nc.nfshost)
+
+class BootstrapConfigTestCase(ConfigTestCase, unittest.TestCase):
+    def test_serialize(self):
+        """
+        Serialize a BootstrapConfig
+        """
+        output = StringIO()
+        bc = sysinstall.BootstrapConfig()
+        # The NFS installation media is set by the boot loader
+        expectedOutput = 'debug=YES\nnonInteractive=YES\nnoWarn=YES\ntryDHCP=YES\nmediaSetNFS\nmediaOpen\nloadConfig\n'
+        bc.serialize(output)
+        self.assertEquals(output.getvalue(), expectedOutput)
+
 class DistSetConfigTestCase(ConfigTestCase, unittest.TestCase):
     def test_init(self):
         """
         Initialize a DistSetConfig
         """
         dsc = sysinstall.DistSetConfig(self.releaseSection, self.config)
+        self.assertEquals(dsc.distSets, {'src' : ['szomg', 'swtf'], 'base' : ['base'], 'kernels' : ['GENERIC']})
         
     def test_serialize(self):
         """
@@ -231,6 +288,35 @@ class PackageConfigTestCase(ConfigTestCase, unittest.TestCase):
         pkgc.serialize(output)
         self.assertEquals(output.getvalue(), 'command=/dist/install_package.sh %s\nsystem\n' % (package.package))
 
+class PackageBatchConfigTestCase(ConfigTestCase, unittest.TestCase):
+    def test_serialize(self):
+        """
+        Serialize a PackageBatchConfig
+        """
+        output = StringIO()
+        pkgc = sysinstall.PackageBatchConfig(['sudo', 'mysql50-server'])
+        pkgc.serialize(output)
+        self.assertEquals(output.getvalue(), 'command=/dist/install_package.sh sudo mysql50-server\nsystem\n')
+
+    def test_serializeList(self):
+        """
+        Serialize a PackageBatchConfig installing from a package list
+        """
+        output = StringIO()
+        pkgc = sysinstall.PackageBatchConfig(['sudo', 'mysql50-server'], '/dist/install/test.packages')
+        pkgc.serialize(output)
+        self.assertEquals(output.getvalue(), 'command=/dist/install_package.sh -l /dist/install/test.packages\nsystem\n')
+
+class PackageImageConfigTestCase(unittest.TestCase):
+    def test_serialize(self):
+        """
+        Serialize a PackageImageConfig
+        """
+        output = StringIO()
+        pkgc = sysinstall.PackageImageConfig('/dist/images/test.tgz')
+        pkgc.serialize(output)
+        self.assertEquals(output.getvalue(), 'command=/usr/bin/tar -xpzf /dist/images/test.tgz -C /\nsystem\n')
+
 class SystemCommandConfigTestCase(ConfigTestCase, unittest.TestCase):
     def test_init(self):
         """
@@ -280,6 +366,29 @@ class InstallationConfigTestCase(ConfigTestCase, unittest.TestCase):
         inst.serialize(output)
         assert(string.find(output.getvalue(), expectedOutput) >= 0)
 
+    def test_batchPackages(self):
+        """
+        Test installing all packages with a single system command
+        """
+        inst = sysinstall.InstallationConfig(self.instSectionNoCommands, self.config)
+        self.assertEquals(len(inst.packageConfigs), 1)
+        packages = [pkgc.package for pkgc in sysinstall.InstallationConfig(self.instSection, self.config).packageConfigs]
+        self.assertEquals(inst.packageConfigs[0].packages, packages)
+        self.assertEquals(inst.packageConfigs[0].listPath, '/dist/install/test2.packages')
+
+        output = StringIO()
+        inst.serialize(output)
+        self.assertEquals(string.count(output.getvalue(), 'install_package.sh'), 1)
+
+    def test_packageImage(self):
+        """
+        Test installing all packages from a package image
+        """
+        self.instSectionNoCommands.packageimage = True
+        inst = sysinstall.InstallationConfig(self.instSectionNoCommands, self.config)
+        self.assertEquals(len(inst.packageConfigs), 1)
+        self.assertEquals(inst.packageConfigs[0].imagePath, '/dist/images/test2.tgz')
+
     def test_serialize(self):
         """
         Serialize an InstallationConfig
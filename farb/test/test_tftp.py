@@ -0,0 +1,234 @@
+# test_tftp.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+
+""" TFTP Server Unit Tests """
+
+import os
+import select
+import shutil
+import socket
+import struct
+import unittest
+
+from farb import tftp
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+TFTP_ROOT = os.path.join(DATA_DIR, 'tftproot')
+
+class TFTPClient(object):
+    """
+    Minimal TFTP client, stepping the server between packets
+    """
+    def __init__(self, server):
+        self.server = server
+        self.address = ('127.0.0.1', server.getAddress()[1])
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+
+    def close(self):
+        self.socket.close()
+
+    def send(self, packet, address=None):
+        self.socket.sendto(packet, address or self.address)
+
+    def receive(self):
+        """
+        @return Tuple of (opcode, payload, address)
+        """
+        for i in range(50):
+            self.server.serve(0.01)
+            if (select.select([self.socket], [], [], 0)[0]):
+                packet, address = self.socket.recvfrom(tftp.MAX_PACKET)
+                return struct.unpack('!H', packet[:2])[0], packet[2:], address
+        raise AssertionError, "No response from server"
+
+    def request(self, filename, options={}, opcode=tftp.OP_RRQ):
+        packet = struct.pack('!H', opcode) + filename + '\0octet\0'
+        for name, value in options.items():
+            packet += '%s\0%s\0' % (name, value)
+        self.send(packet)
+
+    def fetch(self, filename, options={}, ackEvery=None):
+        """
+        Fetch a file
+        @param ackEvery: Acknowledge every n'th block, rather than the last
+            block of each window
+        @return Tuple of (data, negotiated options)
+        """
+        self.request(filename, options)
+        blksize = 512
+        windowsize = 1
+        negotiated = {}
+        data = ''
+        block = 0
+
+        opcode, payload, tid = self.receive()
+        if (opcode == tftp.OP_OACK):
+            fields = payload.split('\0')[:-1]
+            for i in range(0, len(fields), 2):
+                negotiated[fields[i]] = fields[i + 1]
+            blksize = int(negotiated.get('blksize', blksize))
+            windowsize = int(negotiated.get('windowsize', windowsize))
+            self.send(struct.pack('!HH', tftp.OP_ACK, 0), tid)
+            opcode, payload, tid = self.receive()
+
+        ackEvery = ackEvery or windowsize
+        while (True):
+            if (opcode != tftp.OP_DATA):
+                raise AssertionError, "Unexpected opcode %d" % opcode
+            number = struct.unpack('!H', payload[:2])[0]
+            if (number == (block + 1) & 0xffff):
+                block += 1
+                data += payload[2:]
+                last = len(payload) - 2 < blksize
+                if (last or block % ackEvery == 0):
+                    self.send(struct.pack('!HH', tftp.OP_ACK, block & 0xffff), tid)
+                if (last):
+                    break
+            opcode, payload, tid = self.receive()
+
+        # Let the server reap the transfer
+        self.server.serve(0)
+        return data, negotiated
+
+class TFTPServerTestCase(unittest.TestCase):
+    def setUp(self):
+        os.mkdir(TFTP_ROOT)
+        os.mkdir(os.path.join(TFTP_ROOT, 'boot'))
+        self.kernel = ''.join([chr(i % 251) for i in xrange(10000)])
+        self._writeFile('boot/kernel', self.kernel)
+        self._writeFile('boot/empty', '')
+        self._writeFile('boot/exact', 'x' * 2048)
+        self._writeFile(os.path.join('..', 'secret'), 'secret')
+
+        self.server = tftp.TFTPServer(TFTP_ROOT, ('127.0.0.1', 0))
+        self.client = TFTPClient(self.server)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(TFTP_ROOT)
+        os.unlink(os.path.join(DATA_DIR, 'secret'))
+
+    def _writeFile(self, name, data):
+        f = open(os.path.join(TFTP_ROOT, name), 'wb')
+        f.write(data)
+        f.close()
+
+    def test_fetch(self):
+        data, options = self.client.fetch('boot/kernel')
+        self.assertEquals(data, self.kernel)
+        self.assertEquals(options, {})
+        self.assertEquals(self.server.transfers, {})
+        self.assertEquals(self.server.files.files, {})
+
+    def test_fetchAbsolute(self):
+        data, options = self.client.fetch('/boot/kernel')
+        self.assertEquals(data, self.kernel)
+
+    def test_fetchEmpty(self):
+        data, options = self.client.fetch('boot/empty')
+        self.assertEquals(data, '')
+
+    def test_fetchOptions(self):
+        data, options = self.client.fetch('boot/kernel', {'blksize' : 1024, 'tsize' : 0, 'windowsize' : 4, 'unknown' : 1})
+        self.assertEquals(data, self.kernel)
+        self.assertEquals(options, {'blksize' : '1024', 'tsize' : str(len(self.kernel)), 'windowsize' : '4'})
+
+    def test_fetchExactBlocks(self):
+        # A file that is a multiple of the block size ends in an empty block
+        data, options = self.client.fetch('boot/exact', {'blksize' : 1024, 'windowsize' : 2})
+        self.assertEquals(data, 'x' * 2048)
+
+    def test_fetchPartialWindow(self):
+        # Acknowledging part of a window restarts the window after the
+        # acknowledged block
+        data, options = self.client.fetch('boot/kernel', {'blksize' : 512, 'windowsize' : 8}, ackEvery=3)
+        self.assertEquals(data, self.kernel)
+
+    def test_negotiateLimits(self):
+        server = tftp.TFTPServer(TFTP_ROOT, ('127.0.0.1', 0), maxBlockSize=1468, maxWindowSize=2)
+        client = TFTPClient(server)
+        try:
+            data, options = client.fetch('boot/kernel', {'blksize' : 65464, 'windowsize' : 16, 'timeout' : 0})
+            self.assertEquals(data, self.kernel)
+            self.assertEquals(options, {'blksize' : '1468', 'windowsize' : '2'})
+        finally:
+            client.close()
+            server.close()
+
+    def test_sharedFile(self):
+        self.client.request('boot/kernel')
+        opcode, payload, tid = self.client.receive()
+        other = TFTPClient(self.server)
+        try:
+            data, options = other.fetch('boot/kernel')
+            self.assertEquals(data, self.kernel)
+            self.assertEquals(len(self.server.files.files), 1)
+        finally:
+            other.close()
+
+    def test_notFound(self):
+        self.client.request('boot/missing')
+        opcode, payload, tid = self.client.receive()
+        self.assertEquals(opcode, tftp.OP_ERROR)
+        self.assertEquals(struct.unpack('!H', payload[:2])[0], tftp.ERR_NOT_FOUND)
+
+    def test_outsideRoot(self):
+        self.client.request('../secret')
+        opcode, payload, tid = self.client.receive()
+        self.assertEquals(opcode, tftp.OP_ERROR)
+        self.assertEquals(struct.unpack('!H', payload[:2])[0], tftp.ERR_ACCESS)
+
+    def test_write(self):
+        self.client.request('boot/kernel', opcode=tftp.OP_WRQ)
+        opcode, payload, tid = self.client.receive()
+        self.assertEquals(opcode, tftp.OP_ERROR)
+        self.assertEquals(struct.unpack('!H', payload[:2])[0], tftp.ERR_ACCESS)
+
+    def test_unknownTID(self):
+        self.client.request('boot/kernel')
+        opcode, payload, tid = self.client.receive()
+        other = TFTPClient(self.server)
+        try:
+            other.send(struct.pack('!HH', tftp.OP_ACK, 1), tid)
+            opcode, payload, address = other.receive()
+            self.assertEquals(opcode, tftp.OP_ERROR)
+            self.assertEquals(struct.unpack('!H', payload[:2])[0], tftp.ERR_UNKNOWN_TID)
+        finally:
+            other.close()
+
+    def test_parseRequest(self):
+        packet = struct.pack('!H', tftp.OP_RRQ) + 'boot/kernel\0OCTET\0BLKSIZE\x001024\0'
+        self.assertEquals(tftp.parseRequest(packet), ('boot/kernel', 'octet', {'blksize' : '1024'}))
+        self.assertRaises(tftp.TFTPRequestError, tftp.parseRequest, packet[:-1])
+
+    def test_listenFailure(self):
+        self.assertRaises(tftp.TFTPServerError, tftp.TFTPServer, TFTP_ROOT, ('127.0.0.1', self.server.getAddress()[1]))
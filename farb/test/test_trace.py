@@ -0,0 +1,193 @@
+# test_trace.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+
+
+""" Trace Unit Tests """
+
+import os
+import threading
+import unittest
+
+from farb import builder, runner, trace
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+TRACE_FILE = os.path.join(DATA_DIR, 'trace.jsonl')
+CHROME_TRACE_FILE = os.path.join(DATA_DIR, 'trace.json')
+
+class Traced(object):
+    def __init__(self, name):
+        self.name = name
+
+    @trace.traced('step', 'work %(name)s', lambda value: {'value' : value})
+    def work(self, fail=False):
+        if (fail):
+            raise builder.CommandError, "boom"
+        return 42
+
+class TraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tracer = trace.Tracer(TRACE_FILE)
+        trace.setTracer(self.tracer)
+
+    def tearDown(self):
+        trace.setTracer(None)
+        self.tracer.close()
+        for path in (TRACE_FILE, CHROME_TRACE_FILE):
+            if (os.path.exists(path)):
+                os.unlink(path)
+
+    def _read(self):
+        self.tracer.close()
+        return trace.readTrace(TRACE_FILE)
+
+    def test_nesting(self):
+        """ Test that spans nest within the thread's open spans """
+        outer = trace.begin('outer', 'phase')
+        self.assertEquals(trace.getCurrent(), outer)
+        inner = trace.begin('inner', 'step', {'detail' : 'x'})
+        trace.end(inner, {'bytes' : 10})
+        trace.end(outer)
+        self.assertEquals(trace.getCurrent(), None)
+
+        spans = self._read()
+        self.assertEquals([span['name'] for span in spans], ['outer', 'inner'])
+        self.assertEquals(spans[0]['parent'], None)
+        self.assertEquals(spans[1]['parent'], spans[0]['id'])
+        self.assertEquals(spans[1]['args'], {'detail' : 'x'})
+        self.assertEquals(spans[1]['results'], {'bytes' : 10})
+        self.assert_(spans[0]['end'] >= spans[1]['end'])
+
+    def test_threads(self):
+        """ Test that spans begun by other threads are independent """
+        outer = trace.begin('outer', 'phase')
+        def worker():
+            trace.adopt(outer)
+            trace.end(trace.begin('worker', 'task'))
+        thread = threading.Thread(target=worker, name='worker')
+        thread.start()
+        thread.join()
+        trace.end(outer)
+
+        spans = self._read()
+        self.assertEquals(spans[1]['thread'], 'worker')
+        self.assertEquals(spans[1]['parent'], spans[0]['id'])
+
+    def test_traced(self):
+        """ Test tracing method calls """
+        self.assertEquals(Traced('a').work(), 42)
+        self.assertRaises(builder.CommandError, Traced('b').work, True)
+        spans = self._read()
+        self.assertEquals([span['name'] for span in spans], ['work a', 'work b'])
+        self.assertEquals(spans[0]['results'], {'value' : 42})
+        self.assertEquals(spans[1]['results'], {'error' : 'boom'})
+
+    def test_listeners(self):
+        """ Test that listeners are notified of completed spans """
+        completed = []
+        self.tracer.addListener(completed.append)
+        outer = trace.begin('outer', 'phase')
+        Traced('a').work()
+        self.assertEquals([span['name'] for span in completed], ['work a'])
+        trace.end(outer)
+        self.assertEquals(completed[0]['results'], {'value' : 42})
+        self.assertEquals(completed[0]['parent'], outer)
+        self.assertEquals(completed[1]['name'], 'outer')
+        self.assert_(completed[1]['end'] >= completed[1]['ts'])
+
+    def test_withoutFile(self):
+        """ Test notifying listeners without writing a trace file """
+        tracer = trace.Tracer()
+        trace.setTracer(tracer)
+        completed = []
+        tracer.addListener(completed.append)
+        Traced('a').work()
+        tracer.close()
+        self.assertEquals([span['name'] for span in completed], ['work a'])
+
+    def test_commands(self):
+        """ Test that commands are traced within the span that ran them """
+        log = open(os.devnull, 'w')
+        try:
+            span = trace.begin('outer', 'phase')
+            builder._runCommand(['/bin/cat'], log, builder.CommandError, input=['abc'])
+            self.assertRaises(builder.CommandError, builder._runCommand, ['/bin/sh', '-c', 'exit 2'], log, builder.CommandError)
+            trace.end(span)
+        finally:
+            log.close()
+
+        spans = self._read()
+        self.assertEquals([span['name'] for span in spans], ['outer', 'cat', 'sh'])
+        self.assertEquals(spans[1]['parent'], spans[0]['id'])
+        self.assertEquals(spans[1]['args']['argv'], ['/bin/cat'])
+        self.assertEquals(spans[1]['results']['exitCode'], 0)
+        self.assertEquals(spans[1]['results']['bytesWritten'], 3)
+        self.assertEquals(spans[1]['results']['bytesRead'], 3)
+        self.assertEquals(spans[2]['results']['exitCode'], 2)
+
+    def test_tasks(self):
+        """ Test that scheduled tasks are traced """
+        scheduler = runner.TaskScheduler(2)
+        scheduler.add('a', lambda: None)
+        scheduler.add('b', lambda: None, ['a'])
+        span = trace.begin('pipeline', 'phase')
+        scheduler.run()
+        trace.end(span)
+
+        spans = self._read()
+        self.assertEquals([(span['name'], span['category'], span['thread']) for span in spans[1:]], [('a', 'task', 'a'), ('b', 'task', 'b')])
+        self.assertEquals(spans[1]['parent'], spans[0]['id'])
+
+    def test_exportChromeTrace(self):
+        """ Test conversion to the Chrome trace format """
+        outer = trace.begin('outer', 'phase')
+        trace.end(trace.begin('inner', 'step'), {'bytes' : 10})
+        # Never ended
+        trace.begin('unfinished', 'step')
+        trace.end(outer)
+        self.tracer.close()
+
+        trace.exportChromeTrace(TRACE_FILE, CHROME_TRACE_FILE)
+        f = open(CHROME_TRACE_FILE, 'r')
+        try:
+            events = trace.json.load(f)['traceEvents']
+        finally:
+            f.close()
+
+        self.assertEquals(events[0]['ph'], 'M')
+        self.assertEquals(events[0]['args'], {'name' : threading.currentThread().getName()})
+        complete = events[1:]
+        self.assertEquals([event['name'] for event in complete], ['outer', 'inner', 'unfinished'])
+        self.assertEquals(complete[0]['ts'], 0)
+        self.assertEquals(complete[1]['args'], {'bytes' : 10})
+        self.assertEquals(complete[2]['args'], {'unfinished' : True})
+        for event in complete:
+            self.assertEquals(event['ph'], 'X')
+            self.assert_(event['dur'] >= 0)
+            self.assertEquals(event['tid'], events[0]['tid'])
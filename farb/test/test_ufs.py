@@ -0,0 +1,612 @@
+# test_ufs.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" UFS Image Unit Tests """
+
+import gzip
+import os
+import struct
+import unittest
+
+from farb import ufs
+
+# Useful Constants
+from farb.test import DATA_DIR
+
+UFS_IMAGE = os.path.join(DATA_DIR, 'test.ufs')
+
+# Images made by newfs and makefs; see mkimages.sh
+UFS1_FIXTURE = os.path.join(DATA_DIR, 'ufs', 'ufs1.img.gz')
+UFS2_FIXTURE = os.path.join(DATA_DIR, 'ufs', 'ufs2.img.gz')
+
+# Geometry of the test file systems
+FSIZE = 1024
+BSIZE = 8192
+FRAG = 8
+NFRAGS = 512
+IPG = 64
+CONTIGSUMSIZE = 4
+
+#
+# The on-disk layout below is taken from FreeBSD's <ufs/ffs/fs.h>,
+# <ufs/ufs/dinode.h> and <ufs/ufs/dir.h>. It is written out here rather
+# than imported from farb.ufs, so that a mistake in farb.ufs's layout
+# isn't repeated by the images and checks it is tested against.
+#
+
+# Superblock locations and magic numbers
+SBLOCK_UFS1 = 8192
+SBLOCK_UFS2 = 65536
+UFS1_MAGIC = 0x011954
+UFS2_MAGIC = 0x19540119
+CG_MAGIC = 0x090255
+
+# struct fs: (offset, format)
+SB_LAYOUT = {
+    'sblkno':       (8, 'i'),
+    'cblkno':       (12, 'i'),
+    'iblkno':       (16, 'i'),
+    'dblkno':       (20, 'i'),
+    'old_cgoffset': (24, 'i'),
+    'old_cgmask':   (28, 'i'),
+    'ncg':          (44, 'i'),
+    'bsize':        (48, 'i'),
+    'fsize':        (52, 'i'),
+    'frag':         (56, 'i'),
+    'sbsize':       (104, 'i'),
+    'nindir':       (116, 'i'),
+    'inopb':        (120, 'i'),
+    'old_csaddr':   (152, 'i'),
+    'cssize':       (156, 'i'),
+    'cgsize':       (160, 'i'),
+    'ipg':          (184, 'i'),
+    'fpg':          (188, 'i'),
+    'old_cstotal':  (192, '4i'),
+    'clean':        (209, 'b'),
+    'old_flags':    (211, 'B'),
+    'cstotal':      (1008, '4q'),
+    'csaddr':       (1096, 'q'),
+    'contigsumsize': (1316, 'i'),
+    'old_inodefmt': (1324, 'i'),
+    'magic':        (1372, 'i'),
+}
+
+# struct cg
+CG_LAYOUT = {
+    'magic':        (4, 'i'),
+    'ndblk':        (20, 'i'),
+    'cs':           (24, '4i'),
+    'frsum':        (52, '8i'),
+    'iusedoff':     (92, 'i'),
+    'freeoff':      (96, 'i'),
+    'clustersumoff': (104, 'i'),
+    'clusteroff':   (108, 'i'),
+    'nclusterblks': (112, 'i'),
+    'niblk':        (116, 'i'),
+    'initediblk':   (120, 'i'),
+}
+
+# struct ufs1_dinode and struct ufs2_dinode
+UFS1_DINODE = {
+    'mode':         (0, 'H'),
+    'nlink':        (2, 'h'),
+    'size':         (8, 'Q'),
+    'db':           (40, '12i'),
+    'ib':           (88, '3i'),
+    'blocks':       (104, 'i'),
+}
+
+UFS2_DINODE = {
+    'mode':         (0, 'H'),
+    'nlink':        (2, 'h'),
+    'size':         (16, 'Q'),
+    'blocks':       (24, 'Q'),
+    'db':           (112, '12q'),
+    'ib':           (208, '3q'),
+}
+
+FS_FLAGS_UPDATED = 0x80
+FS_44INODEFMT = 2
+IFMT = 0170000
+IFDIR = 0040000
+ROOT_INO = 2
+DIRBLK = 512
+DT_DIR = 4
+
+def _get(data, layout, name, base=0):
+    offset, fmt = layout[name]
+    value = struct.unpack_from('<' + fmt, data, base + offset)
+    if (len(value) == 1):
+        return value[0]
+    return list(value)
+
+def _set(buf, layout, name, value, base=0):
+    offset, fmt = layout[name]
+    if (not isinstance(value, list)):
+        value = [value]
+    struct.pack_into('<' + fmt, buf, base + offset, *value)
+
+def _setbit(buf, base, bit):
+    buf[base + (bit >> 3)] |= 1 << (bit & 7)
+
+def _isset(data, base, bit):
+    return (ord(data[base + (bit >> 3)]) & (1 << (bit & 7))) != 0
+
+def makeImage(path, ufs2=False):
+    """
+    Create a single cylinder group file system containing an empty
+    root directory.
+    @param path: Image path
+    @param ufs2: Create a UFS2 file system, rather than UFS1
+    """
+    if (ufs2):
+        sblockloc = SBLOCK_UFS2
+        magic = UFS2_MAGIC
+        isize = 256
+        addrsize = 8
+        dinode = UFS2_DINODE
+    else:
+        sblockloc = SBLOCK_UFS1
+        magic = UFS1_MAGIC
+        isize = 128
+        addrsize = 4
+        dinode = UFS1_DINODE
+
+    sblkno = sblockloc / FSIZE
+    cblkno = sblkno + FRAG
+    iblkno = cblkno + FRAG
+    dblkno = iblkno + IPG * isize / FSIZE
+    csaddr = dblkno
+    rootblk = csaddr + 1
+    inopb = BSIZE / isize
+
+    # Free space: the remainder of the root directory's block, and whole
+    # blocks from there on
+    nffree = FRAG - (rootblk + 1) % FRAG
+    nbfree = (NFRAGS - (rootblk + 1) - nffree) / FRAG
+    cs = [1, nbfree, IPG - 3, nffree]
+    frsum = [0] * 8
+    frsum[nffree] = 1
+
+    image = bytearray(NFRAGS * FSIZE)
+
+    # Superblock
+    for name, value in (('magic', magic), ('bsize', BSIZE), ('fsize', FSIZE),
+            ('frag', FRAG), ('sbsize', 2048), ('ncg', 1), ('fpg', NFRAGS),
+            ('ipg', IPG), ('inopb', inopb), ('nindir', BSIZE / addrsize),
+            ('sblkno', sblkno), ('cblkno', cblkno), ('iblkno', iblkno),
+            ('dblkno', dblkno), ('old_cgoffset', 0), ('old_cgmask', -1),
+            ('cgsize', BSIZE), ('old_csaddr', csaddr), ('csaddr', csaddr),
+            ('cssize', FSIZE), ('contigsumsize', CONTIGSUMSIZE), ('clean', 1),
+            ('old_flags', FS_FLAGS_UPDATED), ('old_inodefmt', FS_44INODEFMT),
+            ('old_cstotal', cs), ('cstotal', cs)):
+        _set(image, SB_LAYOUT, name, value, sblockloc)
+
+    # Summary information
+    struct.pack_into('<4i', image, csaddr * FSIZE, *cs)
+
+    # Cylinder group
+    cgbase = cblkno * FSIZE
+    for name, value in (('magic', CG_MAGIC), ('ndblk', NFRAGS), ('cs', cs),
+            ('frsum', frsum), ('iusedoff', 168), ('freeoff', 176),
+            ('clustersumoff', 236), ('clusteroff', 256),
+            ('nclusterblks', NFRAGS / FRAG), ('niblk', IPG),
+            ('initediblk', inopb)):
+        _set(image, CG_LAYOUT, name, value, cgbase)
+    for ino in range(ROOT_INO + 1):
+        _setbit(image, cgbase + 168, ino)
+    for frag in range(rootblk + 1, NFRAGS):
+        _setbit(image, cgbase + 176, frag)
+    for blk in range((rootblk + 1 + nffree) / FRAG, NFRAGS / FRAG):
+        _setbit(image, cgbase + 256, blk)
+    struct.pack_into('<i', image, cgbase + 236 + CONTIGSUMSIZE * 4, 1)
+
+    # Root directory
+    offset = iblkno * FSIZE + ROOT_INO * isize
+    for name, value in (('mode', IFDIR | 0755), ('nlink', 2),
+            ('size', DIRBLK), ('blocks', FSIZE / 512),
+            ('db', [rootblk] + [0] * 11)):
+        _set(image, dinode, name, value, offset)
+
+    entries = struct.pack('<IHBB4s', ROOT_INO, 12, DT_DIR, 1, '.')
+    entries += struct.pack('<IHBB4s', ROOT_INO, DIRBLK - 12, DT_DIR, 2, '..')
+    image[rootblk * FSIZE:rootblk * FSIZE + len(entries)] = entries
+
+    output = open(path, 'wb')
+    output.write(str(image))
+    output.close()
+
+class ImageChecker(object):
+    """
+    Check a file system image's allocation maps and summary counts, as
+    fsck's passes 1, 4 and 5 would, and read files back from it. Only
+    little-endian images whose files have no indirect blocks are
+    supported.
+    """
+    def __init__(self, path):
+        """
+        @param path: Image path
+        """
+        input = open(path, 'rb')
+        self.data = input.read()
+        input.close()
+
+        for sblockloc, magic in ((SBLOCK_UFS2, UFS2_MAGIC), (SBLOCK_UFS1, UFS1_MAGIC)):
+            if (len(self.data) >= sblockloc + 2048 and _get(self.data, SB_LAYOUT, 'magic', sblockloc) == magic):
+                break
+        else:
+            raise AssertionError, "No superblock in %s" % (path)
+        self.sblockloc = sblockloc
+        self.ufs2 = (magic == UFS2_MAGIC)
+        if (self.ufs2):
+            self.dinode = UFS2_DINODE
+            self.isize = 256
+            self.csaddr = self.sb('csaddr')
+        else:
+            self.dinode = UFS1_DINODE
+            self.isize = 128
+            self.csaddr = self.sb('old_csaddr')
+
+        self.fsize = self.sb('fsize')
+        self.bsize = self.sb('bsize')
+        self.frag = self.sb('frag')
+        self.fpg = self.sb('fpg')
+        self.ipg = self.sb('ipg')
+        self.inopb = self.sb('inopb')
+        self.ncg = self.sb('ncg')
+
+    def sb(self, name):
+        return _get(self.data, SB_LAYOUT, name, self.sblockloc)
+
+    def _cgbase(self, cgx):
+        return self.fpg * cgx
+
+    def _cgstart(self, cgx):
+        start = self._cgbase(cgx)
+        if (not self.ufs2):
+            start += self.sb('old_cgoffset') * (cgx & ~self.sb('old_cgmask'))
+        return start
+
+    def _cgOffset(self, cgx):
+        offset = (self._cgstart(cgx) + self.sb('cblkno')) * self.fsize
+        if (_get(self.data, CG_LAYOUT, 'magic', offset) != CG_MAGIC):
+            raise AssertionError, "Bad magic number in cylinder group %d" % (cgx)
+        return offset
+
+    def cg(self, cgx, name):
+        return _get(self.data, CG_LAYOUT, name, self._cgOffset(cgx))
+
+    def inode(self, ino, name):
+        cgx = ino / self.ipg
+        fsbn = self._cgstart(cgx) + self.sb('iblkno') + (ino % self.ipg) / self.inopb * self.frag
+        return _get(self.data, self.dinode, name, fsbn * self.fsize + (ino % self.inopb) * self.isize)
+
+    def _allocated(self, ino):
+        return ino >= ROOT_INO and self.inode(ino, 'mode') != 0
+
+    def _inodes(self):
+        """
+        @return The numbers of the inodes that have been initialized
+        """
+        inodes = []
+        for cgx in range(self.ncg):
+            count = self.ipg
+            if (self.ufs2):
+                count = self.cg(cgx, 'initediblk')
+            inodes.extend(range(cgx * self.ipg, cgx * self.ipg + count))
+        return inodes
+
+    def _frags(self, ino):
+        """
+        @return The fragments allocated to an inode's data
+        """
+        if (self.inode(ino, 'ib') != [0, 0, 0]):
+            raise AssertionError, "Inode %d has indirect blocks" % (ino)
+        size = self.inode(ino, 'size')
+        if (self.inode(ino, 'blocks') == 0):
+            # Short symlinks and device nodes
+            return []
+        frags = []
+        db = self.inode(ino, 'db')
+        nblocks = (size + self.bsize - 1) / self.bsize
+        for lbn in range(nblocks):
+            if (size >= (lbn + 1) * self.bsize):
+                nfrags = self.frag
+            else:
+                nfrags = ((size % self.bsize) + self.fsize - 1) / self.fsize
+            frags.extend(range(db[lbn], db[lbn] + nfrags))
+        return frags
+
+    def _metadata(self, cgx):
+        """
+        @return The fragments of a cylinder group used by the boot area,
+            superblock, cylinder group and inode blocks, and summary
+            information
+        """
+        if (cgx == 0):
+            start = self._cgbase(cgx)
+        else:
+            start = self._cgstart(cgx) + self.sb('sblkno')
+        frags = range(start, self._cgstart(cgx) + self.sb('dblkno'))
+        if (self.csaddr / self.fpg == cgx):
+            nfrags = (self.sb('cssize') + self.fsize - 1) / self.fsize
+            frags.extend(range(self.csaddr, self.csaddr + nfrags))
+        return frags
+
+    def check(self):
+        """
+        Check the image, raising an AssertionError on the first
+        inconsistency found
+        """
+        # Pass 1: gather the fragments in use, and check each inode's
+        # block count
+        used = {}
+        for cgx in range(self.ncg):
+            for frag in self._metadata(cgx):
+                used[frag] = 0
+        inodes = {}
+        for ino in self._inodes():
+            if (self._allocated(ino)):
+                inodes[ino] = True
+        for ino in inodes.keys():
+            frags = self._frags(ino)
+            for frag in frags:
+                if (used.has_key(frag)):
+                    raise AssertionError, "Fragment %d of inode %d is also used by %s" % (frag, ino, used[frag] or 'metadata')
+                used[frag] = ino
+            if (self.inode(ino, 'blocks') != len(frags) * self.fsize / 512):
+                raise AssertionError, "Inode %d has a block count of %d, but %d fragments" % (ino, self.inode(ino, 'blocks'), len(frags))
+
+        # Pass 4: link counts
+        links = {}
+        for ino, name, type in self._walk(ROOT_INO):
+            links[ino] = links.get(ino, 0) + 1
+        for ino in inodes.keys():
+            if (self.inode(ino, 'nlink') != links.get(ino, 0)):
+                raise AssertionError, "Inode %d has a link count of %d, but %d links" % (ino, self.inode(ino, 'nlink'), links.get(ino, 0))
+
+        # Pass 5: maps and summaries
+        total = [0, 0, 0, 0]
+        csoffset = self.csaddr * self.fsize
+        for cgx in range(self.ncg):
+            offset = self._cgOffset(cgx)
+            iusedoff = offset + self.cg(cgx, 'iusedoff')
+            freeoff = offset + self.cg(cgx, 'freeoff')
+            ndblk = self.cg(cgx, 'ndblk')
+            base = self._cgbase(cgx)
+
+            ndir = 0
+            nifree = 0
+            for i in range(self.ipg):
+                ino = cgx * self.ipg + i
+                inuse = ino < ROOT_INO or inodes.has_key(ino)
+                if (_isset(self.data, iusedoff, i) != inuse):
+                    raise AssertionError, "Inode %d is wrongly marked in the inode map" % (ino)
+                if (not inuse):
+                    nifree += 1
+                elif (ino >= ROOT_INO and self.inode(ino, 'mode') & IFMT == IFDIR):
+                    ndir += 1
+
+            nbfree = 0
+            nffree = 0
+            for blk in range(0, ndblk, self.frag):
+                free = 0
+                for i in range(blk, min(blk + self.frag, ndblk)):
+                    isfree = _isset(self.data, freeoff, i)
+                    if (isfree == used.has_key(base + i)):
+                        raise AssertionError, "Fragment %d is wrongly marked in the free map" % (base + i)
+                    free += isfree
+                if (free == self.frag):
+                    nbfree += 1
+                else:
+                    nffree += free
+
+            cs = [ndir, nbfree, nifree, nffree]
+            if (self.cg(cgx, 'cs') != cs):
+                raise AssertionError, "Cylinder group %d summary %s, should be %s" % (cgx, self.cg(cgx, 'cs'), cs)
+            csum = list(struct.unpack_from('<4i', self.data, csoffset + cgx * 16))
+            if (csum != cs):
+                raise AssertionError, "Summary information for cylinder group %d %s, should be %s" % (cgx, csum, cs)
+            total = [a + b for a, b in zip(total, cs)]
+
+        if (self.ufs2 or self.sb('old_flags') & FS_FLAGS_UPDATED):
+            if (self.sb('cstotal') != total):
+                raise AssertionError, "Superblock summary %s, should be %s" % (self.sb('cstotal'), total)
+        if (not self.ufs2 and self.sb('old_cstotal') != total):
+            raise AssertionError, "Superblock summary %s, should be %s" % (self.sb('old_cstotal'), total)
+
+    def _contents(self, ino):
+        data = ''.join([self.data[frag * self.fsize:(frag + 1) * self.fsize] for frag in self._frags(ino)])
+        return data[:self.inode(ino, 'size')]
+
+    def _entries(self, ino):
+        """
+        @return The (inode, name, type) entries of a directory
+        """
+        data = self._contents(ino)
+        entries = []
+        for start in range(0, len(data), DIRBLK):
+            offset = start
+            while (offset < start + DIRBLK):
+                entry, reclen, type, namlen = struct.unpack_from('<IHBB', data, offset)
+                if (reclen == 0):
+                    raise AssertionError, "Empty directory entry in inode %d" % (ino)
+                if (entry != 0):
+                    entries.append((entry, data[offset + 8:offset + 8 + namlen], type))
+                offset += reclen
+        return entries
+
+    def _walk(self, ino):
+        """
+        @return The entries of a directory and of all the directories
+            below it
+        """
+        entries = self._entries(ino)
+        for entry, name, type in list(entries):
+            if (type == DT_DIR and name not in ('.', '..')):
+                entries.extend(self._walk(entry))
+        return entries
+
+    def readFile(self, path):
+        """
+        @param path: Path of a file in the image
+        @return The file's contents
+        """
+        ino = ROOT_INO
+        for name in [name for name in path.split('/') if name]:
+            for entry, entryName, type in self._entries(ino):
+                if (entryName == name):
+                    ino = entry
+                    break
+            else:
+                raise AssertionError, "%s not found" % (path)
+        return self._contents(ino)
+
+class UFSImageTestCase(unittest.TestCase):
+    ufs2 = False
+
+    def setUp(self):
+        makeImage(UFS_IMAGE, self.ufs2)
+        self.image = ufs.UFSImage(UFS_IMAGE)
+
+    def tearDown(self):
+        self.image.close()
+        if (os.path.exists(UFS_IMAGE)):
+            os.unlink(UFS_IMAGE)
+
+    def _summary(self):
+        """
+        Check the image, and return its summary information
+        """
+        checker = ImageChecker(UFS_IMAGE)
+        checker.check()
+        return checker.cg(0, 'cs')
+
+    def _freeFrags(self, cs):
+        return cs[1] * FRAG + cs[3]
+
+    def test_writeFile(self):
+        before = self._summary()
+        self.image.writeFile('/install.cfg', 'x' * 3000)
+        self.assertEquals(self.image.readFile('/install.cfg'), 'x' * 3000)
+
+        # Reopen the image, and check the accounting
+        self.image.close()
+        self.image = ufs.UFSImage(UFS_IMAGE)
+        self.assertEquals(self.image.readFile('install.cfg'), 'x' * 3000)
+        self.assertEquals(ImageChecker(UFS_IMAGE).readFile('/install.cfg'), 'x' * 3000)
+        after = self._summary()
+        self.assertEquals(self._freeFrags(before) - self._freeFrags(after), 3)
+        self.assertEquals(before[2] - after[2], 1)
+
+    def test_replaceFile(self):
+        before = self._summary()
+        self.image.writeFile('/install.cfg', 'y' * (BSIZE * 2 + 100))
+        self.assertEquals(self._freeFrags(before) - self._freeFrags(self._summary()), FRAG * 2 + 1)
+
+        self.image.writeFile('/install.cfg', 'z' * 10)
+        self.assertEquals(self.image.readFile('/install.cfg'), 'z' * 10)
+        self.assertEquals(ImageChecker(UFS_IMAGE).readFile('/install.cfg'), 'z' * 10)
+        after = self._summary()
+        self.assertEquals(self._freeFrags(before) - self._freeFrags(after), 1)
+        self.assertEquals(before[2] - after[2], 1)
+
+    def test_manyFiles(self):
+        # Enough files to extend the root directory
+        for i in range(40):
+            self.image.writeFile('/file%02d' % i, 'file %d' % i)
+        checker = ImageChecker(UFS_IMAGE)
+        for i in range(40):
+            self.assertEquals(self.image.readFile('/file%02d' % i), 'file %d' % i)
+            self.assertEquals(checker.readFile('/file%02d' % i), 'file %d' % i)
+        self.assert_(checker.inode(ROOT_INO, 'size') > DIRBLK)
+        self.assertEquals(self._summary()[2], IPG - 43)
+
+    def test_errors(self):
+        self.assertRaises(ufs.UFSImageError, self.image.writeFile, '/nonexistent/install.cfg', 'x')
+        self.assertRaises(ufs.UFSImageError, self.image.writeFile, '/install.cfg', 'x' * (12 * BSIZE + 1))
+        self.assertRaises(ufs.UFSImageError, self.image.writeFile, '/..', 'x')
+        self.assertRaises(ufs.UFSImageError, self.image.readFile, '/install.cfg')
+
+    def test_notUFS(self):
+        output = open(UFS_IMAGE, 'wb')
+        output.write('Uncompress worked.\n')
+        output.close()
+        self.assertRaises(ufs.UFSImageError, ufs.UFSImage, UFS_IMAGE)
+
+class UFS2ImageTestCase(UFSImageTestCase):
+    ufs2 = True
+
+class UFSFixtureTestCase(unittest.TestCase):
+    """
+    Write to images made by newfs and makefs
+    """
+    fixture = UFS1_FIXTURE
+
+    def setUp(self):
+        if (not os.path.exists(self.fixture)):
+            self.skipTest("%s has not been generated; see mkimages.sh" % (self.fixture))
+        input = gzip.open(self.fixture, 'rb')
+        output = open(UFS_IMAGE, 'wb')
+        output.write(input.read())
+        output.close()
+        input.close()
+        self.image = ufs.UFSImage(UFS_IMAGE)
+
+    def tearDown(self):
+        if (hasattr(self, 'image')):
+            self.image.close()
+        if (os.path.exists(UFS_IMAGE)):
+            os.unlink(UFS_IMAGE)
+
+    def test_fixture(self):
+        checker = ImageChecker(UFS_IMAGE)
+        checker.check()
+        self.assertEquals(checker.readFile('/etc/motd'), 'Welcome to the test image.\n')
+
+    def test_writeFile(self):
+        data = ''.join([chr(i % 251) for i in range(BSIZE + 3000)])
+        self.image.writeFile('/install.cfg', data)
+        self.image.writeFile('/etc/motd', 'Replaced.\n')
+        self.image.close()
+        checker = ImageChecker(UFS_IMAGE)
+        checker.check()
+        self.assertEquals(checker.readFile('/install.cfg'), data)
+        self.assertEquals(checker.readFile('/etc/motd'), 'Replaced.\n')
+        self.assertEquals(checker.readFile('/etc/rc.conf'), 'hostname="fixture"\n')
+
+        self.image = ufs.UFSImage(UFS_IMAGE)
+        self.image.writeFile('/install.cfg', 'x')
+        self.image.close()
+        checker = ImageChecker(UFS_IMAGE)
+        checker.check()
+        self.assertEquals(checker.readFile('/install.cfg'), 'x')
+
+class UFS2FixtureTestCase(UFSFixtureTestCase):
+    fixture = UFS2_FIXTURE
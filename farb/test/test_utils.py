@@ -29,6 +29,7 @@
 
 """ Misc Utilities Unit Tests """
 
+import gzip
 import os
 import shutil
 import unittest
@@ -65,3 +66,153 @@ class CopyRecursiveTestCase(unittest.TestCase):
         # TODO Would need root running this test in order to test
         # if the ownership copying code works
         self.assert_(os.path.exists(os.path.join(self.copyRecursiveDst, 'Makefile')))
+
+    def test_copyRecursiveIgnore(self):
+        ignore = lambda directory, names: [name for name in names if name == 'Makefile']
+        utils.copyRecursive(BUILDROOT, self.copyRecursiveDst, ignore=ignore)
+        self.assert_(os.path.isdir(self.copyRecursiveDst))
+        self.assert_(not os.path.exists(os.path.join(self.copyRecursiveDst, 'Makefile')))
+
+class LinkIdenticalTestCase(unittest.TestCase):
+    """
+    Test linkIdentical
+    """
+    # Contents of the reference and target trees
+    files = {
+        'README' : 'An install root\n',
+        os.path.join('6.2', 'base', 'base.aa') : 'base' * 1024,
+        os.path.join('6.2', 'base', 'CHECKSUM.MD5') : 'MD5 (base.aa) = 0\n'
+    }
+
+    # Modification time of the files in both trees
+    mtime = 1200000000
+
+    def setUp(self):
+        self.reference = os.path.join(DATA_DIR, 'testreference')
+        self.target = os.path.join(DATA_DIR, 'testtarget')
+        for root in (self.reference, self.target):
+            for name, content in self.files.iteritems():
+                path = os.path.join(root, name)
+                if (not os.path.isdir(os.path.dirname(path))):
+                    os.makedirs(os.path.dirname(path))
+                f = open(path, 'w')
+                f.write(content)
+                f.close()
+                os.utime(path, (self.mtime, self.mtime))
+
+    def tearDown(self):
+        shutil.rmtree(self.reference)
+        shutil.rmtree(self.target)
+
+    def test_linkIdentical(self):
+        shared = utils.linkIdentical(self.reference, self.target)
+        total = 0
+        for name, content in self.files.iteritems():
+            src = os.stat(os.path.join(self.reference, name))
+            dst = os.stat(os.path.join(self.target, name))
+            self.assertEquals(src.st_ino, dst.st_ino)
+            total += len(content)
+        self.assertEquals(shared, total)
+
+    def test_linkChanged(self):
+        # A modified file must not be linked
+        f = open(os.path.join(self.target, 'README'), 'a')
+        f.write('# Changed\n')
+        f.close()
+        os.utime(os.path.join(self.target, 'README'), (self.mtime, self.mtime))
+        shared = utils.linkIdentical(self.reference, self.target)
+        src = os.stat(os.path.join(self.reference, 'README'))
+        dst = os.stat(os.path.join(self.target, 'README'))
+        self.assertNotEquals(src.st_ino, dst.st_ino)
+        self.assertEquals(shared, len(self.files[os.path.join('6.2', 'base', 'base.aa')]) + len(self.files[os.path.join('6.2', 'base', 'CHECKSUM.MD5')]))
+
+    def test_linkModified(self):
+        # A file of the same size, modified at a different time, must not
+        # be linked
+        path = os.path.join(self.target, 'README')
+        f = open(path, 'w')
+        f.write(self.files['README'].upper())
+        f.close()
+        os.utime(path, (self.mtime + 60, self.mtime + 60))
+        utils.linkIdentical(self.reference, self.target)
+        src = os.stat(os.path.join(self.reference, 'README'))
+        dst = os.stat(path)
+        self.assertNotEquals(src.st_ino, dst.st_ino)
+        self.assertEquals(open(path).read(), self.files['README'].upper())
+
+    def test_getTreeSize(self):
+        size = utils.getTreeSize(self.target)
+        self.assertEquals(size, utils.getTreeSize(self.reference))
+        self.assert_(size >= len(self.files[os.path.join('6.2', 'base', 'base.aa')]))
+
+        # Linked files are only counted once
+        shared = utils.linkIdentical(self.reference, self.target)
+        seen = {}
+        utils.getTreeSize(self.reference, seen)
+        self.assertEquals(utils.getTreeSize(self.target, seen), size - shared)
+
+class CopySparseTestCase(unittest.TestCase):
+    """
+    Test copySparse
+    """
+    def setUp(self):
+        self.copySrc = os.path.join(DATA_DIR, 'testsparse')
+        self.copyDst = os.path.join(DATA_DIR, 'testsparsecopy')
+        self.data = 'head' + '\0' * (utils.SPARSE_BLOCKSIZE * 3) + 'tail' + '\0' * utils.SPARSE_BLOCKSIZE
+        f = open(self.copySrc, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        for path in (self.copySrc, self.copyDst):
+            if (os.path.exists(path)):
+                os.unlink(path)
+
+    def test_copySparse(self):
+        utils.copySparse(self.copySrc, self.copyDst)
+        f = open(self.copyDst, 'rb')
+        self.assertEquals(f.read(), self.data)
+        f.close()
+
+    def test_sha1File(self):
+        self.assertEquals(utils.sha1File(self.copySrc), utils.sha1(self.data).hexdigest())
+
+class CompressFileTestCase(unittest.TestCase):
+    """
+    Test compressFile
+    """
+    def setUp(self):
+        self.path = os.path.join(DATA_DIR, 'testcompress')
+        self.data = 'kernel data\n' * 1000
+
+    def tearDown(self):
+        for path in (self.path, self.path + '.gz'):
+            if (os.path.exists(path)):
+                os.unlink(path)
+
+    def _write(self):
+        f = open(self.path, 'wb')
+        f.write(self.data)
+        f.close()
+        os.utime(self.path, (1000000000, 1000000000))
+
+    def test_compressFile(self):
+        self._write()
+        self.assertEquals(utils.compressFile(self.path), self.path + '.gz')
+        self.assert_(not os.path.exists(self.path))
+        self.assertEquals(int(os.stat(self.path + '.gz').st_mtime), 1000000000)
+
+        f = gzip.GzipFile(self.path + '.gz', 'rb')
+        self.assertEquals(f.read(), self.data)
+        f.close()
+
+    def test_deterministic(self):
+        self._write()
+        f = open(utils.compressFile(self.path), 'rb')
+        first = f.read()
+        f.close()
+
+        self._write()
+        f = open(utils.compressFile(self.path), 'rb')
+        self.assertEquals(f.read(), first)
+        f.close()
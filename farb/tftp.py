@@ -0,0 +1,440 @@
+# tftp.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+TFTP server for the network installation root's tftproot.
+
+Only read requests are supported. The blksize (RFC 2348), tsize and
+timeout (RFC 2349) and windowsize (RFC 7440) options are negotiated as
+described by RFC 2347. All transfers are driven by a single select(2)
+loop, and files are read through shared, read-only memory maps, so
+concurrent clients loading the same kernel or mfsroot are served from a
+single copy in the page cache.
+"""
+
+import errno
+import mmap
+import os
+import select
+import socket
+import struct
+import time
+
+import farb
+
+# Opcodes
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+# Error codes
+ERR_UNDEFINED = 0
+ERR_NOT_FOUND = 1
+ERR_ACCESS = 2
+ERR_ILLEGAL_OP = 4
+ERR_UNKNOWN_TID = 5
+
+# Option limits
+DEFAULT_BLKSIZE = 512
+MIN_BLKSIZE = 8
+MAX_BLKSIZE = 65464
+MAX_WINDOWSIZE = 65535
+DEFAULT_TIMEOUT = 1
+MAX_TIMEOUT = 255
+
+# Number of times a window is retransmitted before the transfer is abandoned
+MAX_RETRIES = 5
+
+# Largest possible TFTP packet
+MAX_PACKET = 65536
+
+class TFTPServerError(farb.FarbError):
+    pass
+
+class TFTPRequestError(farb.FarbError):
+    """
+    A request that is answered with a TFTP error packet
+    """
+    def __init__(self, code, message):
+        farb.FarbError.__init__(self, message)
+        self.code = code
+        self.message = message
+
+def _errorPacket(code, message):
+    return struct.pack('!HH', OP_ERROR, code) + message + '\0'
+
+def parseRequest(packet):
+    """
+    Parse a read or write request packet.
+    @param packet: Request packet, including the opcode
+    @return Tuple of (filename, mode, options). Option names and the mode
+        are lowercased.
+    """
+    fields = packet[2:].split('\0')
+    if (len(fields) < 3 or fields[-1] != ''):
+        raise TFTPRequestError(ERR_ILLEGAL_OP, "Malformed request")
+    fields = fields[:-1]
+
+    filename = fields[0]
+    mode = fields[1].lower()
+    options = {}
+    for i in range(2, len(fields) - 1, 2):
+        options[fields[i].lower()] = fields[i + 1]
+
+    return filename, mode, options
+
+class _FileCache(object):
+    """
+    Reference counted, read-only memory maps of the files being served
+    """
+    def __init__(self):
+        self.files = {}
+
+    def open(self, path):
+        """
+        @param path: File to open
+        @return Tuple of (key, data), where key must be passed to release()
+            once the data is no longer needed
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        if (self.files.has_key(key)):
+            entry = self.files[key]
+            entry[1] += 1
+            return key, entry[0]
+
+        if (st.st_size == 0):
+            data = ''
+        else:
+            f = open(path, 'rb')
+            try:
+                data = mmap.mmap(f.fileno(), st.st_size, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+
+        self.files[key] = [data, 1]
+        return key, data
+
+    def release(self, key):
+        entry = self.files[key]
+        entry[1] -= 1
+        if (entry[1] == 0):
+            if (hasattr(entry[0], 'close')):
+                entry[0].close()
+            del self.files[key]
+
+class _Transfer(object):
+    """
+    A single file transfer to a client
+    """
+    def __init__(self, host, client, filename, key, data, options):
+        """
+        @param host: Local address to send from
+        @param client: Client address
+        @param filename: Requested file name, for logging
+        @param key: File cache key
+        @param data: File contents
+        @param options: Dictionary of negotiated options. If not empty,
+            an OACK is sent before the first data block.
+        """
+        self.client = client
+        self.filename = filename
+        self.key = key
+        self.data = data
+        self.options = options
+        self.oackPending = bool(options)
+
+        self.blksize = int(options.get('blksize', DEFAULT_BLKSIZE))
+        self.windowsize = int(options.get('windowsize', 1))
+        self.timeout = int(options.get('timeout', DEFAULT_TIMEOUT))
+
+        # Blocks are numbered from 1, and a short final block (possibly
+        # empty) marks the end of the file
+        self.lastBlock = len(data) // self.blksize + 1
+        self.acked = 0
+        self.sent = 0
+        self.retries = 0
+        self.deadline = 0
+        self.done = False
+        self.completed = False
+        self.started = time.time()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, 0))
+
+    def start(self):
+        if (self.oackPending):
+            self._sendOACK()
+        else:
+            self._sendWindow()
+
+    def _sendOACK(self):
+        packet = struct.pack('!H', OP_OACK)
+        for name, value in self.options.items():
+            packet += '%s\0%s\0' % (name, value)
+        self.socket.sendto(packet, self.client)
+        self.deadline = time.time() + self.timeout
+
+    def _sendWindow(self):
+        """
+        Send the window of blocks following the last acknowledged block
+        """
+        last = min(self.acked + self.windowsize, self.lastBlock)
+        for block in xrange(self.acked + 1, last + 1):
+            offset = (block - 1) * self.blksize
+            packet = struct.pack('!HH', OP_DATA, block & 0xffff) + self.data[offset:offset + self.blksize]
+            self.socket.sendto(packet, self.client)
+        self.sent = last
+        self.deadline = time.time() + self.timeout
+
+    def handle(self):
+        """
+        Handle a packet received from the client
+        """
+        packet, address = self.socket.recvfrom(MAX_PACKET)
+        if (address != self.client):
+            self.socket.sendto(_errorPacket(ERR_UNKNOWN_TID, "Unknown transfer ID"), address)
+            return
+        if (len(packet) < 4):
+            return
+
+        opcode, block = struct.unpack('!HH', packet[:4])
+        if (opcode == OP_ERROR):
+            # The client abandoned the transfer
+            self.done = True
+            return
+        if (opcode != OP_ACK):
+            self.socket.sendto(_errorPacket(ERR_ILLEGAL_OP, "Illegal TFTP operation"), self.client)
+            self.done = True
+            return
+
+        if (self.oackPending):
+            if (block == 0):
+                self.oackPending = False
+                self.retries = 0
+                self._sendWindow()
+            return
+
+        # Find the acknowledged block within the outstanding window. Stale
+        # and duplicate acknowledgements are ignored.
+        acked = self.acked + ((block - self.acked) & 0xffff)
+        if (acked <= self.acked or acked > self.sent):
+            return
+
+        self.acked = acked
+        self.retries = 0
+        if (self.acked == self.lastBlock):
+            self.done = True
+            self.completed = True
+            return
+
+        self._sendWindow()
+
+    def checkTimeout(self, now):
+        """
+        Retransmit the unacknowledged window, or give up, if the client has
+        not responded in time.
+        """
+        if (self.done or now < self.deadline):
+            return
+
+        self.retries += 1
+        if (self.retries > MAX_RETRIES):
+            self.done = True
+        elif (self.oackPending):
+            self._sendOACK()
+        else:
+            self._sendWindow()
+
+    def close(self):
+        self.socket.close()
+
+class TFTPServer(object):
+    """
+    Serve the files in a directory over TFTP
+    """
+    def __init__(self, root, address=('', 69), log=None, maxBlockSize=MAX_BLKSIZE, maxWindowSize=MAX_WINDOWSIZE):
+        """
+        Create a new TFTP server, listening on the given address
+        @param root: Directory to serve
+        @param address: Tuple of (host, port) to listen on
+        @param log: Optional open log file
+        @param maxBlockSize: Largest block size to negotiate
+        @param maxWindowSize: Largest window size to negotiate
+        """
+        self.root = root
+        self.log = log
+        self.maxBlockSize = maxBlockSize
+        self.maxWindowSize = maxWindowSize
+        self.transfers = {}
+        self.files = _FileCache()
+
+        self.host = address[0]
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.socket.bind(address)
+        except socket.error, e:
+            self.socket.close()
+            raise TFTPServerError, "Could not listen on %s:%d: %s" % (address[0], address[1], e)
+
+    def getAddress(self):
+        """
+        @return The (host, port) tuple the server is listening on
+        """
+        return self.socket.getsockname()
+
+    def _log(self, message):
+        if (self.log):
+            self.log.write(message + '\n')
+
+    def _resolve(self, filename):
+        """
+        @return The path of a requested file, which must be within the
+            served directory
+        """
+        name = filename.replace('\\', '/').lstrip('/')
+        root = os.path.realpath(self.root)
+        path = os.path.realpath(os.path.join(root, name))
+        if (not path.startswith(root + os.sep)):
+            raise TFTPRequestError(ERR_ACCESS, "Access violation")
+        if (not os.path.isfile(path)):
+            raise TFTPRequestError(ERR_NOT_FOUND, "File not found")
+        return path
+
+    def _negotiate(self, options, size):
+        """
+        @return A dictionary of the accepted options and their values
+        """
+        accepted = {}
+        for name, value in options.items():
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+
+            if (name == 'blksize' and value >= MIN_BLKSIZE):
+                accepted[name] = min(value, self.maxBlockSize)
+            elif (name == 'windowsize' and value >= 1):
+                accepted[name] = min(value, self.maxWindowSize)
+            elif (name == 'timeout' and value >= 1 and value <= MAX_TIMEOUT):
+                accepted[name] = value
+            elif (name == 'tsize'):
+                accepted[name] = size
+        return accepted
+
+    def _handleRequest(self):
+        packet, client = self.socket.recvfrom(MAX_PACKET)
+        try:
+            if (len(packet) < 2):
+                raise TFTPRequestError(ERR_ILLEGAL_OP, "Illegal TFTP operation")
+            opcode = struct.unpack('!H', packet[:2])[0]
+            if (opcode == OP_WRQ):
+                raise TFTPRequestError(ERR_ACCESS, "Server is read only")
+            if (opcode != OP_RRQ):
+                raise TFTPRequestError(ERR_ILLEGAL_OP, "Illegal TFTP operation")
+
+            filename, mode, options = parseRequest(packet)
+            if (mode not in ('octet', 'netascii')):
+                raise TFTPRequestError(ERR_ILLEGAL_OP, "Unsupported transfer mode")
+
+            path = self._resolve(filename)
+            try:
+                key, data = self.files.open(path)
+            except (IOError, OSError), e:
+                raise TFTPRequestError(ERR_ACCESS, "Could not read file")
+
+        except TFTPRequestError, e:
+            self._log("Refused request from %s:%d: %s" % (client[0], client[1], e.message))
+            self.socket.sendto(_errorPacket(e.code, e.message), client)
+            return
+
+        transfer = _Transfer(self.host, client, filename, key, data, self._negotiate(options, len(data)))
+        self.transfers[transfer.socket] = transfer
+        self._log("Sending %s to %s:%d (block size %d, window size %d)" % (filename, client[0], client[1], transfer.blksize, transfer.windowsize))
+        transfer.start()
+
+    def serve(self, timeout=None):
+        """
+        Wait for, and handle, a single round of network events.
+        @param timeout: Maximum number of seconds to wait, or None to wait
+            until a request arrives or a transfer times out
+        """
+        wait = timeout
+        for transfer in self.transfers.values():
+            remaining = max(transfer.deadline - time.time(), 0)
+            if (wait == None or remaining < wait):
+                wait = remaining
+
+        try:
+            readable = select.select([self.socket] + self.transfers.keys(), [], [], wait)[0]
+        except select.error, e:
+            if (e.args[0] == errno.EINTR):
+                return
+            raise
+
+        for sock in readable:
+            if (sock is self.socket):
+                self._handleRequest()
+            elif (self.transfers.has_key(sock)):
+                self.transfers[sock].handle()
+
+        now = time.time()
+        for sock, transfer in self.transfers.items():
+            transfer.checkTimeout(now)
+            if (not transfer.done):
+                continue
+
+            if (transfer.completed):
+                elapsed = max(now - transfer.started, 0.001)
+                self._log("Sent %s to %s:%d (%d bytes in %.2f seconds, %.0f KB/s)" % (transfer.filename, transfer.client[0], transfer.client[1], len(transfer.data), elapsed, len(transfer.data) / elapsed / 1024))
+            else:
+                self._log("Transfer of %s to %s:%d failed" % (transfer.filename, transfer.client[0], transfer.client[1]))
+            transfer.close()
+            self.files.release(transfer.key)
+            del self.transfers[sock]
+
+    def serveForever(self):
+        """
+        Serve requests until interrupted
+        """
+        while (True):
+            self.serve()
+
+    def close(self):
+        """
+        Stop serving, abandoning any transfers in progress
+        """
+        for transfer in self.transfers.values():
+            transfer.close()
+            self.files.release(transfer.key)
+        self.transfers = {}
+        self.socket.close()
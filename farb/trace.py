@@ -0,0 +1,382 @@
+# trace.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Structured timeline of a farbot run.
+
+Runner phases, pipeline tasks, assembler steps and commands are
+recorded as spans, written one JSON object per line as they begin and
+end:
+
+    {"event": "begin", "id": 1, "parent": null, "name": "install",
+     "category": "phase", "thread": "MainThread", "ts": 1215000000.5,
+     "args": {}}
+    {"event": "end", "id": 1, "ts": 1215000042.25, "args": {}}
+
+Each thread keeps a stack of its open spans, which become the parents
+of the spans it begins. A trace can be converted to the Chrome trace
+event format, for viewing on a timeline. Listeners may also be notified
+of each span as it begins and ends, with or without a trace file.
+"""
+
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+import farb
+
+class TraceError(farb.FarbError):
+    pass
+
+class Tracer(object):
+    """
+    Write span events to a JSON lines trace file, and notify listeners
+    of completed spans
+    """
+    def __init__(self, path=None):
+        """
+        Create a new Tracer instance, replacing any existing trace file
+        @param path: Trace file path, or None to only notify listeners
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._nextId = 1
+        self._listeners = []
+        self._beginListeners = []
+        # Begin events of open spans, by id
+        self._open = {}
+        self._file = None
+        if (path is None):
+            return
+        if (json is None):
+            raise TraceError, "Tracing requires the json or simplejson module"
+        try:
+            self._file = open(path, 'w')
+        except IOError, e:
+            raise TraceError, "Could not open trace file %s: %s" % (path, e)
+
+    def addListener(self, listener):
+        """
+        Notify a listener of each span as it ends
+        @param listener: Callable passed a span dictionary, as returned by
+            readTrace(). It is called from the thread that ended the span.
+        """
+        self._listeners.append(listener)
+
+    def addBeginListener(self, listener):
+        """
+        Notify a listener of each span as it begins
+        @param listener: Callable passed the span's begin event dictionary.
+            It is called from the thread that began the span.
+        """
+        self._beginListeners.append(listener)
+
+    def _write(self, event):
+        if (self._file is None):
+            return
+        self._file.write(json.dumps(event) + '\n')
+        self._file.flush()
+
+    def begin(self, name, category, args=None, parent=None, thread=None):
+        """
+        Record the beginning of a span
+        @param name: Span name
+        @param category: Span category, such as phase, task, stage, step or
+            command
+        @param args: Optional dictionary of details
+        @param parent: Optional id of the enclosing span
+        @param thread: Name of the thread the span belongs to. Defaults to
+            the current thread
+        @return The span id
+        """
+        if (thread is None):
+            thread = threading.currentThread().getName()
+        if (args is None):
+            args = {}
+        self._lock.acquire()
+        try:
+            span = self._nextId
+            self._nextId += 1
+            event = {
+                'event' : 'begin',
+                'id' : span,
+                'parent' : parent,
+                'name' : name,
+                'category' : category,
+                'thread' : thread,
+                'ts' : time.time(),
+                'args' : args
+            }
+            self._write(event)
+            self._open[span] = event
+        finally:
+            self._lock.release()
+
+        for listener in self._beginListeners:
+            listener(dict(event))
+        return span
+
+    def end(self, span, args=None):
+        """
+        Record the end of a span
+        @param span: Span id returned by begin()
+        @param args: Optional dictionary of results
+        """
+        if (args is None):
+            args = {}
+        self._lock.acquire()
+        try:
+            ts = time.time()
+            self._write({'event' : 'end', 'id' : span, 'ts' : ts, 'args' : args})
+            event = self._open.pop(span, None)
+        finally:
+            self._lock.release()
+
+        if (event is None):
+            return
+        completed = dict(event)
+        del completed['event']
+        completed['end'] = ts
+        completed['results'] = args
+        for listener in self._listeners:
+            listener(completed)
+
+    def close(self):
+        if (self._file is not None):
+            self._file.close()
+
+# Tracer recording the current run, if any
+_tracer = None
+
+# Per-thread stack of open span ids
+_context = threading.local()
+
+def setTracer(tracer):
+    """
+    Record spans begun with begin() to a Tracer
+    @param tracer: Tracer, or None to stop tracing
+    """
+    global _tracer
+    _tracer = tracer
+
+def getTracer():
+    """
+    @return The current Tracer, or None
+    """
+    return _tracer
+
+def _getStack():
+    stack = getattr(_context, 'stack', None)
+    if (stack is None):
+        stack = []
+        _context.stack = stack
+    return stack
+
+def getCurrent():
+    """
+    @return The id of the current thread's innermost open span, or None
+    """
+    stack = _getStack()
+    if (stack):
+        return stack[-1]
+    return None
+
+def adopt(span):
+    """
+    Make a span begun by another thread the parent of the spans the
+    current thread begins
+    @param span: Span id, or None
+    """
+    if (span is not None):
+        _getStack().append(span)
+
+def begin(name, category, args=None):
+    """
+    Begin a span within the current thread's innermost open span. Does
+    nothing if there is no Tracer.
+    @param name: Span name
+    @param category: Span category
+    @param args: Optional dictionary of details
+    @return The span id, or None
+    """
+    tracer = _tracer
+    if (tracer is None):
+        return None
+    span = tracer.begin(name, category, args, parent=getCurrent())
+    _getStack().append(span)
+    return span
+
+def end(span, args=None):
+    """
+    End a span begun with begin()
+    @param span: Span id, or None
+    @param args: Optional dictionary of results
+    """
+    tracer = _tracer
+    if (tracer is None or span is None):
+        return
+    stack = _getStack()
+    if (span in stack):
+        del stack[stack.index(span):]
+    tracer.end(span, args)
+
+def traced(category, name, results=None):
+    """
+    Decorate a method, recording each call as a span
+    @param category: Span category
+    @param name: Span name. A string is formatted with the instance's
+        attributes; a callable is passed the method's arguments, including
+        the instance, and returns the name
+    @param results: Optional callable passed the method's return value,
+        returning a dictionary of results to record
+    """
+    def decorate(function):
+        def wrapper(self, *args, **kwargs):
+            if (_tracer is None):
+                return function(self, *args, **kwargs)
+            if (callable(name)):
+                spanName = name(self, *args, **kwargs)
+            else:
+                spanName = name % self.__dict__
+            span = begin(spanName, category)
+            try:
+                value = function(self, *args, **kwargs)
+            except:
+                end(span, {'error' : str(sys.exc_info()[1])})
+                raise
+            if (results is not None):
+                end(span, results(value))
+            else:
+                end(span)
+            return value
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorate
+
+def readTrace(path):
+    """
+    Read a trace file, pairing each span's begin and end events
+    @param path: Trace file path
+    @return A list of span dictionaries, in the order they began, with
+        the begin event's fields, plus 'end', the end timestamp or None if
+        the span never ended, and 'results', the end event's args
+    """
+    if (json is None):
+        raise TraceError, "Reading traces requires the json or simplejson module"
+    spans = []
+    spansById = {}
+    f = open(path, 'r')
+    try:
+        for line in f:
+            line = line.strip()
+            if (not line):
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError, e:
+                raise TraceError, "Invalid trace event in %s: %s" % (path, e)
+            if (event['event'] == 'begin'):
+                span = dict(event)
+                del span['event']
+                span['end'] = None
+                span['results'] = {}
+                spans.append(span)
+                spansById[span['id']] = span
+            elif (spansById.has_key(event['id'])):
+                span = spansById[event['id']]
+                span['end'] = event['ts']
+                span['results'] = event['args']
+    finally:
+        f.close()
+    return spans
+
+def exportChromeTrace(path, outputPath):
+    """
+    Convert a trace to the Chrome trace event format, as loaded by
+    chrome://tracing and Perfetto. Each span becomes a complete event on
+    its thread's track. Spans that never ended are extended to the end
+    of the trace.
+    @param path: Trace file path
+    @param outputPath: Chrome trace file to write
+    """
+    spans = readTrace(path)
+    if (not spans):
+        start = finish = 0
+    else:
+        start = min([span['ts'] for span in spans])
+        finish = max([span['end'] or span['ts'] for span in spans])
+
+    threads = {}
+    events = []
+    pid = 1
+    for span in spans:
+        if (not threads.has_key(span['thread'])):
+            threads[span['thread']] = len(threads) + 1
+            events.append({
+                'name' : 'thread_name',
+                'ph' : 'M',
+                'pid' : pid,
+                'tid' : threads[span['thread']],
+                'args' : {'name' : span['thread']}
+            })
+
+        args = dict(span['args'])
+        args.update(span['results'])
+        end = span['end']
+        if (end is None):
+            end = finish
+            args['unfinished'] = True
+        events.append({
+            'name' : span['name'],
+            'cat' : span['category'],
+            'ph' : 'X',
+            'ts' : int((span['ts'] - start) * 1000000),
+            'dur' : int((end - span['ts']) * 1000000),
+            'pid' : pid,
+            'tid' : threads[span['thread']],
+            'args' : args
+        })
+
+    try:
+        f = open(outputPath, 'w')
+        try:
+            json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
+        finally:
+            f.close()
+    except IOError, e:
+        raise TraceError, "Could not write Chrome trace %s: %s" % (outputPath, e)
@@ -0,0 +1,753 @@
+# ufs.py vi:ts=4:sw=4:expandtab:
+#
+# Copyright (c) 2006-2008 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Minimal read/write access to FreeBSD UFS1 and UFS2 file system images.
+
+This is intended for customizing small images, such as an installation
+mfsroot, without attaching and mounting them: files of up to NDADDR
+blocks may be created or replaced in an existing directory. Cylinder
+group accounting is recomputed from the block and inode maps after
+every change, in the same way fsck_ffs(8) pass 5 does.
+"""
+
+import array
+import os
+import struct
+import time
+
+import farb
+
+# Superblock locations searched, in order, and the size of the
+# superblock buffer
+SBLOCK_UFS2 = 65536
+SBLOCK_UFS1 = 8192
+SBLOCK_PIGGY = 262144
+SBLOCKSIZE = 8192
+
+# Magic numbers
+FS_UFS1_MAGIC = 0x011954
+FS_UFS2_MAGIC = 0x19540119
+CG_MAGIC = 0x090255
+
+# Flags
+FS_FLAGS_UPDATED = 0x80
+FS_METACKHASH = 0x200
+FS_44INODEFMT = 2
+
+# File system constants
+ROOTINO = 2
+NDADDR = 12
+NIADDR = 3
+DIRBLKSIZ = 512
+DEV_BSIZE = 512
+MAXNAMLEN = 255
+
+# Inode modes and directory entry types
+IFMT = 0170000
+IFDIR = 0040000
+IFREG = 0100000
+DT_DIR = 4
+DT_REG = 8
+
+# Superblock fields: (format, offset)
+SB_FIELDS = {
+    'cblkno' : ('i', 12),
+    'iblkno' : ('i', 16),
+    'old_cgoffset' : ('i', 24),
+    'old_cgmask' : ('i', 28),
+    'ncg' : ('I', 44),
+    'bsize' : ('i', 48),
+    'fsize' : ('i', 52),
+    'frag' : ('i', 56),
+    'sbsize' : ('i', 104),
+    'nindir' : ('i', 116),
+    'inopb' : ('I', 120),
+    'old_csaddr' : ('i', 152),
+    'cgsize' : ('i', 160),
+    'ipg' : ('I', 184),
+    'fpg' : ('i', 188),
+    'old_cstotal' : ('4i', 192),
+    'clean' : ('B', 209),
+    'old_flags' : ('B', 211),
+    'cstotal' : ('4q', 1008),
+    'csaddr' : ('q', 1096),
+    'flags' : ('i', 1312),
+    'contigsumsize' : ('i', 1316),
+    'old_inodefmt' : ('i', 1324),
+    'magic' : ('i', 1372)
+}
+
+# Cylinder group fields
+CG_FIELDS = {
+    'magic' : ('i', 4),
+    'ndblk' : ('I', 20),
+    'cs' : ('4i', 24),
+    'frsum' : ('8i', 52),
+    'iusedoff' : ('I', 92),
+    'freeoff' : ('I', 96),
+    'clustersumoff' : ('I', 104),
+    'clusteroff' : ('I', 108),
+    'nclusterblks' : ('I', 112),
+    'niblk' : ('I', 116),
+    'initediblk' : ('I', 120)
+}
+
+# Inode fields, by file system format
+UFS1_INODE_FIELDS = {
+    'mode' : ('H', 0),
+    'nlink' : ('h', 2),
+    'size' : ('Q', 8),
+    'atime' : ('i', 16),
+    'mtime' : ('i', 24),
+    'ctime' : ('i', 32),
+    'db' : ('12i', 40),
+    'ib' : ('3i', 88),
+    'blocks' : ('i', 104),
+    'gen' : ('i', 108),
+    'uid' : ('I', 112),
+    'gid' : ('I', 116)
+}
+
+UFS2_INODE_FIELDS = {
+    'mode' : ('H', 0),
+    'nlink' : ('h', 2),
+    'uid' : ('I', 4),
+    'gid' : ('I', 8),
+    'size' : ('Q', 16),
+    'blocks' : ('Q', 24),
+    'atime' : ('q', 32),
+    'mtime' : ('q', 40),
+    'ctime' : ('q', 48),
+    'gen' : ('I', 80),
+    'db' : ('12q', 112),
+    'ib' : ('3q', 208)
+}
+
+# Directory entry header: ino, reclen, type, namlen
+DIRECT_HEADER = 'IHBB'
+
+class UFSImageError(farb.FarbError):
+    pass
+
+def _dirsiz(namlen):
+    """
+    @param namlen: Length of a directory entry's name
+    @return The minimum record length of the directory entry
+    """
+    return (struct.calcsize(DIRECT_HEADER) + namlen + 1 + 3) & ~3
+
+class _Struct(object):
+    """
+    An on-disk structure, held in a mutable buffer
+    """
+    def __init__(self, data, fields, endian):
+        """
+        @param data: Raw structure contents
+        @param fields: Dictionary mapping field names to (format, offset)
+        @param endian: struct(3) byte order character
+        """
+        self.buf = array.array('B', data)
+        self.fields = fields
+        self.endian = endian
+
+    def get(self, name):
+        fmt, offset = self.fields[name]
+        return self.getAt(fmt, offset)
+
+    def set(self, name, value):
+        fmt, offset = self.fields[name]
+        self.setAt(fmt, offset, value)
+
+    def getAt(self, fmt, offset):
+        fmt = self.endian + fmt
+        values = struct.unpack(fmt, self.buf[offset:offset + struct.calcsize(fmt)].tostring())
+        # Formats with a repeat count return a list
+        if (fmt[1].isdigit()):
+            return list(values)
+        return values[0]
+
+    def setAt(self, fmt, offset, value):
+        fmt = self.endian + fmt
+        if (not isinstance(value, list)):
+            value = [value]
+        data = struct.pack(fmt, *value)
+        self.buf[offset:offset + len(data)] = array.array('B', data)
+
+    def isset(self, base, bit):
+        return (self.buf[base + (bit >> 3)] & (1 << (bit & 7))) != 0
+
+    def setbit(self, base, bit):
+        self.buf[base + (bit >> 3)] |= (1 << (bit & 7))
+
+    def clrbit(self, base, bit):
+        self.buf[base + (bit >> 3)] &= ~(1 << (bit & 7)) & 0xff
+
+    def tostring(self):
+        return self.buf.tostring()
+
+class UFSImage(object):
+    """
+    A UFS1 or UFS2 file system image, opened for modification
+    """
+    def __init__(self, path):
+        """
+        Open an image and read its superblock.
+        @param path: Path to the file system image
+        """
+        self.path = path
+        try:
+            self.file = open(path, 'r+b')
+        except IOError, e:
+            raise UFSImageError, "Could not open UFS image %s: %s" % (path, e)
+
+        try:
+            self._readSuperblock()
+        except:
+            self.file.close()
+            raise
+
+        # Cylinder groups read so far, and those modified
+        self.cgs = {}
+        self.dirty = {}
+
+    def close(self):
+        """
+        Close the image. All changes are written by writeFile().
+        """
+        self.file.close()
+
+    def _readSuperblock(self):
+        for sblockloc, magics in ((SBLOCK_UFS2, (FS_UFS2_MAGIC,)), (SBLOCK_UFS1, (FS_UFS1_MAGIC, FS_UFS2_MAGIC)), (SBLOCK_PIGGY, (FS_UFS2_MAGIC,))):
+            data = self._read(sblockloc, SBLOCKSIZE)
+            if (len(data) < SBLOCKSIZE):
+                continue
+            for endian in ('<', '>'):
+                sb = _Struct(data, SB_FIELDS, endian)
+                if (sb.get('magic') in magics):
+                    break
+            else:
+                continue
+            break
+        else:
+            raise UFSImageError, "No UFS superblock found in %s" % (self.path)
+
+        self.sblockloc = sblockloc
+        self.sb = sb
+        self.endian = sb.endian
+        self.ufs1 = (sb.get('magic') == FS_UFS1_MAGIC)
+
+        if (sb.get('flags') & FS_METACKHASH):
+            raise UFSImageError, "%s uses metadata check hashes, which are not supported" % (self.path)
+        if (not sb.get('clean')):
+            raise UFSImageError, "The file system in %s is not clean" % (self.path)
+        if (self.ufs1 and sb.get('old_inodefmt') < FS_44INODEFMT):
+            raise UFSImageError, "%s uses an unsupported inode format" % (self.path)
+
+        self.bsize = sb.get('bsize')
+        self.fsize = sb.get('fsize')
+        self.frag = sb.get('frag')
+        self.fpg = sb.get('fpg')
+        self.ipg = sb.get('ipg')
+        self.inopb = sb.get('inopb')
+        self.nindir = sb.get('nindir')
+        self.ncg = sb.get('ncg')
+        self.contigsumsize = sb.get('contigsumsize')
+
+        if (self.ufs1):
+            self.csaddr = sb.get('old_csaddr')
+            self.inodeFields = UFS1_INODE_FIELDS
+            self.isize = 128
+            self.addrFormat = 'i'
+        else:
+            self.csaddr = sb.get('csaddr')
+            self.inodeFields = UFS2_INODE_FIELDS
+            self.isize = 256
+            self.addrFormat = 'q'
+
+    #
+    # Raw I/O
+    #
+    def _read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def _write(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+
+    def _readFrags(self, fsbn, nfrags):
+        return self._read(fsbn * self.fsize, nfrags * self.fsize)
+
+    #
+    # Geometry
+    #
+    def _cgstart(self, cgx):
+        start = self.fpg * cgx
+        if (self.ufs1):
+            start += self.sb.get('old_cgoffset') * (cgx & ~self.sb.get('old_cgmask'))
+        return start
+
+    def _numfrags(self, nbytes):
+        return (nbytes + self.fsize - 1) // self.fsize
+
+    def _blksize(self, size, lbn):
+        """
+        @return The number of bytes allocated to logical block lbn of a
+            file of the given size
+        """
+        if (lbn >= NDADDR or size >= (lbn + 1) * self.bsize):
+            return self.bsize
+        return self._numfrags(size % self.bsize) * self.fsize
+
+    #
+    # Cylinder groups
+    #
+    def _cg(self, cgx):
+        if (not self.cgs.has_key(cgx)):
+            offset = (self._cgstart(cgx) + self.sb.get('cblkno')) * self.fsize
+            cg = _Struct(self._read(offset, self.sb.get('cgsize')), CG_FIELDS, self.endian)
+            if (cg.get('magic') != CG_MAGIC):
+                raise UFSImageError, "Bad magic number in cylinder group %d of %s" % (cgx, self.path)
+            self.cgs[cgx] = cg
+        return self.cgs[cgx]
+
+    def _cgOrder(self, prefcg):
+        return range(prefcg, self.ncg) + range(0, prefcg)
+
+    def _summarize(self, cg):
+        """
+        Recompute a cylinder group's free block counts, fragment summary
+        and cluster map from its free fragment map.
+        """
+        ndblk = cg.get('ndblk')
+        freeoff = cg.get('freeoff')
+        nblocks = (ndblk + self.frag - 1) // self.frag
+        nbfree = 0
+        nffree = 0
+        frsum = [0] * 8
+        clusters = []
+
+        for blk in xrange(nblocks):
+            base = blk * self.frag
+            free = [base + i < ndblk and cg.isset(freeoff, base + i) for i in xrange(self.frag)]
+            if (False not in free):
+                nbfree += 1
+                clusters.append(True)
+                continue
+
+            clusters.append(False)
+            run = 0
+            for bit in free + [False]:
+                if (bit):
+                    run += 1
+                elif (run):
+                    nffree += run
+                    frsum[run] += 1
+                    run = 0
+
+        cs = cg.get('cs')
+        cs[1] = nbfree
+        cs[2] = self.ipg - len([i for i in xrange(self.ipg) if cg.isset(cg.get('iusedoff'), i)])
+        cs[3] = nffree
+        cg.set('cs', cs)
+        frsum[0] = cg.get('frsum')[0]
+        cg.set('frsum', frsum)
+
+        if (self.contigsumsize <= 0):
+            return
+
+        clusteroff = cg.get('clusteroff')
+        nclusterblks = cg.get('nclusterblks')
+        sums = [0] * (self.contigsumsize + 1)
+        run = 0
+        for blk in xrange(nclusterblks):
+            if (blk < len(clusters) and clusters[blk]):
+                cg.setbit(clusteroff, blk)
+                run += 1
+            else:
+                cg.clrbit(clusteroff, blk)
+                if (run):
+                    sums[min(run, self.contigsumsize)] += 1
+                    run = 0
+        if (run):
+            sums[min(run, self.contigsumsize)] += 1
+
+        # The first entry of the cluster summary overlaps the free map
+        cg.setAt('%di' % self.contigsumsize, cg.get('clustersumoff') + 4, sums[1:])
+
+    def _flush(self):
+        """
+        Write modified cylinder groups, along with the file system's
+        summary information.
+        """
+        if (not self.dirty):
+            return
+
+        csoffset = self.csaddr * self.fsize
+        csum = _Struct(self._read(csoffset, self.ncg * 16), {}, self.endian)
+        total = [0, 0, 0, 0]
+
+        for cgx in self.dirty.keys():
+            cg = self.cgs[cgx]
+            old = cg.get('cs')
+            self._summarize(cg)
+            new = cg.get('cs')
+            delta = [new[i] - old[i] for i in range(4)]
+
+            cs = csum.getAt('4i', cgx * 16)
+            csum.setAt('4i', cgx * 16, [cs[i] + delta[i] for i in range(4)])
+            total = [total[i] + delta[i] for i in range(4)]
+
+            self._write((self._cgstart(cgx) + self.sb.get('cblkno')) * self.fsize, cg.tostring())
+
+        self._write(csoffset, csum.tostring())
+
+        if (self.ufs1):
+            cs = self.sb.get('old_cstotal')
+            self.sb.set('old_cstotal', [cs[i] + total[i] for i in range(4)])
+        if (not self.ufs1 or self.sb.get('old_flags') & FS_FLAGS_UPDATED):
+            cs = self.sb.get('cstotal')
+            self.sb.set('cstotal', [cs[i] + total[i] for i in range(4)])
+        self._write(self.sblockloc, self.sb.tostring()[:self.sb.get('sbsize')])
+
+        self.file.flush()
+        self.dirty = {}
+
+    #
+    # Block allocation
+    #
+    def _allocFrags(self, nfrags, prefcg):
+        """
+        Allocate nfrags contiguous fragments within a single block,
+        preferring the best fitting run of free fragments.
+        @return The file system address of the first fragment
+        """
+        for cgx in self._cgOrder(prefcg):
+            cg = self._cg(cgx)
+            ndblk = cg.get('ndblk')
+            freeoff = cg.get('freeoff')
+            best = None
+            for blkstart in xrange(0, ndblk, self.frag):
+                run = 0
+                for frag in xrange(blkstart, min(blkstart + self.frag, ndblk) + 1):
+                    if (frag < min(blkstart + self.frag, ndblk) and cg.isset(freeoff, frag)):
+                        run += 1
+                        continue
+                    if (run >= nfrags and (best == None or run < best[1])):
+                        best = (frag - run, run)
+                    run = 0
+                if (best and best[1] == nfrags):
+                    break
+
+            if (best):
+                for frag in xrange(best[0], best[0] + nfrags):
+                    cg.clrbit(freeoff, frag)
+                self.dirty[cgx] = True
+                return cgx * self.fpg + best[0]
+
+        raise UFSImageError, "No space left in %s for %d fragments" % (self.path, nfrags)
+
+    def _freeFrags(self, fsbn, nfrags):
+        cgx = fsbn // self.fpg
+        cg = self._cg(cgx)
+        for frag in xrange(fsbn % self.fpg, fsbn % self.fpg + nfrags):
+            cg.setbit(cg.get('freeoff'), frag)
+        self.dirty[cgx] = True
+
+    #
+    # Inodes
+    #
+    def _inodeOffset(self, ino):
+        cgx = ino // self.ipg
+        index = ino % self.ipg
+        fsbn = self._cgstart(cgx) + self.sb.get('iblkno') + (index // self.inopb) * self.frag
+        return fsbn * self.fsize + (index % self.inopb) * self.isize
+
+    def _readInode(self, ino):
+        return _Struct(self._read(self._inodeOffset(ino), self.isize), self.inodeFields, self.endian)
+
+    def _writeInode(self, ino, inode):
+        self._write(self._inodeOffset(ino), inode.tostring())
+
+    def _allocInode(self, prefcg):
+        """
+        Allocate an inode, initializing inode blocks as needed.
+        @return The new inode number
+        """
+        for cgx in self._cgOrder(prefcg):
+            cg = self._cg(cgx)
+            iusedoff = cg.get('iusedoff')
+            for index in xrange(self.ipg):
+                if (not cg.isset(iusedoff, index)):
+                    break
+            else:
+                continue
+
+            if (not self.ufs1):
+                # UFS2 inode blocks are initialized on first use
+                while (index >= cg.get('initediblk')):
+                    initediblk = cg.get('initediblk')
+                    offset = self._inodeOffset(cgx * self.ipg + initediblk)
+                    self._write(offset, '\0' * self.isize * self.inopb)
+                    cg.set('initediblk', initediblk + self.inopb)
+
+            cg.setbit(iusedoff, index)
+            self.dirty[cgx] = True
+            return cgx * self.ipg + index
+
+        raise UFSImageError, "No free inodes left in %s" % (self.path)
+
+    def _fileBlocks(self, inode):
+        """
+        @return A list of the data block addresses of the inode,
+            and a list of its indirect block addresses
+        """
+        nblocks = (inode.get('size') + self.bsize - 1) // self.bsize
+        data = inode.get('db')[:min(nblocks, NDADDR)]
+        meta = []
+        remaining = nblocks - NDADDR
+        ib = inode.get('ib')
+        for level in range(NIADDR):
+            if (remaining <= 0):
+                break
+            count = min(remaining, self.nindir ** (level + 1))
+            self._indirectBlocks(ib[level], level, count, data, meta)
+            remaining -= count
+        return data, meta
+
+    def _indirectBlocks(self, fsbn, level, count, data, meta):
+        if (fsbn == 0):
+            data.extend([0] * count)
+            return
+        meta.append(fsbn)
+        ptrs = _Struct(self._readFrags(fsbn, self.frag), {}, self.endian).getAt('%d%s' % (self.nindir, self.addrFormat), 0)
+        span = self.nindir ** level
+        for ptr in ptrs:
+            if (count <= 0):
+                break
+            n = min(count, span)
+            if (level == 0):
+                data.append(ptr)
+            else:
+                self._indirectBlocks(ptr, level - 1, n, data, meta)
+            count -= n
+
+    def _readData(self, inode):
+        size = inode.get('size')
+        data, meta = self._fileBlocks(inode)
+        output = []
+        for lbn in range(len(data)):
+            blksize = self._blksize(size, lbn)
+            if (data[lbn] == 0):
+                output.append('\0' * blksize)
+            else:
+                output.append(self._read(data[lbn] * self.fsize, blksize))
+        return ''.join(output)[:size]
+
+    def _writeData(self, inode, contents, prefcg):
+        """
+        Replace the contents of an inode, releasing its existing blocks.
+        The caller is responsible for writing the inode itself.
+        """
+        if (len(contents) > NDADDR * self.bsize):
+            raise UFSImageError, "Files larger than %d bytes can not be written to %s" % (NDADDR * self.bsize, self.path)
+
+        # Release the existing blocks
+        size = inode.get('size')
+        data, meta = self._fileBlocks(inode)
+        for lbn in range(len(data)):
+            if (data[lbn] != 0):
+                self._freeFrags(data[lbn], self._numfrags(self._blksize(size, lbn)))
+        for fsbn in meta:
+            self._freeFrags(fsbn, self.frag)
+
+        # Allocate and write the new ones
+        size = len(contents)
+        db = [0] * NDADDR
+        nfrags = 0
+        for lbn in range((size + self.bsize - 1) // self.bsize):
+            blksize = self._blksize(size, lbn)
+            fsbn = self._allocFrags(self._numfrags(blksize), prefcg)
+            chunk = contents[lbn * self.bsize:lbn * self.bsize + blksize]
+            self._write(fsbn * self.fsize, chunk + '\0' * (blksize - len(chunk)))
+            db[lbn] = fsbn
+            nfrags += self._numfrags(blksize)
+
+        inode.set('size', size)
+        inode.set('db', db)
+        inode.set('ib', [0] * NIADDR)
+        inode.set('blocks', nfrags * self.fsize // DEV_BSIZE)
+
+    #
+    # Directories
+    #
+    def _entries(self, contents):
+        """
+        Iterate over the entries in directory contents.
+        @return Tuples of (offset, ino, reclen, namlen, name)
+        """
+        for chunk in range(0, len(contents), DIRBLKSIZ):
+            offset = chunk
+            while (offset < chunk + DIRBLKSIZ):
+                ino, reclen, type, namlen = struct.unpack(self.endian + DIRECT_HEADER, contents[offset:offset + 8])
+                if (reclen < 8 or offset + reclen > chunk + DIRBLKSIZ):
+                    raise UFSImageError, "Corrupt directory entry in %s" % (self.path)
+                yield (offset, ino, reclen, namlen, contents[offset + 8:offset + 8 + namlen])
+                offset += reclen
+
+    def _lookup(self, dirino, name):
+        contents = self._readData(self._readInode(dirino))
+        for offset, ino, reclen, namlen, entry in self._entries(contents):
+            if (ino != 0 and entry == name):
+                return ino
+        return None
+
+    def _namei(self, path):
+        """
+        Look up the parent directory of a path.
+        @return Tuple of (directory inode number, final path component)
+        """
+        components = [c for c in path.split('/') if c]
+        if (not components):
+            raise UFSImageError, "Invalid path %s" % (path)
+
+        dirino = ROOTINO
+        for name in components[:-1]:
+            ino = self._lookup(dirino, name)
+            if (ino == None or self._readInode(ino).get('mode') & IFMT != IFDIR):
+                raise UFSImageError, "No such directory %s in %s" % (name, self.path)
+            dirino = ino
+
+        name = components[-1]
+        if (len(name) > MAXNAMLEN):
+            raise UFSImageError, "File name %s is too long" % (name)
+        return dirino, name
+
+    def _addEntry(self, dirino, name, ino, type):
+        """
+        Add an entry to a directory, using free space in an existing
+        directory block if possible.
+        """
+        dinode = self._readInode(dirino)
+        contents = self._readData(dinode)
+        needed = _dirsiz(len(name))
+        newentry = None
+
+        for offset, entino, reclen, namlen, entry in self._entries(contents):
+            used = 0
+            if (entino != 0):
+                used = _dirsiz(namlen)
+            if (reclen - used >= needed):
+                if (used):
+                    contents = contents[:offset + 4] + struct.pack(self.endian + 'H', used) + contents[offset + 6:]
+                newentry = (offset + used, reclen - used)
+                break
+
+        if (newentry == None):
+            # Extend the directory by a directory block
+            newentry = (len(contents), DIRBLKSIZ)
+            contents += '\0' * DIRBLKSIZ
+
+        offset, reclen = newentry
+        record = struct.pack(self.endian + DIRECT_HEADER, ino, reclen, type, len(name)) + name
+        record += '\0' * (needed - len(record))
+        contents = contents[:offset] + record + contents[offset + needed:]
+
+        prefcg = dirino // self.ipg
+        if (len(contents) != dinode.get('size')):
+            self._writeData(dinode, contents, prefcg)
+        else:
+            # Rewrite only the modified directory block
+            chunk = offset - offset % DIRBLKSIZ
+            lbn = chunk // self.bsize
+            data, meta = self._fileBlocks(dinode)
+            self._write(data[lbn] * self.fsize + chunk % self.bsize, contents[chunk:chunk + DIRBLKSIZ])
+
+        now = int(time.time())
+        dinode.set('mtime', now)
+        dinode.set('ctime', now)
+        self._writeInode(dirino, dinode)
+
+    #
+    # Public interface
+    #
+    def readFile(self, path):
+        """
+        Read a file from the image.
+        @param path: Absolute path to the file within the image
+        @return The file's contents
+        """
+        dirino, name = self._namei(path)
+        ino = self._lookup(dirino, name)
+        if (ino == None):
+            raise UFSImageError, "No such file %s in %s" % (path, self.path)
+        return self._readData(self._readInode(ino))
+
+    def writeFile(self, path, contents, mode=0644, uid=0, gid=0):
+        """
+        Create or replace a regular file in the image. The file's parent
+        directory must already exist. The permissions and ownership of
+        an existing file are preserved.
+        @param path: Absolute path to the file within the image
+        @param contents: New file contents
+        @param mode: Permissions of a newly created file
+        @param uid: Owner of a newly created file
+        @param gid: Group of a newly created file
+        """
+        dirino, name = self._namei(path)
+        ino = self._lookup(dirino, name)
+        created = (ino == None)
+        now = int(time.time())
+
+        if (not created):
+            inode = self._readInode(ino)
+            if (inode.get('mode') & IFMT != IFREG):
+                raise UFSImageError, "%s is not a regular file in %s" % (path, self.path)
+        else:
+            ino = self._allocInode(dirino // self.ipg)
+            inode = self._readInode(ino)
+            gen = inode.get('gen') + 1
+            inode = _Struct('\0' * self.isize, self.inodeFields, self.endian)
+            inode.set('mode', IFREG | (mode & ~IFMT))
+            inode.set('nlink', 1)
+            inode.set('uid', uid)
+            inode.set('gid', gid)
+            inode.set('gen', gen & 0x7fffffff)
+            inode.set('atime', now)
+
+        self._writeData(inode, contents, ino // self.ipg)
+        inode.set('mtime', now)
+        inode.set('ctime', now)
+        self._writeInode(ino, inode)
+
+        if (created):
+            self._addEntry(dirino, name, ino, DT_REG)
+
+        self._flush()
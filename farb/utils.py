@@ -29,17 +29,39 @@
 
 import os
 import shutil
+import stat
+import struct
+import zlib
 
-def copyRecursive(src, dst, symlinks=False):
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+# Buffer size used when streaming file data
+COPY_BUFSIZE = 1024 * 1024
+
+# Runs of zeros at least this long are written as holes by copySparse()
+SPARSE_BLOCKSIZE = 64 * 1024
+
+def copyRecursive(src, dst, symlinks=False, ignore=None):
     """
     Recursively copy a directory tree using preserving ownership.
 
     Code adapted from the python shutil.copytree implementation.
+    @param ignore: Optional callable, called with each directory copied
+        and a list of its contents, returning the names not to copy.
     """
     names = os.listdir(src)
+    if (ignore):
+        ignoredNames = ignore(src, names)
+    else:
+        ignoredNames = ()
     os.makedirs(dst)
     errors = []
     for name in names:
+        if name in ignoredNames:
+            continue
         srcname = os.path.join(src, name)
         dstname = os.path.join(dst, name)
         try:
@@ -47,17 +69,17 @@ def copyRecursive(src, dst, symlinks=False):
                 linkto = os.readlink(srcname)
                 os.symlink(linkto, dstname)
             elif os.path.isdir(srcname):
-                copyRecursive(srcname, dstname, symlinks)
+                copyRecursive(srcname, dstname, symlinks, ignore)
             else:
                 copyWithOwnership(srcname, dstname)
         except (IOError, os.error), why:
             errors.append((srcname, dstname, why))
-        except Error, err:
+        except shutil.Error, err:
             errors.extend(err.args[0])
     shutil.copystat(src, dst)
     _copyOwnership(src, dst)
     if errors:
-        raise Error, errors
+        raise shutil.Error, errors
 
 def copyWithOwnership(src, dst):
     """
@@ -73,3 +95,172 @@ def _copyOwnership(src, dst):
     """
     st = os.stat(src)
     os.chown(dst, st.st_uid, st.st_gid)
+
+def linkIdentical(reference, target):
+    """
+    Replace regular files in target with hard links to the corresponding
+    files in reference, if the reference file appears to be identical.
+
+    Files are considered identical if their size, modification time, mode
+    and ownership match, as with rsync(1)'s quick check. Both trees must
+    reside on the same file system.
+    @param reference: Directory tree to link against
+    @param target: Directory tree whose files will be replaced with links
+    @return The number of bytes shared with the reference tree
+    """
+    shared = 0
+    for dirpath, dirnames, filenames in os.walk(target):
+        refpath = os.path.join(reference, dirpath[len(target):].lstrip(os.sep))
+        for name in filenames:
+            srcname = os.path.join(refpath, name)
+            dstname = os.path.join(dirpath, name)
+            if (os.path.islink(srcname) or os.path.islink(dstname)):
+                continue
+            if (not os.path.isfile(srcname)):
+                continue
+
+            srcstat = os.stat(srcname)
+            dststat = os.stat(dstname)
+            if (srcstat.st_ino == dststat.st_ino and srcstat.st_dev == dststat.st_dev):
+                # Already linked
+                shared += dststat.st_size
+                continue
+
+            if (srcstat.st_size != dststat.st_size or
+                    int(srcstat.st_mtime) != int(dststat.st_mtime) or
+                    srcstat.st_mode != dststat.st_mode or
+                    srcstat.st_uid != dststat.st_uid or
+                    srcstat.st_gid != dststat.st_gid):
+                continue
+
+            # Link to a temporary name, then rename over the copy so that the
+            # target path is never missing
+            tmpname = dstname + '.farbtmp'
+            os.link(srcname, tmpname)
+            os.rename(tmpname, dstname)
+            shared += dststat.st_size
+
+    return shared
+
+def getTreeSize(path, seen=None):
+    """
+    Total the sizes of the regular files in a directory tree, without
+    following symbolic links. Hard linked files are counted once.
+    @param path: Directory tree
+    @param seen: Optional dictionary of (device, inode) keys of files
+        already counted, which is updated with the tree's files
+    @return The size of the tree's files, in bytes
+    """
+    if (seen is None):
+        seen = {}
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if (not stat.S_ISREG(st.st_mode)):
+                continue
+            key = (st.st_dev, st.st_ino)
+            if (seen.has_key(key)):
+                continue
+            seen[key] = True
+            size += st.st_size
+    return size
+
+def copyFileObjSparse(fsrc, fdst):
+    """
+    Copy the contents of the file-like object fsrc to the file object fdst,
+    seeking over blocks of zeros rather than writing them, so that the
+    destination file is created sparse.
+    @param fsrc: Readable file-like object
+    @param fdst: Writable, seekable file object
+    """
+    zeros = '\0' * SPARSE_BLOCKSIZE
+    while (True):
+        buf = fsrc.read(COPY_BUFSIZE)
+        if (not buf):
+            break
+        for offset in xrange(0, len(buf), SPARSE_BLOCKSIZE):
+            block = buf[offset:offset + SPARSE_BLOCKSIZE]
+            if (block == zeros[:len(block)]):
+                fdst.seek(len(block), 1)
+            else:
+                fdst.write(block)
+
+    # Extend the file over any trailing hole
+    fdst.truncate(fdst.tell())
+
+def copySparse(src, dst):
+    """
+    Copy a file, leaving holes in the destination where the source
+    contains blocks of zeros.
+    @param src: Source file path
+    @param dst: Destination file path
+    """
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            copyFileObjSparse(fsrc, fdst)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+def sha1File(path):
+    """
+    @param path: File to hash
+    @return The hex SHA-1 digest of the file's contents
+    """
+    digest = sha1()
+    f = open(path, 'rb')
+    try:
+        while (True):
+            buf = f.read(COPY_BUFSIZE)
+            if (not buf):
+                break
+            digest.update(buf)
+    finally:
+        f.close()
+
+    return digest.hexdigest()
+
+def compressFile(path):
+    """
+    Replace a file with a gzip(1) compressed copy named path.gz. The
+    compressed file keeps the original's permissions, ownership and
+    modification time, and its gzip header records only the modification
+    time, so identical files always compress to identical output.
+    @param path: File to compress
+    @return The path of the compressed file
+    """
+    dst = path + '.gz'
+    st = os.stat(path)
+    mtime = int(st.st_mtime)
+
+    fsrc = open(path, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            # Header: magic, deflate, no flags, mtime, max compression, Unix
+            fdst.write('\037\213\010\000' + struct.pack('<L', mtime & 0xffffffffL) + '\002\003')
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+            crc = zlib.crc32('')
+            size = 0
+            while (True):
+                buf = fsrc.read(COPY_BUFSIZE)
+                if (not buf):
+                    break
+                crc = zlib.crc32(buf, crc)
+                size += len(buf)
+                fdst.write(compressor.compress(buf))
+            fdst.write(compressor.flush())
+            fdst.write(struct.pack('<LL', crc & 0xffffffffL, size & 0xffffffffL))
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+    shutil.copystat(path, dst)
+    _copyOwnership(path, dst)
+    os.unlink(path)
+    return dst
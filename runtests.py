@@ -31,10 +31,20 @@
 """ Run all unit tests. """
 
 import unittest
+from farb.test.test_accounting import *
 from farb.test.test_builder import *
 from farb.test.test_config import *
+from farb.test.test_history import *
+from farb.test.test_logfile import *
+from farb.test.test_metrics import *
+from farb.test.test_pkgindex import *
+from farb.test.test_profiling import *
+from farb.test.test_progress import *
 from farb.test.test_runner import *
 from farb.test.test_sysinstall import *
+from farb.test.test_tftp import *
+from farb.test.test_trace import *
+from farb.test.test_ufs import *
 from farb.test.test_utils import *
 
 if __name__ == '__main__':